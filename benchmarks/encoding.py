@@ -0,0 +1,119 @@
+"""
+Compare the old and new ways of turning streamed output lines into an
+encoded SSE batch, reporting lines/sec and bytes allocated per line:
+
+- old: a `JobStreamEvent` with nested pydantic models per line, then
+  `.dict()` and `JsonEncoder.encode` on the batch.
+- new: an `OutputLine` per line, encoded by `BatchEncoder`.
+
+    python benchmarks/encoding.py --lines 200000
+"""
+
+import argparse
+import re
+import time
+import tracemalloc
+
+from collections import deque
+from typing import Callable, Iterator, List
+
+from appyratus.json import JsonEncoder
+from appyratus.utils.time_utils import TimeUtils
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job, JobOutput, JobStreamEvent
+from controlgrid.processing.encoding import BatchEncoder, OutputLine
+
+
+def make_job() -> Job:
+    return Job(
+        job_id="0123456789abcdef0123456789abcdef",
+        created_at=TimeUtils.utc_now(),
+        command="yes",
+        args=[],
+        status=JobStatus.running,
+        tag="bench",
+        pid=4242,
+    )
+
+
+def old_path(job: Job, texts: List[str], batch_size: int) -> Iterator[str]:
+    encoder = JsonEncoder()
+    batch = []
+    for line_no, text in enumerate(texts):
+        event = JobStreamEvent(
+            result=None,
+            line=JobOutput(
+                job_id=job.job_id,
+                tag=job.tag,
+                timestamp=TimeUtils.utc_timestamp(),
+                data=JobOutput.Data(line_no=line_no, text=text),
+                pid=job.pid,
+            ),
+        )
+        batch.append(event.dict())
+        if len(batch) == batch_size:
+            yield encoder.encode(batch)
+            batch = []
+
+
+def new_path(job: Job, texts: List[str], batch_size: int) -> Iterator[str]:
+    encoder = BatchEncoder()
+    batch = []
+    for line_no, text in enumerate(texts):
+        timestamp = int(TimeUtils.utc_timestamp())
+        batch.append(OutputLine(job, timestamp, line_no, text))
+        if len(batch) == batch_size:
+            yield encoder.encode(batch)
+            batch = []
+
+
+def measure(name: str, func: Callable, job: Job, texts, batch_size: int):
+    start = time.perf_counter()
+    deque(func(job, texts, batch_size), maxlen=0)
+    elapsed = time.perf_counter() - start
+
+    # measure allocations in a separate run, as tracing slows things down.
+    # batches are discarded as they're encoded, so the peak is the memory
+    # allocated to build and encode one batch.
+    tracemalloc.start()
+    deque(func(job, texts[: batch_size * 10], batch_size), maxlen=0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name}: {len(texts) / elapsed:,.0f} lines/sec | "
+        f"{peak / batch_size:,.0f} peak bytes allocated per line"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    job = make_job()
+    texts = [f"line {i}: the quick brown fox" for i in range(args.lines)]
+
+    # sanity check that both paths produce the same bytes, apart from the
+    # timestamps, which may tick over in between
+    sample = texts[: args.batch_size]
+    old = list(old_path(job, sample, args.batch_size))
+    new = list(new_path(job, sample, args.batch_size))
+    strip = re.compile(r'"timestamp":\d+').sub
+    if [strip("", b) for b in old] != [strip("", b) for b in new]:
+        raise AssertionError("encoded output differs")
+    # and for lines with fields parsed out by an output pipeline
+    line = OutputLine(job, 0, 0, "50%", {"percent": "50"})
+    if BatchEncoder().encode([line]) != JsonEncoder().encode(
+        [line.to_event().dict()]
+    ):
+        raise AssertionError("encoded output with fields differs")
+
+    measure("old", old_path, job, texts, args.batch_size)
+    measure("new", new_path, job, texts, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Measure request/reply throughput and latency of `ipc.Service` over ipc://
+and tcp:// transports, for each serializer and for raw bytes payloads:
+
+- sync: one blocking `Client` request at a time, reporting p50/p99 latency.
+- pipelined: an `AsyncClient` keeping `--window` requests in flight,
+  reporting msgs/sec and p99 latency.
+
+    python benchmarks/ipc_throughput.py --requests 20000 --window 64
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from typing import Any, List
+
+import zmq
+import zmq.asyncio
+
+from controlgrid.processing.ipc import AsyncClient, Client, Service
+
+MESSAGE = {
+    "job_id": "0123456789abcdef0123456789abcdef",
+    "stream": "bench",
+    "line_no": 42,
+    "text": "the quick brown fox jumps over the lazy dog",
+}
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def echo(request: Any) -> Any:
+    return request
+
+
+def match_all(request: Any) -> bool:
+    return True
+
+
+def serve(addr: str, serializer: str, workers: int) -> None:
+    service = Service(addr, workers=workers, serializer=serializer)
+    service.add_route(match_all, echo)
+    service.run()
+
+
+def start_service(
+    addr: str, serializer: str, workers: int
+) -> multiprocessing.Process:
+    # serve from another process, so that it doesn't compete with the
+    # clients for the GIL
+    process = multiprocessing.Process(
+        target=serve, args=(addr, serializer, workers), daemon=True
+    )
+    process.start()
+    return process
+
+
+def run_sync(addr: str, serializer: str, payload: Any, n: int) -> None:
+    client = Client(addr, serializer=serializer)
+    client.request(payload, timeout=5)  # wait for the connection
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(n):
+        t = time.perf_counter()
+        client.request(payload)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    client.close()
+    report("sync", n / elapsed, latencies)
+
+
+async def run_pipelined(
+    addr: str, serializer: str, payload: Any, n: int, window: int
+) -> None:
+    context = zmq.asyncio.Context()
+    client = AsyncClient(addr, context=context, serializer=serializer)
+    await client.request(payload, timeout=5)
+    latencies: List[float] = []
+    remaining = iter(range(n))
+
+    async def worker() -> None:
+        for _ in remaining:
+            t = time.perf_counter()
+            await client.request(payload)
+            latencies.append(time.perf_counter() - t)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(window)))
+    elapsed = time.perf_counter() - start
+    client.close()
+    context.term()
+    report(f"pipelined x{window}", n / elapsed, latencies)
+
+
+def report(name: str, rate: float, latencies: List[float]) -> None:
+    print(
+        f"  {name}: {rate:,.0f} msgs/sec | "
+        f"p50 {percentile(latencies, 50) * 1e6:,.0f}us | "
+        f"p99 {percentile(latencies, 99) * 1e6:,.0f}us"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--window", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=5599)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    cases = [
+        ("pickle", MESSAGE),
+        ("msgpack", MESSAGE),
+        ("msgpack", os.urandom(4096)),
+    ]
+    port = args.port
+    for transport in ("ipc", "tcp"):
+        for serializer, payload in cases:
+            if transport == "ipc":
+                addr = f"ipc://{tmp_dir}/bench-{port}"
+            else:
+                addr = f"tcp://127.0.0.1:{port}"
+            port += 1
+
+            kind = "bytes" if isinstance(payload, bytes) else serializer
+            print(f"{transport} {kind}:")
+            service = start_service(addr, serializer, args.workers)
+            try:
+                run_sync(addr, serializer, payload, args.requests // 4)
+                asyncio.run(
+                    run_pipelined(
+                        addr, serializer, payload, args.requests, args.window
+                    )
+                )
+            finally:
+                service.terminate()
+
+
+if __name__ == "__main__":
+    main()
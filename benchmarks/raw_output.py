@@ -0,0 +1,156 @@
+"""
+Read the output of a `yes`-style job through a `Streamer` process backend
+and encode it into stream batches, in each output mode, reporting lines/sec
+and the speedup over reading a line at a time:
+
+- readline: `Process.readline` and an `OutputLine` per line.
+- lines: `Process.readlines`, a chunk of `OutputLine`s at a time.
+- text, base64: raw output read with `Process.readinto` by a `LineChunker`,
+  and sent as one `OutputBlock` per buffer, decoded or base64 encoded.
+
+Output isn't stored, so this measures reading, splitting and encoding only.
+
+    python benchmarks/raw_output.py --lines 2000000 --backend pipe
+"""
+
+import argparse
+import asyncio
+import time
+
+from typing import List
+
+from appyratus.utils.time_utils import TimeUtils
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job
+from controlgrid.processing.backends import BACKENDS, get_backend
+from controlgrid.processing.chunks import LineChunker
+from controlgrid.processing.encoding import (
+    BatchEncoder,
+    OutputBlock,
+    OutputLine,
+    StreamEvent,
+)
+
+MODES = ("readline", "lines", "text", "base64")
+
+
+def make_job(output_format: str) -> Job:
+    return Job(
+        job_id="0123456789abcdef0123456789abcdef",
+        created_at=TimeUtils.utc_now(),
+        command="yes",
+        args=[],
+        status=JobStatus.running,
+        tag="bench",
+        pid=4242,
+        output_format=output_format,
+    )
+
+
+async def run_mode(
+    mode: str, backend_name: str, lines: int, text: str, batch_size: int
+) -> float:
+    backend = get_backend(backend_name)
+    job = make_job(mode if mode in ("text", "base64") else "lines")
+    encoder = BatchEncoder()
+    script = f"yes '{text}' | head -n {lines}"
+
+    start = time.perf_counter()
+    proc = await backend.spawn(
+        "sh", ["-c", script], raw=mode in ("text", "base64")
+    )
+    batch: List[StreamEvent] = []
+    size = 0
+    line_no = 0
+    encoded_bytes = 0
+
+    if mode == "readline":
+        while True:
+            line = await proc.readline()
+            if not line:
+                break
+            batch.append(OutputLine(job, 0, line_no, line.rstrip()))
+            line_no += 1
+            if len(batch) >= batch_size:
+                encoded_bytes += len(encoder.encode(batch))
+                batch = []
+    elif mode == "lines":
+        while True:
+            texts = await proc.readlines(batch_size)
+            if not texts:
+                break
+            batch.extend(
+                OutputLine(job, 0, line_no + i, text.rstrip())
+                for i, text in enumerate(texts)
+            )
+            line_no += len(texts)
+            if len(batch) >= batch_size:
+                encoded_bytes += len(encoder.encode(batch))
+                batch = []
+    else:
+        chunker = LineChunker(proc)
+        while True:
+            chunk = await chunker.read()
+            if chunk is None:
+                break
+            data, count = chunk
+            batch.append(OutputBlock(job, 0, line_no, count, data))
+            line_no += count
+            size += len(data)
+            if size >= 1 << 18:
+                encoded_bytes += len(encoder.encode(batch))
+                batch = []
+                size = 0
+    if batch:
+        encoded_bytes += len(encoder.encode(batch))
+    await proc.wait()
+    elapsed = time.perf_counter() - start
+
+    if line_no != lines:
+        raise RuntimeError(f"{mode}: read {line_no} lines, not {lines}")
+    print(
+        f"{mode:>8}: {lines} lines in {elapsed:.2f}s | "
+        f"{lines / elapsed:,.0f} lines/s | "
+        f"{encoded_bytes / elapsed / (1 << 20):.1f} MB/s encoded"
+    )
+    return lines / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=2000000)
+    parser.add_argument("--text", default="y")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument(
+        "--backend",
+        default="pipe",
+        choices=sorted(set(BACKENDS) - {"pexpect"}),
+    )
+    parser.add_argument(
+        "--modes", nargs="+", default=list(MODES), choices=MODES
+    )
+    args = parser.parse_args()
+
+    rates = {}
+    for mode in args.modes:
+        rates[mode] = asyncio.run(
+            run_mode(
+                mode, args.backend, args.lines, args.text, args.batch_size
+            )
+        )
+
+    baseline = rates.get("readline")
+    if baseline:
+        print(
+            "speedup over readline: "
+            + ", ".join(
+                f"{mode} {rate / baseline:.1f}x"
+                for mode, rate in rates.items()
+                if mode != "readline"
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
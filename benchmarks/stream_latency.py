@@ -0,0 +1,115 @@
+"""
+Run N line-spewing jobs at the same time through each `Streamer` process
+backend and report per-stream output latency (time from the child printing a
+line to the event loop reading it), time to first line, and event loop lag.
+A blocking backend serializes the streams, which shows up as a large time to
+first line and loop lag rather than as per-line latency.
+
+    python benchmarks/stream_latency.py --jobs 50 --lines 200
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+from typing import List
+
+from controlgrid.processing.backends import BACKENDS, get_backend
+
+CHILD_SCRIPT = """
+import sys, time
+for i in range({lines}):
+    print(repr(time.time()), flush=True)
+    time.sleep({interval})
+"""
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def read_stream(
+    backend, script: str, start: float, first_lines: List[float]
+) -> List[float]:
+    latencies: List[float] = []
+    proc = await backend.spawn(sys.executable, ["-c", script])
+    while True:
+        line = await proc.readline()
+        if not line:
+            break
+        if not latencies:
+            first_lines.append(time.time() - start)
+        try:
+            latencies.append(time.time() - float(line.strip()))
+        except ValueError:
+            continue
+    await proc.wait()
+    return latencies
+
+
+async def measure_loop_lag(done: asyncio.Event, lags: List[float]) -> None:
+    interval = 0.005
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run_backend(name: str, jobs: int, lines: int, interval: float):
+    backend = get_backend(name)
+    script = CHILD_SCRIPT.format(lines=lines, interval=interval)
+    done = asyncio.Event()
+    lags: List[float] = []
+    first_lines: List[float] = []
+    lag_task = asyncio.create_task(measure_loop_lag(done, lags))
+
+    start = time.time()
+    results = await asyncio.gather(
+        *(
+            read_stream(backend, script, start, first_lines)
+            for _ in range(jobs)
+        )
+    )
+    elapsed = time.time() - start
+
+    done.set()
+    await lag_task
+
+    p50s = [percentile(r, 50) * 1000 for r in results]
+    p99s = [percentile(r, 99) * 1000 for r in results]
+    total = sum(len(r) for r in results)
+
+    print(
+        f"{name:>8}: {total} lines in {elapsed:.2f}s | "
+        f"per-stream p50 {statistics.median(p50s):.2f}ms "
+        f"(worst {max(p50s):.2f}ms) | "
+        f"per-stream p99 {statistics.median(p99s):.2f}ms "
+        f"(worst {max(p99s):.2f}ms) | "
+        f"first line p99 {percentile(first_lines, 99) * 1000:.2f}ms | "
+        f"loop lag p99 {percentile(lags, 99) * 1000:.2f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=50)
+    parser.add_argument("--lines", type=int, default=200)
+    parser.add_argument("--interval", type=float, default=0.005)
+    parser.add_argument(
+        "--backends", nargs="+", default=["pexpect", "pty", "pipe"],
+        choices=sorted(BACKENDS),
+    )
+    args = parser.parse_args()
+
+    for name in args.backends:
+        asyncio.run(run_backend(name, args.jobs, args.lines, args.interval))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,8 @@
 from .app import app
 from .routes.websocket import websocket
-from .routes.stream_event_source import stream_event_source
-from .routes.stream import stream
+from .routes.stream_event_source import stream_event_source, stream_stats
+from .routes.stream import stream, stream_batch
 from .routes.run import run
+from .routes.jobs import get_job, get_job_output, list_jobs, post_job_cancel
+from .routes.db import db_stats
+from .routes.metrics import get_metrics
@@ -1,14 +1,25 @@
-import os
+import asyncio
+
+from datetime import timedelta
+from typing import Optional
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from appyratus.env import Environment
 from databases import Database
 
+from controlgrid.processing.hub import StreamHub
 from controlgrid.processing.streamer import Streamer
 from controlgrid.processing.runner import Runner
+from controlgrid.processing.notifier import JobNotifier, notify_channel
+from controlgrid.processing.processes import ProcessRegistry, reap_orphans
+from controlgrid.processing.worker import OutputRelay, output_channel
 from controlgrid.log import log
-from controlgrid.db.database import DatabaseManager
+from controlgrid.db.database import DatabaseManager, resolve_url
 from controlgrid.db import tables
+from controlgrid.db.models import JobRegistry, JobStateWriter
+from controlgrid.db.output import JobOutputStore
+from controlgrid.db.retention import archive_periodically
 
 
 class LocalDaemonAPI(FastAPI):
@@ -17,6 +28,10 @@ class LocalDaemonAPI(FastAPI):
     runner = Runner()
     databases = DatabaseManager()
     streamer: Streamer
+    notifier: JobNotifier
+    relay: Optional[OutputRelay] = None
+    reaper: asyncio.Task
+    archiver: Optional[asyncio.Task] = None
     db: Database
 
 
@@ -39,15 +54,86 @@ app.add_middleware(
 async def startup():
     # etablish database connection. default to SQLite DB,
     # using a local database file in data/
-    url = app.env.get("DATABASE_URL")
-    if not url:
-        os.makedirs("./data", exist_ok=True)
-        url = "sqlite:///data/controlgrid.db"
+    url = resolve_url(app.env.get("DATABASE_URL"))
 
-    app.db = await app.databases.connect(url, "db", tables=[tables.jobs])
+    app.db = await app.databases.connect(
+        url,
+        "db",
+        tables=[
+            tables.jobs,
+            tables.jobs_archive,
+            tables.job_output,
+            tables.workers,
+        ],
+    )
     app.db.create_tables()
 
+    # move finished jobs out of the jobs table once they're old enough
+    retention_days = app.env.get("JOB_RETENTION_DAYS", dtype=float)
+    if retention_days:
+        app.archiver = asyncio.create_task(
+            archive_periodically(
+                app.db,
+                timedelta(days=retention_days),
+                app.env.get("JOB_ARCHIVE_INTERVAL", 3600.0, dtype=float),
+            )
+        )
+
+    # wake up stream workers when jobs are created. if there's a channel
+    # address, jobs created in other processes wake them up as well.
+    channel = notify_channel(app.env)
+    app.notifier = JobNotifier(channel)
+    app.notifier.start()
+
+    # jobs are cached in memory. the same channel carries invalidations of
+    # jobs changed by other API processes.
+    registry = JobRegistry.get(app.db)
+    if channel is not None:
+        registry.connect(channel)
+
+    # jobs are cancelled by the process running them, which may be another
+    # one, asked to over the same channel
+    processes = ProcessRegistry.get()
+    processes.kill_grace_period = app.env.get(
+        "JOB_KILL_GRACE_PERIOD", 5.0, dtype=float
+    )
+    if channel is not None:
+        processes.connect(channel)
+
+    # recover the jobs of processes on this host that died while running
+    # them, like a previous run of this one
+    for stream_name in await reap_orphans(app.db):
+        app.notifier.notify(stream_name)
+
+    # with a worker output address, jobs are run by `controlgrid worker`
+    # processes, and this process only relays their output to clients.
+    worker_addr = app.env.get("WORKER_OUTPUT_ADDR")
+    if worker_addr:
+        app.relay = OutputRelay(
+            output_channel(worker_addr),
+            registry=registry,
+            heartbeat_timeout=app.env.get(
+                "WORKER_HEARTBEAT_TIMEOUT", 10.0, dtype=float
+            ),
+        )
+        app.relay.start()
+        app.reaper = asyncio.create_task(
+            app.relay.reap_periodically(app.db, app.notifier)
+        )
+
 
 @app.on_event("shutdown")
 async def shutdown():
+    # stop running jobs, putting back the ones not started, before the
+    # state writer's last flush
+    for hub in StreamHub.all().values():
+        await hub.stop()
+    if app.archiver is not None:
+        app.archiver.cancel()
+    if app.relay is not None:
+        app.reaper.cancel()
+        app.relay.stop()
+    app.runner.shutdown()
+    await JobStateWriter.get(app.db).flush()
+    await JobOutputStore.get(app.db).flush()
     await app.db.disconnect()
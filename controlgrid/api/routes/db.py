@@ -0,0 +1,9 @@
+from controlgrid.api.app import app
+
+
+@app.get("/db/stats")
+async def db_stats() -> dict:
+    """
+    Get the state of the DB connection pools.
+    """
+    return app.db.pool_stats()
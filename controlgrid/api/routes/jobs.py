@@ -0,0 +1,112 @@
+import base64
+import json
+
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from fastapi import HTTPException, Query
+
+from controlgrid.api.app import app
+from controlgrid.db.models import Job, JobRegistry
+from controlgrid.db.output import JobOutputStore
+from controlgrid.processing.processes import cancel_job
+
+
+@app.get("/jobs")
+async def list_jobs(
+    status: List[str] = Query([]),
+    stream: Optional[str] = None,
+    tag: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+) -> dict:
+    """
+    List jobs, newest first, optionally filtered by status (any of several),
+    stream, tag and creation time. Pass the `next_cursor` of a response as
+    `cursor` to get the next page. It's null on the last page.
+    """
+    jobs = await Job.query(
+        app.db,
+        statuses=status,
+        stream=stream,
+        tag=tag,
+        created_after=created_after,
+        created_before=created_before,
+        after=decode_cursor(cursor) if cursor else None,
+        limit=limit,
+    )
+    next_cursor = None
+    if len(jobs) == limit:
+        next_cursor = encode_cursor(jobs[-1])
+    return {"jobs": [job.dict() for job in jobs], "next_cursor": next_cursor}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> dict:
+    """
+    Get a job. Jobs that are running, or finished recently, are served from
+    memory.
+    """
+    job = await JobRegistry.get(app.db).find(job_id)
+    if job is None:
+        raise HTTPException(404, f"job {job_id} not found")
+    return job.dict()
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def post_job_cancel(job_id: str) -> dict:
+    """
+    Cancel a job. A job that hasn't been claimed yet is cancelled right
+    away. A claimed or running one is stopped by the process that claimed
+    it, killing its process group, and its status is "cancelling" until it
+    has.
+    """
+    job = await JobRegistry.get(app.db).find(job_id)
+    if job is None:
+        raise HTTPException(404, f"job {job_id} not found")
+    status = await cancel_job(app.db, job)
+    if status is None:
+        raise HTTPException(409, f"job {job_id} can't be cancelled")
+    return {"job_id": job_id, "status": status}
+
+
+@app.get("/jobs/{job_id}/output")
+async def get_job_output(
+    job_id: str,
+    from_line: int = 0,
+    limit: int = Query(1000, ge=1, le=10000),
+) -> dict:
+    """
+    Read stored output lines of a job, starting at `from_line`.
+    """
+    job = await JobRegistry.get(app.db).find(job_id)
+    if job is None:
+        raise HTTPException(404, f"job {job_id} not found")
+
+    lines = await JobOutputStore.get(app.db).read(
+        job_id, from_line=max(0, from_line), limit=limit
+    )
+    return {
+        "job_id": job_id,
+        "status": job.status,
+        "lines": [
+            {"line_no": line_no, "timestamp": timestamp, "text": text}
+            for line_no, timestamp, text in lines
+        ],
+        "next_line": lines[-1][0] + 1 if lines else from_line,
+    }
+
+
+def encode_cursor(job: Job) -> str:
+    key = [job.created_at.isoformat(), job.job_id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        created_at, job_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(created_at), job_id
+    except (TypeError, ValueError):
+        raise HTTPException(400, f"invalid cursor: {cursor}")
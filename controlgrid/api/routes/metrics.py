@@ -0,0 +1,56 @@
+import sqlalchemy as sa
+
+from fastapi.responses import PlainTextResponse
+
+from controlgrid import metrics
+from controlgrid.api.app import app
+from controlgrid.constants import JobStatus
+from controlgrid.processing.cache import ResultCache
+from controlgrid.processing.processes import ProcessRegistry
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """
+    Get metrics of this process in the Prometheus text format. Worker
+    processes record their own metrics, which aren't included.
+    """
+    await collect_pending_jobs()
+    metrics.REGISTRY.collect()
+    return PlainTextResponse(
+        metrics.REGISTRY.expose(),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+async def collect_pending_jobs() -> None:
+    # counted with the index of pending jobs, so this only reads those
+    table = app.db.tables["jobs"]
+    query = (
+        sa.select(table.c.stream, sa.func.count())
+        .where(table.c.status == JobStatus.created)
+        .group_by(table.c.stream)
+    )
+    counts = {row[0] or "": row[1] for row in await app.db.fetch_all(query)}
+    # zero out streams whose jobs have all been claimed since
+    for (stream,) in metrics.JOBS_PENDING.label_values():
+        counts.setdefault(stream, 0)
+    for stream, count in counts.items():
+        metrics.JOBS_PENDING.labels(stream).set(count)
+
+
+def collect_app_metrics() -> None:
+    for engine, stats in app.db.pool_stats().items():
+        if not isinstance(stats, dict):
+            continue
+        for state, value in stats.items():
+            if isinstance(value, int):
+                metrics.DB_POOL_CONNECTIONS.labels(engine, state).set(value)
+
+    metrics.PROCESSES.set(len(ProcessRegistry.get()))
+    metrics.RESULT_CACHE_ENTRIES.set(len(ResultCache.get()))
+    if app.relay is not None:
+        metrics.WORKERS.set(len(app.relay.workers))
+
+
+metrics.REGISTRY.add_collector(collect_app_metrics)
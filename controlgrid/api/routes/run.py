@@ -7,6 +7,7 @@ from pydantic import BaseModel
 from controlgrid.db.models import Job, JobResult
 from controlgrid.api.app import app
 from controlgrid.constants import JobStatus
+from controlgrid.processing.cache import ResultCache, cache_key
 
 
 class Body(BaseModel):
@@ -14,13 +15,48 @@ class Body(BaseModel):
     args: List[str]
     tag: Optional[str]
     timeout: Optional[int]
+    cpu_limit: Optional[int]
+    memory_limit: Optional[int]
+    # reuse the result of an identical job run within this many seconds
+    cache_ttl: Optional[float]
+    cache_key: Optional[str]
+
+    def result_key(self) -> str:
+        return cache_key(
+            self.command,
+            self.args,
+            "run",
+            self.cache_key,
+            self.tag,
+            self.timeout,
+            self.cpu_limit,
+            self.memory_limit,
+        )
 
 
 @app.post("/run")
 async def run(body: Body) -> JobResult:
     """
     Create new job and stream back output line by line.
+
+    With a `cache_ttl`, the result of an identical job (with the same
+    command, args, tag, limits and `cache_key`) that completed within
+    `cache_ttl` seconds is returned instead, or, if one is running, its
+    result is waited for.
     """
+    if not body.cache_ttl:
+        result = await run_job(body)
+    else:
+        result = await ResultCache.get().run(
+            body.result_key(),
+            body.cache_ttl,
+            lambda: run_job(body),
+            cacheable=lambda result: result.job.status == JobStatus.completed,
+        )
+    return result.dict()
+
+
+async def run_job(body: Body) -> JobResult:
     job = await Job(
         job_id=uuid4().hex,
         command=body.command,
@@ -28,7 +64,8 @@ async def run(body: Body) -> JobResult:
         args=body.args,
         tag=body.tag,
         timeout=body.timeout,
+        cpu_limit=body.cpu_limit,
+        memory_limit=body.memory_limit,
         status=JobStatus.created,
     ).create(app.db)
-    result = await app.runner.run(app.db, job)
-    return result.dict()
+    return await app.runner.run(app.db, job)
@@ -1,12 +1,17 @@
-from typing import List, Optional
+import json
+
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 from uuid import uuid4
 
 from appyratus.utils.time_utils import TimeUtils
-from pydantic import BaseModel
+from fastapi import HTTPException, Request
+from pydantic import BaseModel, ValidationError, validator
 
-from controlgrid.db.models import Job
+from controlgrid.db.models import Job, JobRegistry, JobStateWriter
 from controlgrid.api.app import app
-from controlgrid.constants import JobStatus
+from controlgrid.constants import JobStatus, OutputFormat
+from controlgrid.processing.cache import ResultCache, cache_key
+from controlgrid.processing.pipeline import Pipeline
 
 
 class Body(BaseModel):
@@ -15,22 +20,185 @@ class Body(BaseModel):
     tag: Optional[str]
     timeout: Optional[int]
     stream: str
+    priority: int = 0
+    cpu_limit: Optional[int]
+    memory_limit: Optional[int]
+    # share an identical job created within this many seconds, if any
+    cache_ttl: Optional[float]
+    cache_key: Optional[str]
+    # output pipeline stages: see `controlgrid.processing.pipeline`
+    pipeline: Optional[List[dict]]
+    # "text" or "base64" to stream raw chunks of output instead of lines
+    output_format: Optional[str]
+
+    @validator("pipeline")
+    def validate_pipeline(cls, value):
+        if value is not None:
+            Pipeline.parse(value)
+        return value
+
+    @validator("output_format")
+    def validate_output_format(cls, value, values):
+        if value is not None:
+            if value not in OutputFormat.values():
+                raise ValueError(f"invalid output format: {value}")
+            if value != OutputFormat.lines and values.get("pipeline"):
+                raise ValueError("pipelines only apply to lines of output")
+        return value
+
+    def result_key(self) -> Optional[str]:
+        if not self.cache_ttl:
+            return None
+        return cache_key(
+            self.command,
+            self.args,
+            "stream",
+            self.stream,
+            self.cache_key,
+            self.pipeline,
+            self.output_format,
+            self.tag,
+            self.timeout,
+            self.cpu_limit,
+            self.memory_limit,
+        )
+
+    def to_job(self) -> Job:
+        return Job(
+            job_id=uuid4().hex,
+            command=self.command,
+            created_at=TimeUtils.utc_now(),
+            args=self.args,
+            tag=self.tag,
+            timeout=self.timeout,
+            stream=self.stream,
+            priority=self.priority,
+            cpu_limit=self.cpu_limit,
+            memory_limit=self.memory_limit,
+            pipeline=self.pipeline,
+            output_format=self.output_format,
+            status=JobStatus.created,
+        )
 
 
 @app.post("/stream")
 async def stream(body: Body) -> Job:
     """
     Create new job and write to DB, where it will be picked up by a named
-    stream worker at `/stream/{stream_name}`.
+    stream worker at `/stream/{stream_name}`. With a `cache_ttl`, an
+    identical job is returned instead, if there is one: see `submit_jobs`.
     """
-    job = await Job(
-        job_id=uuid4().hex,
-        command=body.command,
-        created_at=TimeUtils.utc_now(),
-        args=body.args,
-        tag=body.tag,
-        timeout=body.timeout,
-        stream=body.stream,
-        status=JobStatus.created,
-    ).create(app.db)
-    return job.dict()
+    jobs = await submit_jobs([body])
+    return jobs[0].dict()
+
+
+@app.post("/stream/batch")
+async def stream_batch(request: Request) -> dict:
+    """
+    Create many jobs at once, from a JSON array of job specs, each like the
+    body of `POST /stream`, or from NDJSON, with a job spec per line, if the
+    content type is "application/x-ndjson". Nothing is created unless every
+    spec is valid. Each stream with new jobs is woken up once.
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("application/x-ndjson"):
+        items = read_ndjson(request)
+    else:
+        items = read_json_array(request)
+
+    bodies: List[Body] = []
+    index = 0
+    try:
+        async for item in items:
+            bodies.append(Body.parse_obj(item))
+            index += 1
+    except ValidationError as exc:
+        raise HTTPException(422, f"invalid job spec at index {index}: {exc}")
+    except ValueError as exc:
+        raise HTTPException(400, f"invalid JSON at index {index}: {exc}")
+
+    jobs = await submit_jobs(bodies)
+    return {"job_ids": [job.job_id for job in jobs]}
+
+
+async def submit_jobs(bodies: List[Body]) -> List[Job]:
+    """
+    Create jobs and wake up their streams. A job with a `cache_ttl` isn't
+    created if there's an identical one (with the same command, args,
+    stream, tag, limits, output options and `cache_key`) that's pending or
+    running, or that completed within `cache_ttl` seconds of being
+    created. That job is returned in its place, so that its output is
+    shared.
+    """
+    jobs: List[Job] = []
+    new_jobs: List[Job] = []
+    # new jobs by cache key, to share them within the batch too
+    new_keys: Dict[str, Tuple[Job, float]] = {}
+    for body in bodies:
+        key = body.result_key()
+        job = None
+        if key in new_keys:
+            job = new_keys[key][0]
+            ResultCache.get().record("shared")
+        elif key is not None:
+            job = await find_cached_job(key)
+        if job is None:
+            job = body.to_job()
+            new_jobs.append(job)
+            if key is not None:
+                new_keys[key] = (job, body.cache_ttl)
+        jobs.append(job)
+
+    if len(new_jobs) == 1:
+        await new_jobs[0].create(app.db)
+    elif new_jobs:
+        await Job.create_many(app.db, new_jobs)
+
+    # only once they exist
+    cache = ResultCache.get()
+    for key, (job, ttl) in new_keys.items():
+        cache.put(key, job.job_id, ttl)
+
+    for stream_name in {job.stream for job in new_jobs}:
+        app.notifier.notify(stream_name)
+
+    return jobs
+
+
+async def find_cached_job(key: str) -> Optional[Job]:
+    cache = ResultCache.get()
+    # an expired entry still counts while its job is in flight
+    job_id = cache.lookup(key, stale=True)
+    if job_id is not None:
+        job = await JobRegistry.get(app.db).find(job_id)
+        if job is not None:
+            if job.status not in JobStateWriter.terminal_statuses:
+                cache.record("shared")
+                return job
+            if job.status == JobStatus.completed and cache.lookup(key):
+                cache.record("hit")
+                return job
+        cache.discard(key)
+    cache.record("miss")
+    return None
+
+
+async def read_json_array(request: Request) -> AsyncIterator[dict]:
+    items = json.loads(await request.body())
+    if not isinstance(items, list):
+        raise ValueError("expected an array of job specs")
+    for item in items:
+        yield item
+
+
+async def read_ndjson(request: Request) -> AsyncIterator[dict]:
+    # parse lines as they arrive, without holding the whole body
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buffer.strip():
+        yield json.loads(buffer)
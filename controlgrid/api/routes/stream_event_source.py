@@ -1,31 +1,159 @@
-import asyncio
+from typing import AsyncIterator, Dict, List, Optional
 
-from typing import AsyncIterator
-
-from fastapi import Request
+from fastapi import HTTPException, Query, Request
 from sse_starlette.sse import EventSourceResponse
+from starlette.background import BackgroundTask
 
+from controlgrid import metrics
 from controlgrid.api.app import app
+from controlgrid.constants import OverflowPolicy
+from controlgrid.processing.batching import BatchStats
+from controlgrid.processing.buffers import ClientBuffer
+from controlgrid.processing.hub import StreamHub
 from controlgrid.processing.streamer import Streamer
 
 
 @app.get("/streams/{name}")
-async def stream_event_source(request: Request) -> EventSourceResponse:
+async def stream_event_source(
+    request: Request,
+    max_concurrency: int = 4,
+    tag_limit: List[str] = Query([]),
+    batch_lines: int = 100,
+    batch_bytes: int = 1 << 18,
+    batch_latency_ms: float = 20,
+    buffer_events: int = 16,
+    buffer_bytes: int = 1 << 22,
+    overflow: str = OverflowPolicy.block,
+) -> EventSourceResponse:
     """
-    Create new job and stream back output line by line.
+    Stream back output from jobs submitted to the named stream, running up
+    to `max_concurrency` jobs at a time. Each `tag_limit` param, formatted as
+    "tag:limit", caps how many jobs with the given tag run at once.
+
+    Output is sent in batches of at most `batch_lines` lines and about
+    `batch_bytes` of text, holding lines back for no more than
+    `batch_latency_ms`.
+
+    Up to `buffer_events` batches, and about `buffer_bytes` of data, are
+    buffered for a client that reads slower than output is produced. Once
+    that's full, the `overflow` policy applies: "block" pauses the jobs
+    until the client catches up, "drop_oldest" drops buffered batches and
+    sends a "gap" event in their place, and "disconnect" ends the stream.
+
+    All clients of a stream share the jobs and output of one streamer,
+    configured by the params of the client that started it. Clients joining
+    a running stream first get its last few batches. If jobs are run by
+    worker processes, the params of the streamer are those of the workers.
+
+    Each event's ID records how far the output of its jobs has been sent, so
+    that a client reconnecting with a `Last-Event-ID` header gets the output
+    it missed.
     """
     stream_name = request.path_params["name"]
 
+    if overflow not in OverflowPolicy.values():
+        raise HTTPException(400, f"invalid overflow policy: {overflow}")
+
     app.log.info(f"starting '{stream_name}' stream")
 
-    streamer = Streamer(app.db, stream_name)
-    max_concurrency = 4
+    streamer = Streamer(
+        app.db,
+        stream_name,
+        batch_size=batch_lines,
+        batch_bytes=batch_bytes,
+        batch_latency=batch_latency_ms / 1000,
+        max_concurrency=max_concurrency,
+        tag_limits=parse_tag_limits(tag_limit),
+        notifier=app.notifier,
+    )
+    buffer = ClientBuffer(
+        overflow, max_events=buffer_events, max_bytes=buffer_bytes
+    )
+    poll_interval = app.env.get("STREAM_POLL_INTERVAL", dtype=float)
+    history = app.env.get("STREAM_HUB_HISTORY", 16, dtype=int)
+
+    last_event_id = request.headers.get("last-event-id")
+
+    def create_hub() -> StreamHub:
+        return StreamHub(
+            stream_name,
+            streamer,
+            app.notifier,
+            poll_interval=poll_interval,
+            history=history,
+            relay=app.relay,
+        )
+
+    clients = metrics.SSE_CLIENTS.labels(stream_name)
+    hub: Optional[StreamHub] = None
+    connected = False
 
-    async def stream(request: Request) -> AsyncIterator[str]:
-        while not await request.is_disconnected():
-            await asyncio.sleep(0.05)
-            async for batch in streamer.generate():
-                yield batch
+    async def stream() -> AsyncIterator[dict]:
+        nonlocal hub, connected
+        clients.inc()
+        connected = True
+        try:
+            # a reconnecting client first gets the output it missed
+            if last_event_id:
+                async for batch in streamer.replay(last_event_id):
+                    yield {"data": batch}
 
-    source = EventSourceResponse(stream(request))
+            # clients of the same stream share one hub, running the streamer
+            # of whichever client came first.
+            hub = StreamHub.get(stream_name, create_hub)
+            hub.subscribe(buffer, history=not last_event_id)
+            while True:
+                event = await buffer.get()
+                if event is None:
+                    break
+                yield event
+            if buffer.close_reason != "closed":
+                app.log.warning(
+                    f"'{stream_name}' stream closed: {buffer.close_reason}"
+                )
+        finally:
+            await disconnect()
+
+    async def disconnect() -> None:
+        # also run once the response is done: a client disconnecting during
+        # heavy output cancels the response while it's sending, which leaves
+        # the stream suspended rather than closed.
+        nonlocal connected
+        if not connected:
+            return
+        connected = False
+        clients.dec()
+        if hub is not None:
+            hub.unsubscribe(buffer)
+
+    source = EventSourceResponse(
+        stream(), background=BackgroundTask(disconnect)
+    )
     return source
+
+
+@app.get("/streams/{name}/stats")
+async def stream_stats(name: str) -> dict:
+    """
+    Get counts of output batches sent for the named stream, by the limit
+    that triggered them, and its number of connected clients.
+    """
+    hub = StreamHub.find(name)
+    stats = BatchStats.find(name) or BatchStats(name)
+    return dict(
+        stats.dict(),
+        subscribers=hub.subscriber_count if hub is not None else 0,
+    )
+
+
+def parse_tag_limits(values: List[str]) -> Dict[str, int]:
+    tag_limits = {}
+    for value in values:
+        tag, _, limit = value.rpartition(":")
+        if not (tag and limit.isdigit()):
+            raise HTTPException(400, f"invalid tag_limit: {value}")
+        # jobs with a limit of 0 could never run
+        if int(limit) < 1:
+            raise HTTPException(422, f"tag_limit must be at least 1: {value}")
+        tag_limits[tag] = int(limit)
+    return tag_limits
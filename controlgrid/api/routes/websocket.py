@@ -1,20 +1,422 @@
+"""
+Multiplexed job control and streaming over one websocket per client.
+
+Frames are JSON text frames, or msgpack binary frames if the socket is
+opened with `?encoding=msgpack`. Clients may send either kind. Each frame
+is an object with an "op". Requests may carry an "id", which is echoed back
+in the reply, or in an "error" frame if the request failed.
+
+Client to server:
+
+- submit: `{"op": "submit", "id": 1, "jobs": [spec, ...]}`, where each spec
+  is like the body of `POST /stream`. Replies with `{"op": "submitted",
+  "id": 1, "job_ids": [...]}`.
+- subscribe to a stream: `{"op": "subscribe", "id": 2, "stream": "name",
+  "credits": 16, "params": {...}, "last_event_id": "..."}`. The params are
+  the query params of `GET /streams/{name}`, and `last_event_id` is
+  optional. Replies with `{"op": "subscribed", "id": 2, "sub": 1}`.
+- subscribe to a job: `{"op": "subscribe", "id": 3, "job": "job ID",
+  "credits": 16, "from_line": 0}`. Sends the job's output from the given
+  line, as lines, or as blocks for jobs with raw output, then its result,
+  then ends. This only follows the job: it's run by
+  whoever is subscribed to its stream, or by a worker.
+- unsubscribe: `{"op": "unsubscribe", "id": 4, "sub": 1}`.
+- credit: `{"op": "credit", "sub": 1, "credits": 8}`. Lets the server send
+  that many more frames for the subscription.
+- cancel: `{"op": "cancel", "id": 5, "job_ids": [...]}`. Replies with
+  `{"op": "cancelled", "id": 5, "jobs": {job ID: status}}`, where the
+  status is as returned by `POST /jobs/{id}/cancel`, or null for jobs
+  that couldn't be cancelled.
+
+Server to client:
+
+- output: `{"op": "output", "sub": 1, "event_id": "...", "data": batch}`,
+  where the batch is the same as the data of an SSE event. With msgpack,
+  the batch is sent as JSON text, as it's encoded once for all clients.
+- gap: `{"op": "gap", "sub": 1, "events": n, "bytes": n}`, for output
+  dropped by the "drop_oldest" overflow policy.
+- end: `{"op": "end", "sub": 1, "reason": "..."}`, once a subscription
+  ends on its own.
+
+Every output and gap frame spends one of its subscription's credits.
+Once they're spent, the server sends nothing more for the subscription,
+and its buffer fills up, until the client grants more. When the buffer is
+full, the subscription's overflow policy applies, as with SSE.
+"""
+
 import asyncio
 
-from fastapi import WebSocket, WebSocketDisconnect
+from itertools import count
+from typing import Dict, Optional
+
+import msgpack
+import rapidjson
+
+from fastapi import HTTPException, WebSocket
+from pydantic import ValidationError
+from starlette.websockets import WebSocketState
 
+from controlgrid import metrics
 from controlgrid.api.app import app
+from controlgrid.api.routes.stream import Body, submit_jobs
+from controlgrid.api.routes.stream_event_source import parse_tag_limits
+from controlgrid.constants import OverflowPolicy
+from controlgrid.db.models import (
+    Job,
+    JobRegistry,
+    JobResult,
+    JobStateWriter,
+    JobStreamEvent,
+)
+from controlgrid.db.output import JobOutputStore
 from controlgrid.log import log
+from controlgrid.processing.buffers import ClientBuffer
+from controlgrid.processing.encoding import BatchEncoder
+from controlgrid.processing.hub import StreamHub
+from controlgrid.processing.pipeline import get_pipeline, load_tag_pipelines
+from controlgrid.processing.processes import cancel_job
+from controlgrid.processing.streamer import Streamer, read_stored_events
+
+
+class ProtocolError(Exception):
+    """
+    Raised for a bad request frame. The message is sent back to the client.
+    """
+
+
+class Credits:
+    """
+    Flow-control credits of a subscription: the number of frames the client
+    is ready to receive.
+    """
+
+    def __init__(self, credits: int) -> None:
+        self._credits = credits
+        self._granted = asyncio.Event()
+        if credits > 0:
+            self._granted.set()
+
+    def grant(self, credits: int) -> None:
+        self._credits += credits
+        if self._credits > 0:
+            self._granted.set()
+
+    async def spend(self) -> None:
+        while self._credits <= 0:
+            self._granted.clear()
+            await self._granted.wait()
+        self._credits -= 1
+
+
+class Session:
+    """
+    One client's websocket, with its subscriptions, each fed by a task.
+    """
+
+    def __init__(self, socket: WebSocket, binary: bool) -> None:
+        self._socket = socket
+        self._binary = binary
+        self._send_lock = asyncio.Lock()
+        self._sub_ids = count(1)
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._credits: Dict[int, Credits] = {}
+        self._registry = JobRegistry.get(app.db)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                message = await self._socket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                await self._handle(message)
+        finally:
+            tasks = list(self._tasks.values())
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle(self, message: dict) -> None:
+        request_id = None
+        try:
+            if message.get("bytes") is not None:
+                frame = msgpack.unpackb(message["bytes"], raw=False)
+            else:
+                frame = rapidjson.loads(message["text"])
+            if not isinstance(frame, dict):
+                raise ProtocolError("expected an object")
+            request_id = frame.get("id")
+            handler = self._handlers.get(frame.get("op"))
+            if handler is None:
+                raise ProtocolError(f"unrecognized op: {frame.get('op')}")
+            await handler(self, frame)
+        except (ProtocolError, TypeError, ValueError) as exc:
+            await self.send(
+                {"op": "error", "id": request_id, "error": str(exc)}
+            )
+        except HTTPException as exc:
+            await self.send(
+                {"op": "error", "id": request_id, "error": exc.detail}
+            )
+
+    async def send(self, frame: dict) -> None:
+        if self._binary:
+            await self._send_bytes(msgpack.packb(frame, use_bin_type=True))
+        else:
+            await self._send_text(rapidjson.dumps(frame))
+
+    async def send_output(self, sub: int, event_id: str, batch: str) -> None:
+        # the batch is already JSON, so it goes into the frame as it is
+        if self._binary:
+            frame = {"op": "output", "sub": sub, "event_id": event_id}
+            await self.send(dict(frame, data=batch))
+        else:
+            await self._send_text(
+                f'{{"op":"output","sub":{sub},'
+                f'"event_id":{rapidjson.dumps(event_id)},"data":{batch}}}'
+            )
+
+    async def _send_text(self, text: str) -> None:
+        async with self._send_lock:
+            await self._socket.send_text(text)
+
+    async def _send_bytes(self, data: bytes) -> None:
+        async with self._send_lock:
+            await self._socket.send_bytes(data)
+
+    async def _submit(self, frame: dict) -> None:
+        try:
+            bodies = [Body.parse_obj(spec) for spec in frame["jobs"]]
+        except (KeyError, TypeError) as exc:
+            raise ProtocolError(f"expected a list of jobs: {exc}")
+        except ValidationError as exc:
+            raise ProtocolError(f"invalid job spec: {exc}")
+
+        jobs = await submit_jobs(bodies)
+
+        await self.send(
+            {
+                "op": "submitted",
+                "id": frame.get("id"),
+                "job_ids": [job.job_id for job in jobs],
+            }
+        )
+
+    async def _subscribe(self, frame: dict) -> None:
+        credits = Credits(int(frame.get("credits", 16)))
+        if frame.get("stream") is not None:
+            stream_name = str(frame["stream"])
+            params = frame.get("params") or {}
+            buffer = ClientBuffer(
+                params.get("overflow", OverflowPolicy.block),
+                max_events=int(params.get("buffer_events", 16)),
+                max_bytes=int(params.get("buffer_bytes", 1 << 22)),
+            )
+            feed = self._feed_stream(
+                stream_name,
+                create_streamer(stream_name, params),
+                buffer,
+                frame.get("last_event_id"),
+            )
+        elif frame.get("job") is not None:
+            job = await self._registry.find(str(frame["job"]))
+            if job is None:
+                raise ProtocolError(f"job {frame['job']} not found")
+            feed = self._feed_job(job, int(frame.get("from_line", 0)))
+        else:
+            raise ProtocolError("expected a stream or job to subscribe to")
+
+        sub = next(self._sub_ids)
+        self._credits[sub] = credits
+        self._tasks[sub] = asyncio.create_task(self._run_feed(sub, feed))
+        await self.send(
+            {"op": "subscribed", "id": frame.get("id"), "sub": sub}
+        )
+
+    async def _unsubscribe(self, frame: dict) -> None:
+        sub = frame.get("sub")
+        task = self._tasks.get(sub)
+        if task is None:
+            raise ProtocolError(f"no such subscription: {sub}")
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await self.send(
+            {"op": "unsubscribed", "id": frame.get("id"), "sub": sub}
+        )
+
+    async def _credit(self, frame: dict) -> None:
+        credits = self._credits.get(frame.get("sub"))
+        if credits is None:
+            raise ProtocolError(f"no such subscription: {frame.get('sub')}")
+        credits.grant(int(frame.get("credits", 0)))
+
+    async def _cancel(self, frame: dict) -> None:
+        statuses = {}
+        for job_id in frame.get("job_ids") or []:
+            job = await self._registry.find(str(job_id))
+            if job is not None:
+                statuses[job.job_id] = await cancel_job(app.db, job)
+            else:
+                statuses[str(job_id)] = None
+        await self.send(
+            {"op": "cancelled", "id": frame.get("id"), "jobs": statuses}
+        )
+
+    _handlers = {
+        "submit": _submit,
+        "subscribe": _subscribe,
+        "unsubscribe": _unsubscribe,
+        "credit": _credit,
+        "cancel": _cancel,
+    }
+
+    async def _run_feed(self, sub: int, feed) -> None:
+        # feeds yield (event ID, batch) pairs, or gap events, until they end,
+        # returning the reason they ended
+        credits = self._credits[sub]
+        reason = "closed"
+        try:
+            async for item in feed:
+                if isinstance(item, str):
+                    reason = item
+                    break
+                await credits.spend()
+                if isinstance(item, dict):
+                    await self.send(dict(item, op="gap", sub=sub))
+                else:
+                    await self.send_output(sub, *item)
+            await self.send({"op": "end", "sub": sub, "reason": reason})
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception(f"error feeding websocket subscription {sub}")
+        finally:
+            await feed.aclose()
+            self._tasks.pop(sub, None)
+            self._credits.pop(sub, None)
+
+    async def _feed_stream(
+        self,
+        stream_name: str,
+        streamer: Streamer,
+        buffer: ClientBuffer,
+        last_event_id: Optional[str],
+    ):
+        if last_event_id:
+            async for batch in streamer.replay(last_event_id):
+                yield (last_event_id, batch)
+
+        hub = StreamHub.get(
+            stream_name, lambda: create_hub(stream_name, streamer)
+        )
+        hub.subscribe(buffer, history=not last_event_id)
+        try:
+            while True:
+                event = await buffer.get()
+                if event is None:
+                    break
+                if event.get("event") == "gap":
+                    yield rapidjson.loads(event["data"])
+                else:
+                    yield (event.get("id", ""), event["data"])
+            yield buffer.close_reason
+        finally:
+            hub.unsubscribe(buffer)
+
+    async def _feed_job(self, job: Job, from_line: int):
+        # output is read back from the output store, which has every line
+        # streamed so far. the job's stream hub, if it's running, is only
+        # watched to wake up when there's more. a job subscription never
+        # starts one, and jobs without a stream, like those run by POST
+        # /run, are just polled.
+        output = JobOutputStore.get(app.db)
+        encoder = BatchEncoder()
+        batch_lines = app.env.get("WEBSOCKET_BATCH_LINES", 100, dtype=int)
+        poll_interval = app.env.get(
+            "WEBSOCKET_POLL_INTERVAL", 1.0, dtype=float
+        )
+        pipeline = get_pipeline(job, load_tag_pipelines(app.env))
+        wakeup = asyncio.Event()
+        hub: Optional[StreamHub] = None
+        try:
+            while True:
+                found = None
+                if job.stream is not None:
+                    found = StreamHub.find(job.stream)
+                if found is not hub:
+                    if hub is not None:
+                        hub.unwatch(wakeup)
+                    hub = found
+                    if hub is not None:
+                        hub.watch(wakeup)
+                # cleared before reading, so that output written meanwhile
+                # isn't missed
+                wakeup.clear()
+
+                job = await self._registry.find(job.job_id) or job
+                finished = job.status in JobStateWriter.terminal_statuses
+                batch, next_line = await read_stored_events(
+                    output, job, from_line, batch_lines, pipeline
+                )
+                if next_line != from_line:
+                    from_line = next_line
+                    if batch:
+                        event_id = f"{job.job_id}:{from_line}"
+                        yield (event_id, encoder.encode(batch))
+                elif finished:
+                    result = JobResult.create(job, [])
+                    event = JobStreamEvent(result=result, line=None)
+                    event_id = f"{job.job_id}:{from_line}"
+                    yield (event_id, encoder.encode([event]))
+                    yield "finished"
+                    return
+                else:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if hub is not None:
+                hub.unwatch(wakeup)
+
+
+def create_streamer(stream_name: str, params: dict) -> Streamer:
+    return Streamer(
+        app.db,
+        stream_name,
+        batch_size=int(params.get("batch_lines", 100)),
+        batch_bytes=int(params.get("batch_bytes", 1 << 18)),
+        batch_latency=float(params.get("batch_latency_ms", 20)) / 1000,
+        max_concurrency=int(params.get("max_concurrency", 4)),
+        tag_limits=parse_tag_limits(params.get("tag_limit") or []),
+        notifier=app.notifier,
+    )
+
+
+def create_hub(stream_name: str, streamer: Streamer) -> StreamHub:
+    return StreamHub(
+        stream_name,
+        streamer,
+        app.notifier,
+        poll_interval=app.env.get("STREAM_POLL_INTERVAL", dtype=float),
+        history=app.env.get("STREAM_HUB_HISTORY", 16, dtype=int),
+        relay=app.relay,
+    )
 
 
 @app.websocket("/websocket")
-async def websocket(socket: WebSocket) -> None:
+async def websocket(socket: WebSocket, encoding: str = "json") -> None:
+    """
+    Submit, follow and cancel jobs over one socket. See the module docstring
+    for the protocol.
+    """
     await socket.accept()
-
+    clients = metrics.WEBSOCKET_CLIENTS
+    clients.inc()
     try:
-        while True:
-            await asyncio.sleep(0.1)
-            # TODO: do something here
-    except WebSocketDisconnect:
-        await websocket.close()
+        await Session(socket, binary=encoding == "msgpack").run()
     except Exception:
         log.exception("websocket error")
+        if socket.application_state != WebSocketState.DISCONNECTED:
+            await socket.close()
+    finally:
+        clients.dec()
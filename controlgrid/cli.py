@@ -0,0 +1,60 @@
+import argparse
+import os
+
+from typing import List, Optional
+
+from controlgrid.processing.ipc import Forwarder
+from controlgrid.processing.worker import run_workers
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="controlgrid")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    worker = commands.add_parser(
+        "worker",
+        help=(
+            "run jobs in worker processes, publishing their output to the "
+            "API at WORKER_OUTPUT_ADDR"
+        ),
+    )
+    worker.add_argument(
+        "-p",
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of worker processes (default: number of CPUs)",
+    )
+    worker.add_argument(
+        "-c",
+        "--max-concurrency",
+        type=int,
+        default=4,
+        help="max jobs each process runs at once per stream (default: 4)",
+    )
+
+    commands.add_parser(
+        "forwarder",
+        help=(
+            "forward messages published to NOTIFY_PUBLISH_ADDR to the "
+            "processes subscribed at NOTIFY_CHANNEL_ADDR"
+        ),
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "worker":
+        if not os.environ.get("WORKER_OUTPUT_ADDR"):
+            parser.error("WORKER_OUTPUT_ADDR must be set")
+        run_workers(args.processes, args.max_concurrency)
+    elif args.command == "forwarder":
+        addr = os.environ.get("NOTIFY_CHANNEL_ADDR")
+        publish_addr = os.environ.get("NOTIFY_PUBLISH_ADDR")
+        if not (addr and publish_addr):
+            parser.error(
+                "NOTIFY_CHANNEL_ADDR and NOTIFY_PUBLISH_ADDR must be set"
+            )
+        Forwarder(addr, publish_addr).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,4 +13,35 @@ class JobStatus(EnumValueStr):
             "error",
             "failed",
             "completed",
+            "cancelled",
+        }
+
+
+class OverflowPolicy(EnumValueStr):
+    @staticmethod
+    def values() -> Set[str]:
+        return {
+            "block",
+            "drop_oldest",
+            "disconnect",
+        }
+
+
+class DropPolicy(EnumValueStr):
+    @staticmethod
+    def values() -> Set[str]:
+        return {
+            "drop_oldest",
+            "drop_newest",
+            "block",
+        }
+
+
+class OutputFormat(EnumValueStr):
+    @staticmethod
+    def values() -> Set[str]:
+        return {
+            "lines",
+            "text",
+            "base64",
         }
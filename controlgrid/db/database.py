@@ -1,20 +1,216 @@
+import os
+import sqlite3
+
 import sqlalchemy as sa
 
-from typing import Callable, Dict, List, Optional
+from typing import Callable, Dict, List, Optional, Type
 
+from appyratus.env import Environment
 from sqlalchemy import Table, MetaData
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool, StaticPool
 from databases import Database as BaseDatabase
 
 from controlgrid.log import log
 
 TableFactory = Callable[[MetaData], Table]
 
+DEFAULT_URL = "sqlite:///data/controlgrid.db"
+
+
+def resolve_url(url: Optional[str]) -> str:
+    # default to SQLite DB, using a local database file in data/
+    if not url:
+        os.makedirs("./data", exist_ok=True)
+        url = DEFAULT_URL
+    return url
+
+
+class EngineProfile:
+    """
+    Backend-specific configuration of the two ways we talk to a DB: the
+    sync SQLAlchemy engine, used for bulk writes in worker threads, and the
+    async `databases` connection, used for everything else. Settings are
+    read from env.
+    """
+
+    backend: str = ""
+
+    def __init__(self, url: str, env: Environment) -> None:
+        self.url = url
+        self.env = env
+
+    def engine_kwargs(self) -> dict:
+        return {}
+
+    def database_kwargs(self) -> dict:
+        return {}
+
+    def pool_stats(self, db: "Database") -> dict:
+        pool = db.engine.pool
+        if not isinstance(pool, QueuePool):
+            return {"engine": {"pool": type(pool).__name__}}
+        return {
+            "engine": {
+                "pool": type(pool).__name__,
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            }
+        }
+
+
+class SQLiteProfile(EngineProfile):
+    """
+    SQLite in WAL mode, so that readers don't block the writer, with a busy
+    timeout, so that concurrent writers wait for the lock instead of failing
+    with "database is locked". The same pragmas are set on every connection,
+    sync or async.
+
+    - SQLITE_JOURNAL_MODE (default: WAL)
+    - SQLITE_SYNCHRONOUS (default: NORMAL, which is safe in WAL mode)
+    - SQLITE_BUSY_TIMEOUT_MS (default: 5000)
+    - SQLITE_MMAP_SIZE (default: 256MB)
+    - DB_POOL_MAX_SIZE: sync engine connections kept open (default: 4)
+    """
+
+    backend = "sqlite"
+
+    def __init__(self, url: str, env: Environment) -> None:
+        super().__init__(url, env)
+        self.in_memory = sa.engine.make_url(url).database in (None, "")
+        self.in_memory |= ":memory:" in url or "mode=memory" in url
+        self.busy_timeout = env.get("SQLITE_BUSY_TIMEOUT_MS", 5000, dtype=int)
+        self.pragmas = {
+            "busy_timeout": self.busy_timeout,
+            "synchronous": env.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+            "mmap_size": env.get("SQLITE_MMAP_SIZE", 1 << 28, dtype=int),
+        }
+        if not self.in_memory:
+            self.pragmas["journal_mode"] = env.get(
+                "SQLITE_JOURNAL_MODE", "WAL"
+            )
+        self.factory = sqlite_connection_factory(self.pragmas)
+
+    def engine_kwargs(self) -> dict:
+        connect_args = {
+            "check_same_thread": False,
+            "timeout": self.busy_timeout / 1000,
+            "factory": self.factory,
+        }
+        if self.in_memory:
+            return {"connect_args": connect_args, "poolclass": StaticPool}
+        # keep connections open, rather than reopening the file and
+        # setting pragmas on every flush
+        return {
+            "connect_args": connect_args,
+            "poolclass": QueuePool,
+            "pool_size": self.env.get("DB_POOL_MAX_SIZE", 4, dtype=int),
+            "max_overflow": 0,
+        }
+
+    def database_kwargs(self) -> dict:
+        # passed through aiosqlite to `sqlite3.connect`
+        return {"timeout": self.busy_timeout / 1000, "factory": self.factory}
+
+
+class PostgresProfile(EngineProfile):
+    """
+    Postgres with bounded connection pools and cached prepared statements.
+
+    - DB_POOL_MIN_SIZE (default: 2)
+    - DB_POOL_MAX_SIZE (default: 10)
+    - DB_POOL_TIMEOUT: seconds to wait for a sync connection (default: 30)
+    - DB_POOL_RECYCLE: max age of sync connections in seconds (default: 1800)
+    - DB_STATEMENT_CACHE_SIZE: prepared statements cached per connection,
+      and SQL compilations cached by the sync engine. Set to 0 behind a
+      transaction-pooling pgbouncer (default: 1024)
+    """
+
+    backend = "postgresql"
+
+    def __init__(self, url: str, env: Environment) -> None:
+        super().__init__(url, env)
+        self.min_size = env.get("DB_POOL_MIN_SIZE", 2, dtype=int)
+        self.max_size = max(
+            self.min_size, env.get("DB_POOL_MAX_SIZE", 10, dtype=int)
+        )
+        self.statement_cache_size = env.get(
+            "DB_STATEMENT_CACHE_SIZE", 1024, dtype=int
+        )
+
+    def engine_kwargs(self) -> dict:
+        return {
+            "pool_size": self.min_size,
+            "max_overflow": self.max_size - self.min_size,
+            "pool_timeout": self.env.get("DB_POOL_TIMEOUT", 30.0, dtype=float),
+            "pool_recycle": self.env.get("DB_POOL_RECYCLE", 1800, dtype=int),
+            "pool_pre_ping": True,
+            "query_cache_size": self.statement_cache_size,
+        }
+
+    def database_kwargs(self) -> dict:
+        # passed to `asyncpg.create_pool`
+        return {
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "statement_cache_size": self.statement_cache_size,
+        }
+
+    def pool_stats(self, db: "Database") -> dict:
+        stats = super().pool_stats(db)
+        pool = getattr(db._backend, "_pool", None)
+        if pool is not None:
+            stats["async"] = {
+                "size": pool.get_size(),
+                "idle": pool.get_idle_size(),
+                "min_size": pool.get_min_size(),
+                "max_size": pool.get_max_size(),
+            }
+        return stats
+
+
+PROFILES: Dict[str, Type[EngineProfile]] = {
+    profile_type.backend: profile_type
+    for profile_type in (SQLiteProfile, PostgresProfile)
+}
+
+
+def get_profile(url: str, env: Optional[Environment] = None) -> EngineProfile:
+    backend = sa.engine.make_url(url).get_backend_name()
+    profile_type = PROFILES.get(backend, EngineProfile)
+    return profile_type(url, env or Environment())
+
+
+def sqlite_connection_factory(
+    pragmas: Dict[str, object]
+) -> Type[sqlite3.Connection]:
+    """
+    Make a `sqlite3.Connection` class that sets the given pragmas when it
+    connects.
+    """
+    statements = [f"PRAGMA {name}={value}" for name, value in pragmas.items()]
+
+    class Connection(sqlite3.Connection):
+        def __init__(self, *args, **kwargs) -> None:
+            super().__init__(*args, **kwargs)
+            for statement in statements:
+                self.execute(statement).close()
+
+    return Connection
+
 
 class Database(BaseDatabase):
     def __init__(
-        self, url: str, metadata: MetaData, engine: Engine, *args, **kwargs
+        self,
+        url: str,
+        metadata: MetaData,
+        engine: Engine,
+        *args,
+        profile: Optional[EngineProfile] = None,
+        **kwargs,
     ):
         super().__init__(url, *args, **kwargs)
         self.tables: Dict[str, Table] = {}
@@ -22,6 +218,12 @@ class Database(BaseDatabase):
         self.metadata = metadata
         self.engine = engine
         self.inspector = Inspector.from_engine(engine)
+        self.profile = profile or EngineProfile(url, Environment())
+
+    def pool_stats(self) -> dict:
+        return dict(
+            self.profile.pool_stats(self), backend=self.profile.backend
+        )
 
     def add_table(self, factory: TableFactory) -> Table:
         table = factory(self.metadata)
@@ -31,10 +233,66 @@ class Database(BaseDatabase):
     def create_tables(self) -> None:
         log.info(f"creating database tables at {self.engine.url}")
         self.metadata.create_all(self.engine, checkfirst=True)
+        # create_all skips tables that exist, along with their indexes, so
+        # add any columns, and then indexes on them, that were defined after
+        # the tables were created, and drop indexes that no longer are
+        for table in self.metadata.tables.values():
+            self.add_missing_columns(table)
+        for table in self.metadata.tables.values():
+            self.drop_stale_indexes(table)
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+
+    def add_missing_columns(self, table: Table) -> List[str]:
+        """
+        Add columns of the table that are missing from its existing table in
+        the DB, returning their names. New columns must be nullable, or have
+        a server default, to be added to a table with rows in it.
+        """
+        existing = {
+            column["name"]
+            for column in sa.inspect(self.engine).get_columns(table.name)
+        }
+        dialect = self.engine.dialect
+        table_name = dialect.identifier_preparer.format_table(table)
+        added = []
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            log.info(f"adding column {column.name} to {table.name} table")
+            ddl = sa.schema.CreateColumn(column).compile(dialect=dialect)
+            with self.engine.begin() as conn:
+                conn.execute(
+                    sa.text(f"ALTER TABLE {table_name} ADD COLUMN {ddl}")
+                )
+            added.append(column.name)
+        return added
+
+
+    def drop_stale_indexes(self, table: Table) -> List[str]:
+        """
+        Drop indexes of the table's existing table in the DB that the table
+        no longer defines, returning their names. Only indexes named like
+        ours, "ix_<table>_...", are dropped, leaving any created by hand.
+        """
+        defined = {index.name for index in table.indexes}
+        prefix = f"ix_{table.name}_"
+        preparer = self.engine.dialect.identifier_preparer
+        dropped = []
+        for index in sa.inspect(self.engine).get_indexes(table.name):
+            name = index["name"]
+            if not name or not name.startswith(prefix) or name in defined:
+                continue
+            log.info(f"dropping index {name} of {table.name} table")
+            with self.engine.begin() as conn:
+                conn.execute(sa.text(f"DROP INDEX {preparer.quote(name)}"))
+            dropped.append(name)
+        return dropped
 
 
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, env: Optional[Environment] = None):
+        self._env = env
         self._url2db: Dict[str, Database] = {}
         self._name2db: Dict[str, Database] = {}
         self._db2info: Dict[Database, Database] = {}
@@ -45,9 +303,15 @@ class DatabaseManager:
         # memoize database
         if url not in self._url2db:
             log.debug(f"connecting to database at {url}")
-            connect_args = {"check_same_thread": False}
-            engine = sa.create_engine(url, connect_args=connect_args)
-            database = Database(url, MetaData(), engine)
+            profile = get_profile(url, self._env)
+            engine = sa.create_engine(url, **profile.engine_kwargs())
+            database = Database(
+                url,
+                MetaData(),
+                engine,
+                profile=profile,
+                **profile.database_kwargs(),
+            )
             self._url2db[url] = database
         else:
             database = self._url2db[url]
@@ -1,10 +1,42 @@
-from typing import Iterable, Optional, List, Union
-from datetime import datetime
+import asyncio
+import time
+import weakref
 
+from collections import OrderedDict, defaultdict
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterable,
+    Optional,
+    List,
+    Set,
+    Tuple,
+    Union,
+)
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+import sqlalchemy as sa
+
+from appyratus.utils.time_utils import TimeUtils
 from pydantic import BaseModel
 
+from controlgrid import metrics
 from controlgrid.constants import JobStatus
 from controlgrid.db.database import Database
+from controlgrid.log import log
+from controlgrid.processing.ipc import Channel
+
+_query_seconds = {
+    name: metrics.DB_QUERY_SECONDS.labels(name)
+    for name in (
+        "job_save",
+        "job_get_pending",
+        "job_claim_pending",
+        "job_state_flush",
+    )
+}
 
 
 class Job(BaseModel):
@@ -19,6 +51,16 @@ class Job(BaseModel):
     pid: Optional[int]
     error: Optional[str]
     stream: Optional[str]
+    priority: int = 0
+    worker_id: Optional[str]
+    # rlimits of the job's subprocess: CPU seconds and bytes of memory
+    cpu_limit: Optional[int]
+    memory_limit: Optional[int]
+    # stages that process the job's output before it's streamed
+    pipeline: Optional[List[dict]]
+    # "lines" (the default), or "text" or "base64" to stream raw chunks of
+    # output: see `OutputFormat`
+    output_format: Optional[str]
 
     def __hash__(self) -> int:
         return int(self.job_id, base=16)
@@ -27,8 +69,37 @@ class Job(BaseModel):
         table = db.tables["jobs"]
         query = table.insert().values(**self.dict())
         await db.execute(query)
+        JobRegistry.get(db).put(self)
         return self
 
+    @classmethod
+    async def create_many(
+        cls, db: Database, jobs: List["Job"], chunk_size: int = 1000
+    ) -> List["Job"]:
+        """
+        Insert jobs with one `executemany` per chunk of `chunk_size` jobs,
+        each chunk in its own transaction.
+        """
+        table = db.tables["jobs"]
+        rows = [job.dict() for job in jobs]
+        chunks = [
+            rows[i : i + chunk_size] for i in range(0, len(rows), chunk_size)
+        ]
+
+        def insert() -> None:
+            for chunk in chunks:
+                with db.engine.begin() as conn:
+                    conn.execute(table.insert(), chunk)
+
+        # the async driver runs executemany as one execute per row, so go
+        # through the sync engine in a thread instead.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, insert)
+        registry = JobRegistry.get(db)
+        for job in jobs:
+            registry.put(job)
+        return jobs
+
     async def save(
         self, db: Database, fields: Union[str, Iterable[str]] = None, **values
     ) -> "Job":
@@ -55,16 +126,107 @@ class Job(BaseModel):
                 .where(table.c.job_id == self.job_id)
                 .values(**values)
             )
-            await db.execute(query)
+            with _query_seconds["job_save"].time():
+                await db.execute(query)
 
         return self
 
     @classmethod
     async def get(cls, db: Database, id: str) -> Optional["Job"]:
+        # look in the archive too, for finished jobs moved out by retention
+        for name in ("jobs", "jobs_archive"):
+            table = db.tables.get(name)
+            if table is None:
+                continue
+            query = table.select().where(table.c.job_id == id).limit(1)
+            data = await db.fetch_one(query)
+            if data:
+                return cls(**data)
+        return None
+
+    @classmethod
+    async def query(
+        cls,
+        db: Database,
+        statuses: Optional[Iterable[str]] = None,
+        stream: Optional[str] = None,
+        tag: Optional[str] = None,
+        created_after: Optional[datetime] = None,
+        created_before: Optional[datetime] = None,
+        after: Optional[Tuple[datetime, str]] = None,
+        limit: int = 100,
+    ) -> List["Job"]:
+        """
+        List jobs matching the given filters, newest first. Pages are read
+        with keyset pagination: pass the (created_at, job_id) of the last
+        job of a page as `after` to get the next one, which costs the same
+        however deep the page is.
+        """
         table = db.tables["jobs"]
-        query = table.select().where(table.c.job_id == id).limit(1)
-        data = await db.fetch_one(query)
-        return cls(**data) if data else None
+        c = table.c
+        query = table.select()
+        if statuses:
+            query = query.where(c.status.in_(list(statuses)))
+        if stream is not None:
+            query = query.where(c.stream == stream)
+        if tag is not None:
+            query = query.where(c.tag == tag)
+        if created_after is not None:
+            query = query.where(c.created_at >= created_after)
+        if created_before is not None:
+            query = query.where(c.created_at < created_before)
+        if after is not None:
+            created_at, job_id = after
+            query = query.where(
+                sa.or_(
+                    c.created_at < created_at,
+                    sa.and_(c.created_at == created_at, c.job_id < job_id),
+                )
+            )
+        query = query.order_by(c.created_at.desc(), c.job_id.desc())
+        rows = await db.fetch_all(query.limit(limit))
+        return [cls(**data) for data in rows]
+
+    @classmethod
+    async def archive(
+        cls, db: Database, created_before: datetime, batch_size: int = 1000
+    ) -> int:
+        """
+        Move finished jobs created before the given time from the jobs table
+        to the archive, in batches, each in its own transaction. Return the
+        number of jobs moved.
+        """
+        jobs = db.tables["jobs"]
+        archive = db.tables["jobs_archive"]
+        candidates = (
+            sa.select(jobs.c.job_id)
+            .where(
+                jobs.c.status.in_(list(JobStateWriter.terminal_statuses)),
+                jobs.c.created_at < created_before,
+            )
+            .limit(batch_size)
+        )
+
+        def move_batch() -> int:
+            with db.engine.begin() as conn:
+                ids = [row[0] for row in conn.execute(candidates)]
+                if ids:
+                    conn.execute(
+                        archive.insert().from_select(
+                            [col.name for col in jobs.c],
+                            jobs.select().where(jobs.c.job_id.in_(ids)),
+                        )
+                    )
+                    conn.execute(jobs.delete().where(jobs.c.job_id.in_(ids)))
+                return len(ids)
+
+        loop = asyncio.get_running_loop()
+        total = 0
+        while True:
+            moved = await loop.run_in_executor(None, move_batch)
+            total += moved
+            if moved < batch_size:
+                return total
 
     @classmethod
     async def get_pending_jobs(
@@ -81,12 +243,472 @@ class Job(BaseModel):
         else:
             query = query.where(table.c.status == JobStatus.created)
 
-        # sort jobs in FIFO order
-        query = query.order_by(table.c.created_at.asc())
+        # sort jobs by priority and then in FIFO order
+        query = query.order_by(
+            table.c.priority.desc(), table.c.created_at.asc()
+        )
 
-        rows = await db.fetch_all(query)
+        with _query_seconds["job_get_pending"].time():
+            rows = await db.fetch_all(query)
         return [cls(**data) for data in rows]
 
+    @classmethod
+    async def claim_pending(
+        cls,
+        db: Database,
+        stream: Optional[str] = None,
+        limit: int = 100,
+        worker_id: Optional[str] = None,
+        exclude_tags: Iterable[str] = (),
+    ) -> List["Job"]:
+        """
+        Atomically claim up to `limit` pending jobs, in priority and then FIFO
+        order, setting their status to "enqueued" and recording the claiming
+        worker. A job is only ever claimed by one worker, even when several
+        workers claim jobs from the same stream concurrently. Jobs with any
+        of the `exclude_tags` are skipped.
+        """
+        table = db.tables["jobs"]
+        candidates = sa.select(table.c.job_id).where(
+            table.c.status == JobStatus.created
+        )
+        if stream is not None:
+            candidates = candidates.where(table.c.stream == stream)
+        exclude_tags = list(exclude_tags)
+        if exclude_tags:
+            candidates = candidates.where(
+                sa.or_(
+                    table.c.tag.is_(None), table.c.tag.notin_(exclude_tags)
+                )
+            )
+        candidates = candidates.order_by(
+            table.c.priority.desc(), table.c.created_at.asc()
+        ).limit(limit)
+
+        claim = table.update().values(
+            status=JobStatus.enqueued, worker_id=worker_id
+        )
+
+        start = time.perf_counter()
+        if db.engine.dialect.name == "postgresql":
+            # skip rows locked by concurrent claims instead of waiting for
+            # them, and claim everything in a single round trip
+            candidates = candidates.with_for_update(skip_locked=True)
+            query = claim.where(
+                table.c.job_id.in_(candidates.scalar_subquery())
+            ).returning(*table.c)
+            rows = await db.fetch_all(query)
+        else:
+            # the update is conditional on the job still being pending, so
+            # only one of several concurrent claims on a job can win it. read
+            # back the jobs that this worker won, which is why worker IDs must
+            # be unique per claimer.
+            ids = [row[0] for row in await db.fetch_all(candidates)]
+            if not ids:
+                return []
+            await db.execute(
+                claim.where(
+                    table.c.job_id.in_(ids),
+                    table.c.status == JobStatus.created,
+                )
+            )
+            query = (
+                table.select()
+                .where(
+                    table.c.job_id.in_(ids),
+                    table.c.worker_id == worker_id,
+                    table.c.status == JobStatus.enqueued,
+                )
+                .order_by(table.c.priority.desc(), table.c.created_at.asc())
+            )
+            rows = await db.fetch_all(query)
+        _query_seconds["job_claim_pending"].observe(
+            time.perf_counter() - start
+        )
+
+        jobs = [cls(**data) for data in rows]
+        registry = JobRegistry.get(db)
+        for job in jobs:
+            registry.put(job)
+        registry.changed([job.job_id for job in jobs])
+        return jobs
+
+    @classmethod
+    async def get_pending_streams(cls, db: Database) -> List[str]:
+        """
+        Get the names of streams with jobs waiting to be claimed.
+        """
+        table = db.tables["jobs"]
+        query = (
+            sa.select(table.c.stream)
+            .where(table.c.status == JobStatus.created)
+            .distinct()
+        )
+        return [row[0] for row in await db.fetch_all(query)]
+
+    @classmethod
+    async def recover_worker_jobs(
+        cls, db: Database, worker_id: str
+    ) -> Set[str]:
+        """
+        Clean up after a worker that died: jobs it claimed but didn't start
+        go back to pending, so that other workers can claim them, and jobs
+        it was running are marked as errors. Return the names of streams
+        with jobs put back.
+        """
+        table = db.tables["jobs"]
+        columns = (table.c.job_id, table.c.stream, table.c.status)
+        query = sa.select(*columns).where(
+            table.c.worker_id == worker_id,
+            table.c.status.in_([JobStatus.enqueued, JobStatus.running]),
+        )
+        rows = await db.fetch_all(query)
+        streams = {row[1] for row in rows if row[2] == JobStatus.enqueued}
+        await db.execute(
+            table.update()
+            .where(
+                table.c.worker_id == worker_id,
+                table.c.status == JobStatus.enqueued,
+            )
+            .values(status=JobStatus.created, worker_id=None)
+        )
+        await db.execute(
+            table.update()
+            .where(
+                table.c.worker_id == worker_id,
+                table.c.status == JobStatus.running,
+            )
+            .values(status=JobStatus.error, error="worker lost")
+        )
+        job_ids = [row[0] for row in rows]
+        registry = JobRegistry.get(db)
+        registry.invalidate(job_ids)
+        registry.changed(job_ids)
+        return streams
+
+    @classmethod
+    async def cancel(cls, db: Database, job_ids: List[str]) -> List[str]:
+        """
+        Cancel jobs that haven't been claimed yet, returning the IDs of the
+        ones cancelled. Jobs that are already claimed are left alone.
+        """
+        table = db.tables["jobs"]
+        condition = sa.and_(
+            table.c.job_id.in_(job_ids), table.c.status == JobStatus.created
+        )
+
+        def cancel() -> List[str]:
+            # select and update in one transaction, locking the rows, so
+            # that jobs claimed in between aren't reported as cancelled
+            with db.engine.begin() as conn:
+                query = (
+                    sa.select(table.c.job_id)
+                    .where(condition)
+                    .with_for_update()
+                )
+                ids = [row[0] for row in conn.execute(query)]
+                if ids:
+                    conn.execute(
+                        table.update()
+                        .where(condition)
+                        .values(status=JobStatus.cancelled)
+                    )
+                return ids
+
+        loop = asyncio.get_running_loop()
+        cancelled = await loop.run_in_executor(None, cancel)
+        registry = JobRegistry.get(db)
+        registry.invalidate(cancelled)
+        registry.changed(cancelled)
+        return cancelled
+
+
+class WorkerHeartbeat:
+    """
+    Heartbeats of worker processes, kept in the `workers` table, so that any
+    API process can find workers that have gone silent, including ones it
+    never heard from itself, like those of a process that was restarted.
+    """
+
+    @classmethod
+    async def beat(cls, db: Database, worker_id: str) -> None:
+        table = db.tables["workers"]
+        now = TimeUtils.utc_now()
+        await db.execute(
+            table.update()
+            .where(table.c.worker_id == worker_id)
+            .values(heartbeat_at=now)
+        )
+        # insert it the first time, or if it was swept up while the worker
+        # wasn't responding
+        query = sa.select(table.c.worker_id).where(
+            table.c.worker_id == worker_id
+        )
+        if await db.fetch_val(query) is None:
+            await db.execute(
+                table.insert().values(worker_id=worker_id, heartbeat_at=now)
+            )
+
+    @classmethod
+    async def remove(cls, db: Database, worker_id: str) -> None:
+        table = db.tables["workers"]
+        await db.execute(
+            table.delete().where(table.c.worker_id == worker_id)
+        )
+
+    @classmethod
+    async def find_stale(cls, db: Database, timeout: float) -> List[str]:
+        """
+        Get the IDs of workers not heard from for `timeout` seconds.
+        """
+        table = db.tables["workers"]
+        deadline = TimeUtils.utc_now() - timedelta(seconds=timeout)
+        query = sa.select(table.c.worker_id).where(
+            table.c.heartbeat_at < deadline
+        )
+        return [row[0] for row in await db.fetch_all(query)]
+
+
+class JobStateWriter:
+    """
+    Write-behind buffer for job state. Changes made through `update` are set
+    on the job right away, but only persisted by the next flush, which:
+
+    - coalesces all changes to a job into a single row update,
+    - groups updates by the set of fields they change, running each group
+      as one `executemany` statement,
+    - and runs all statements in one transaction.
+
+    Flushes run every `flush_interval` seconds while there are changes, and
+    `save` flushes synchronously when a job reaches a terminal state.
+    """
+
+    terminal_statuses = {
+        JobStatus.completed,
+        JobStatus.failed,
+        JobStatus.error,
+        JobStatus.cancelled,
+    }
+
+    _instances: "weakref.WeakKeyDictionary[Database, JobStateWriter]" = (
+        weakref.WeakKeyDictionary()
+    )
+
+    def __init__(self, db: Database, flush_interval: float = 0.05) -> None:
+        self._db = db
+        self._flush_interval = flush_interval
+        self._dirty: Dict[str, Job] = {}
+        self._dirty_fields: Dict[str, Set[str]] = defaultdict(set)
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    @classmethod
+    def get(cls, db: Database) -> "JobStateWriter":
+        """
+        Get the writer shared by everything writing job state to the DB.
+        """
+        writer = cls._instances.get(db)
+        if writer is None:
+            writer = cls._instances[db] = cls(db)
+        return writer
+
+    def update(self, job: Job, **values) -> Job:
+        """
+        Set field values on the job and mark them to be written by the next
+        flush.
+        """
+        for key, val in values.items():
+            setattr(job, key, val)
+
+        self._dirty[job.job_id] = job
+        self._dirty_fields[job.job_id].update(values)
+        JobRegistry.get(self._db).put(job)
+
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_periodically())
+
+        return job
+
+    async def save(self, job: Job, flush: bool = False, **values) -> Job:
+        """
+        Like `update`, but flush right away if the job has reached a terminal
+        state (or if `flush` is set).
+        """
+        self.update(job, **values)
+        if flush or job.status in self.terminal_statuses:
+            await self.flush()
+        return job
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            jobs, fields = self._dirty, self._dirty_fields
+            self._dirty, self._dirty_fields = {}, defaultdict(set)
+
+            # group row updates by the fields they change
+            groups: Dict[FrozenSet[str], List[dict]] = defaultdict(list)
+            for job_id, job in jobs.items():
+                names = frozenset(fields[job_id])
+                row = {f"_{name}": getattr(job, name) for name in names}
+                row["_job_id"] = job_id
+                groups[names].append(row)
+
+            table = self._db.tables["jobs"]
+            statements = []
+            for names, rows in groups.items():
+                params = {name: sa.bindparam(f"_{name}") for name in names}
+                statement = (
+                    table.update()
+                    .where(table.c.job_id == sa.bindparam("_job_id"))
+                    .values(params)
+                )
+                statements.append((statement, rows))
+
+            # the async driver runs executemany as one execute per row, so
+            # go through the sync engine in a thread instead.
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self._execute, statements)
+                JobRegistry.get(self._db).changed(list(jobs))
+            except Exception:
+                # put the changes back, so that the next flush retries them
+                for job_id, job in jobs.items():
+                    self._dirty.setdefault(job_id, job)
+                    self._dirty_fields[job_id].update(fields[job_id])
+                raise
+
+    def _execute(self, statements: List[tuple]) -> None:
+        with _query_seconds["job_state_flush"].time():
+            with self._db.engine.begin() as conn:
+                for statement, rows in statements:
+                    conn.execute(statement, rows)
+
+    async def _flush_periodically(self) -> None:
+        while self._dirty:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("error flushing job state")
+
+
+class JobRegistry:
+    """
+    Process-local cache of jobs, keyed by job ID, in front of the DB. Jobs
+    that haven't finished are always kept. Finished jobs are kept up to
+    `max_finished`, evicting the least recently used.
+
+    The registry holds the same `Job` objects that are created, claimed and
+    updated through `JobStateWriter` in this process, so it sees changes as
+    they're made, while the writer persists them. Other processes learn of
+    changes through invalidations, sent after each flush: see `connect`.
+    """
+
+    invalidation_topic = "jobs.invalidate."
+
+    _instances: "weakref.WeakKeyDictionary[Database, JobRegistry]" = (
+        weakref.WeakKeyDictionary()
+    )
+
+    def __init__(self, db: Database, max_finished: int = 10000) -> None:
+        self._db = db
+        self._max_finished = max_finished
+        self._live: Dict[str, Job] = {}
+        self._finished: "OrderedDict[str, Job]" = OrderedDict()
+        self._id = uuid4().hex
+        self._channel: Optional[Channel] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # called with IDs of jobs changed by this process, to invalidate
+        # them in others
+        self.publisher: Optional[Callable[[List[str]], None]] = None
+
+    @classmethod
+    def get(cls, db: Database) -> "JobRegistry":
+        registry = cls._instances.get(db)
+        if registry is None:
+            registry = cls._instances[db] = cls(db)
+        return registry
+
+    def __len__(self) -> int:
+        return len(self._live) + len(self._finished)
+
+    def connect(self, channel: Channel) -> None:
+        """
+        Send and receive invalidations over an IPC channel. Must be called
+        from within the running event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._channel = channel
+        self.publisher = self._publish
+        channel.subscribe(
+            callback=self._on_message, topics=[self.invalidation_topic]
+        )
+
+    def put(self, job: Job) -> Job:
+        job_id = job.job_id
+        if job.status in JobStateWriter.terminal_statuses:
+            self._live.pop(job_id, None)
+            self._finished[job_id] = job
+            self._finished.move_to_end(job_id)
+            while len(self._finished) > self._max_finished:
+                self._finished.popitem(last=False)
+        else:
+            self._finished.pop(job_id, None)
+            self._live[job_id] = job
+        return job
+
+    def peek(self, job_id: str) -> Optional[Job]:
+        job = self._live.get(job_id)
+        if job is None:
+            job = self._finished.get(job_id)
+            if job is not None:
+                self._finished.move_to_end(job_id)
+        return job
+
+    async def find(self, job_id: str) -> Optional[Job]:
+        """
+        Get a job from memory, or from the DB if it's not there.
+        """
+        job = self.peek(job_id)
+        if job is None:
+            job = await Job.get(self._db, job_id)
+            if job is not None:
+                self.put(job)
+        return job
+
+    def invalidate(self, job_ids: Iterable[str]) -> None:
+        """
+        Drop jobs changed elsewhere, so that they're read from the DB next.
+        """
+        for job_id in job_ids:
+            self._live.pop(job_id, None)
+            self._finished.pop(job_id, None)
+
+    def changed(self, job_ids: List[str]) -> None:
+        """
+        Tell other processes that jobs were changed by this one.
+        """
+        if job_ids and self.publisher is not None:
+            try:
+                self.publisher(job_ids)
+            except Exception:
+                log.exception("error publishing job invalidations")
+
+    def _publish(self, job_ids: List[str]) -> None:
+        self._channel.publish(
+            {"job_ids": job_ids, "source": self._id},
+            topic=self.invalidation_topic,
+        )
+
+    def _on_message(self, message: dict) -> None:
+        # called from the subscription thread, not the event loop
+        if message.get("source") != self._id and self._loop is not None:
+            self._loop.call_soon_threadsafe(
+                self.invalidate, message["job_ids"]
+            )
+
 
 class JobResult(BaseModel):
     job: Job
@@ -102,6 +724,16 @@ class JobOutput(BaseModel):
     class Data(BaseModel):
         line_no: int
         text: str
+        # parsed out of the text by an output pipeline, if any
+        fields: Optional[dict]
+
+        def dict(self, **kwargs) -> dict:
+            # leave out fields when there are none, as `BatchEncoder` does,
+            # so that lines are encoded the same either way
+            data = super().dict(**kwargs)
+            if data.get("fields") is None:
+                data.pop("fields", None)
+            return data
 
     job_id: str
     tag: Optional[str]
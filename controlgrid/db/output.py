@@ -0,0 +1,345 @@
+import asyncio
+import weakref
+import zlib
+
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from controlgrid.db.database import Database
+from controlgrid.log import log
+
+# (line_no, timestamp, text)
+OutputLine = Tuple[int, int, str]
+
+# (line_no, line_count, timestamp, data)
+OutputBytes = Tuple[int, int, int, bytes]
+
+
+class OutputChunk:
+    """
+    Consecutive output lines of a job, as a list of lines, or for jobs with
+    raw output, and chunks read back from the DB, as the bytes of
+    `raw_count` newline-separated lines, which are only decoded and split
+    when read as lines.
+
+    Lines are output at the chunk's `timestamp`, or if they were added
+    later, at the time of the last of `timestamps`, a list of (offset of
+    the first line added, time) pairs, before them.
+    """
+
+    __slots__ = (
+        "job_id",
+        "line_no",
+        "timestamp",
+        "timestamps",
+        "lines",
+        "raw",
+        "raw_count",
+    )
+
+    def __init__(self, job_id: str, line_no: int, timestamp: int) -> None:
+        self.job_id = job_id
+        self.line_no = line_no
+        self.timestamp = timestamp
+        self.timestamps: List[Tuple[int, int]] = []
+        self.lines: List[str] = []
+        self.raw: Optional[bytearray] = None
+        self.raw_count = 0
+
+    @property
+    def line_count(self) -> int:
+        return self.raw_count if self.raw is not None else len(self.lines)
+
+    def stamp(self, timestamp: int) -> None:
+        # lines added from now on were output at the given time
+        last = self.timestamps[-1][1] if self.timestamps else self.timestamp
+        if timestamp != last:
+            self.timestamps.append((self.line_count, timestamp))
+
+    def timestamp_at(self, offset: int) -> int:
+        # time the line at the offset was output
+        i = bisect_right(self.timestamps, (offset, float("inf")))
+        return self.timestamps[i - 1][1] if i else self.timestamp
+
+    def add_raw(self, data: bytes, line_count: int) -> None:
+        if self.raw is None:
+            self.raw = bytearray()
+        elif self.raw and self.raw[-1] != 10:
+            # end the piece of a long line that the last data ended with
+            self.raw += b"\n"
+        self.raw += data
+        self.raw_count += line_count
+
+    def slice(self, start: int, stop: Optional[int]) -> List[OutputLine]:
+        # get lines in [start, stop) as OutputLine tuples
+        offset = max(0, start - self.line_no)
+        end = None if stop is None else max(0, stop - self.line_no)
+        lines = self.lines if self.raw is None else self._split_raw()
+        if not self.timestamps:
+            return [
+                (self.line_no + offset + i, self.timestamp, text)
+                for i, text in enumerate(lines[offset:end])
+            ]
+        return [
+            (self.line_no + i, self.timestamp_at(i), text)
+            for i, text in enumerate(lines[offset:end], offset)
+        ]
+
+    def slice_raw(
+        self, start: int, stop: Optional[int]
+    ) -> Optional[OutputBytes]:
+        # get lines in [start, stop) as bytes, each ending with a newline
+        offset = max(0, start - self.line_no)
+        end = self.line_count
+        if stop is not None:
+            end = min(end, max(0, stop - self.line_no))
+        if offset >= end:
+            return None
+        if self.raw is None:
+            text = "".join([f"{line}\n" for line in self.lines[offset:end]])
+            data = text.encode("utf-8")
+        else:
+            # find the lines' bounds without splitting the rest
+            raw = self.raw
+            begin = 0
+            for _ in range(offset):
+                begin = raw.index(b"\n", begin) + 1
+            finish = begin
+            for _ in range(end - offset):
+                finish = raw.find(b"\n", finish) + 1 or len(raw)
+            data = bytes(raw[begin:finish])
+            if not data.endswith(b"\n"):
+                data += b"\n"
+        timestamp = self.timestamp_at(offset)
+        return self.line_no + offset, end - offset, timestamp, data
+
+    def to_row(self) -> dict:
+        if self.raw is not None:
+            # stored like lines, joined by newlines, without a last one
+            end = len(self.raw) - 1 if self.raw.endswith(b"\n") else None
+            data = bytes(memoryview(self.raw)[:end])
+        else:
+            data = "\n".join(self.lines).encode("utf-8")
+        return {
+            "job_id": self.job_id,
+            "line_no": self.line_no,
+            "line_count": self.line_count,
+            "timestamp": self.timestamp,
+            "timestamps": [list(pair) for pair in self.timestamps] or None,
+            "data": zlib.compress(data),
+        }
+
+    @classmethod
+    def from_row(cls, row) -> "OutputChunk":
+        # kept as bytes, as for raw output, and only split into lines if
+        # they're read as lines, so that raw output can be read back as is
+        chunk = cls(row["job_id"], row["line_no"], row["timestamp"])
+        # rows from before per-line timestamps were stored have none
+        chunk.timestamps = [tuple(pair) for pair in row["timestamps"] or ()]
+        chunk.raw = bytearray(zlib.decompress(row["data"]))
+        chunk.raw += b"\n"
+        chunk.raw_count = row["line_count"]
+        return chunk
+
+    def _split_raw(self) -> List[str]:
+        text = self.raw.decode("utf-8", errors="replace")
+        if text.endswith("\n"):
+            text = text[:-1]
+        return text.split("\n")
+
+
+class JobOutputStore:
+    """
+    Persistent log of job output lines. Lines are appended to an in-memory
+    chunk per job. Full chunks, and on every flush, partial ones, are
+    compressed and inserted into the `job_output` table in batches, off the
+    event loop, every `flush_interval` seconds.
+
+    Reads return lines from the DB as well as lines not yet flushed.
+    """
+
+    _instances: "weakref.WeakKeyDictionary[Database, JobOutputStore]" = (
+        weakref.WeakKeyDictionary()
+    )
+
+    def __init__(
+        self,
+        db: Database,
+        chunk_size: int = 1000,
+        flush_interval: float = 1.0,
+        chunk_bytes: int = 1 << 20,
+    ) -> None:
+        self._db = db
+        self._chunk_size = chunk_size
+        self._chunk_bytes = chunk_bytes
+        self._flush_interval = flush_interval
+        self._open: Dict[str, OutputChunk] = {}
+        self._sealed: List[OutputChunk] = []
+        self._flushing: List[OutputChunk] = []
+        self._flush_lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+
+    @classmethod
+    def get(cls, db: Database) -> "JobOutputStore":
+        store = cls._instances.get(db)
+        if store is None:
+            store = cls._instances[db] = cls(db)
+        return store
+
+    def append(
+        self, job_id: str, line_no: int, text: str, timestamp: float
+    ) -> None:
+        self.extend(job_id, line_no, [text], timestamp)
+
+    def extend(
+        self, job_id: str, line_no: int, texts: List[str], timestamp: float
+    ) -> None:
+        """
+        Append consecutive lines, starting at `line_no`.
+        """
+        start = 0
+        while start < len(texts):
+            chunk = self._get_open_chunk(job_id, line_no + start, timestamp)
+            chunk.stamp(int(timestamp))
+            end = start + self._chunk_size - len(chunk.lines)
+            chunk.lines.extend(texts[start:end])
+            start = end
+            if len(chunk.lines) >= self._chunk_size:
+                self._sealed.append(self._open.pop(job_id))
+
+    def extend_raw(
+        self,
+        job_id: str,
+        line_no: int,
+        data: bytes,
+        line_count: int,
+        timestamp: float,
+    ) -> None:
+        """
+        Append raw output of `line_count` lines, starting at `line_no`. It's
+        kept as bytes, in chunks of about `chunk_bytes`, until it's read.
+        """
+        chunk = self._get_open_chunk(job_id, line_no, timestamp)
+        chunk.stamp(int(timestamp))
+        chunk.add_raw(data, line_count)
+        if (
+            chunk.raw_count >= self._chunk_size
+            or len(chunk.raw) >= self._chunk_bytes
+        ):
+            self._sealed.append(self._open.pop(job_id))
+
+    def _get_open_chunk(
+        self, job_id: str, line_no: int, timestamp: float
+    ) -> OutputChunk:
+        chunk = self._open.get(job_id)
+        if chunk is None:
+            chunk = self._open[job_id] = OutputChunk(
+                job_id, line_no, int(timestamp)
+            )
+            if self._flusher is None or self._flusher.done():
+                self._flusher = asyncio.create_task(
+                    self._flush_periodically()
+                )
+        return chunk
+
+    def close(self, job_id: str) -> None:
+        """
+        Mark the end of a job's output, so that its last chunk gets written
+        by the next flush.
+        """
+        chunk = self._open.pop(job_id, None)
+        if chunk is not None:
+            self._sealed.append(chunk)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            self._sealed.extend(self._open.values())
+            self._open.clear()
+            if not self._sealed:
+                return
+
+            self._flushing, self._sealed = self._sealed, []
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(
+                    None, self._insert, list(self._flushing)
+                )
+            except Exception:
+                # put the chunks back, so that the next flush retries them
+                self._sealed[:0] = self._flushing
+                raise
+            finally:
+                self._flushing = []
+
+    async def read(
+        self, job_id: str, from_line: int = 0, limit: Optional[int] = None
+    ) -> List[OutputLine]:
+        """
+        Read up to `limit` lines of a job's output, starting at `from_line`,
+        loading only the chunks that contain them.
+        """
+        stop = None if limit is None else from_line + limit
+        lines: List[OutputLine] = []
+        for chunk in await self._load_chunks(job_id, from_line, stop):
+            lines.extend(chunk.slice(from_line, stop))
+        return lines
+
+    async def read_raw(
+        self, job_id: str, from_line: int = 0, limit: Optional[int] = None
+    ) -> List[OutputBytes]:
+        """
+        Like `read`, but return the lines as they were output, as bytes, in
+        a block per chunk.
+        """
+        stop = None if limit is None else from_line + limit
+        blocks = [
+            chunk.slice_raw(from_line, stop)
+            for chunk in await self._load_chunks(job_id, from_line, stop)
+        ]
+        return [block for block in blocks if block is not None]
+
+    async def _load_chunks(
+        self, job_id: str, from_line: int, stop: Optional[int]
+    ) -> List[OutputChunk]:
+        # chunks with lines in [from_line, stop), in order
+
+        # lines that haven't been flushed to the DB yet
+        pending = [
+            chunk
+            for chunk in self._flushing + self._sealed
+            if chunk.job_id == job_id
+        ]
+        if job_id in self._open:
+            pending.append(self._open[job_id])
+
+        table = self._db.tables["job_output"]
+        query = table.select().where(
+            table.c.job_id == job_id,
+            table.c.line_no + table.c.line_count > from_line,
+        )
+        if stop is not None:
+            query = query.where(table.c.line_no < stop)
+
+        rows = await self._db.fetch_all(query.order_by(table.c.line_no))
+
+        chunks = {chunk.line_no: chunk for chunk in pending}
+        for row in rows:
+            if row["line_no"] not in chunks:
+                chunks[row["line_no"]] = OutputChunk.from_row(row)
+
+        return [chunks[line_no] for line_no in sorted(chunks)]
+
+    def _insert(self, chunks: List[OutputChunk]) -> None:
+        # compress and insert in a worker thread with a single executemany
+        table = self._db.tables["job_output"]
+        rows = [chunk.to_row() for chunk in chunks]
+        with self._db.engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+
+    async def _flush_periodically(self) -> None:
+        while self._open or self._sealed:
+            await asyncio.sleep(self._flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("error flushing job output")
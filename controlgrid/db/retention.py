@@ -0,0 +1,26 @@
+import asyncio
+
+from datetime import timedelta
+
+from appyratus.utils.time_utils import TimeUtils
+
+from controlgrid.db.database import Database
+from controlgrid.db.models import Job
+from controlgrid.log import log
+
+
+async def archive_periodically(
+    db: Database, retention: timedelta, interval: float = 3600.0
+) -> None:
+    """
+    Every `interval` seconds, move finished jobs older than `retention` out
+    of the jobs table, into the archive, keeping the hot table small.
+    """
+    while True:
+        try:
+            moved = await Job.archive(db, TimeUtils.utc_now() - retention)
+            if moved:
+                log.info(f"archived {moved} jobs older than {retention}")
+        except Exception:
+            log.exception("error archiving jobs")
+        await asyncio.sleep(interval)
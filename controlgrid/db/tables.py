@@ -1,26 +1,95 @@
+from typing import List
+
 import sqlalchemy as sa
 
 from appyratus.utils.time_utils import TimeUtils
 
 
+def job_columns() -> List[sa.Column]:
+    return [
+        sa.Column("job_id", sa.String(), primary_key=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("command", sa.String(length=100), nullable=False),
+        sa.Column("args", sa.JSON(), nullable=False, default=[]),
+        sa.Column("status", sa.String(length=20), nullable=False),
+        sa.Column("tag", sa.String(length=100)),
+        sa.Column("stream", sa.String(length=100)),
+        sa.Column("timeout", sa.Float()),
+        sa.Column("pid", sa.Integer()),
+        sa.Column("exit_code", sa.Integer()),
+        sa.Column("error", sa.String()),
+        # with a server default, so that it can be added to existing rows
+        sa.Column(
+            "priority",
+            sa.Integer(),
+            nullable=False,
+            default=0,
+            server_default=sa.text("0"),
+        ),
+        sa.Column("worker_id", sa.String(length=100)),
+        sa.Column("cpu_limit", sa.Integer()),
+        sa.Column("memory_limit", sa.BigInteger()),
+        sa.Column("pipeline", sa.JSON()),
+        sa.Column("output_format", sa.String(length=20)),
+    ]
+
+
 def jobs(metadata: sa.MetaData) -> sa.Table:
+    table = sa.Table("jobs", metadata, *job_columns())
+    c = table.c
+
+    # claiming pending jobs: status and stream, in priority and FIFO order
+    sa.Index(
+        "ix_jobs_pending",
+        c.status,
+        c.stream,
+        c.priority.desc(),
+        c.created_at,
+    )
+    # listing jobs, newest first, with keyset pagination on
+    # (created_at, job_id), optionally filtered by one of these fields
+    sa.Index("ix_jobs_created_at_job_id", c.created_at, c.job_id)
+    sa.Index("ix_jobs_status_created_at", c.status, c.created_at, c.job_id)
+    sa.Index("ix_jobs_stream_created_at", c.stream, c.created_at, c.job_id)
+    sa.Index("ix_jobs_tag_created_at", c.tag, c.created_at, c.job_id)
+    # recovering the jobs of a dead worker
+    sa.Index("ix_jobs_worker_id_status", c.worker_id, c.status)
+
+    return table
+
+
+def jobs_archive(metadata: sa.MetaData) -> sa.Table:
+    # finished jobs moved out of the jobs table by retention
+    table = sa.Table("jobs_archive", metadata, *job_columns())
+    sa.Index("ix_jobs_archive_created_at", table.c.created_at)
+    return table
+
+
+def workers(metadata: sa.MetaData) -> sa.Table:
+    # worker processes, by when they were last heard from, so that the jobs
+    # of ones that have died can be recovered
+    return sa.Table(
+        "workers",
+        metadata,
+        sa.Column("worker_id", sa.String(length=100), primary_key=True),
+        sa.Column("heartbeat_at", sa.DateTime(), nullable=False),
+    )
+
+
+def job_output(metadata: sa.MetaData) -> sa.Table:
+    # each row is a zlib-compressed chunk of consecutive output lines,
+    # starting at line_no.
     return sa.Table(
-        "jobs",
+        "job_output",
         metadata,
         *[
             sa.Column("job_id", sa.String(), primary_key=True),
-            sa.Column("created_at", sa.DateTime(), nullable=False, index=True),
-            sa.Column("command", sa.String(length=100), nullable=False),
-            sa.Column("args", sa.JSON(), nullable=False, default=[]),
-            sa.Column(
-                "status", sa.String(length=20), nullable=False, index=True
-            ),
-            sa.Column("tag", sa.String(length=100), index=True),
-            sa.Column("stream", sa.String(length=100), index=True),
-            sa.Column("timeout", sa.Float()),
-            sa.Column("pid", sa.Integer()),
-            sa.Column("exit_code", sa.Integer()),
-            sa.Column("error", sa.String()),
+            sa.Column("line_no", sa.Integer(), primary_key=True),
+            sa.Column("line_count", sa.Integer(), nullable=False),
+            sa.Column("timestamp", sa.Integer(), nullable=False),
+            # (offset, timestamp) of lines output after the first, if any
+            sa.Column("timestamps", sa.JSON()),
+            sa.Column("data", sa.LargeBinary(), nullable=False),
         ]
     )
 
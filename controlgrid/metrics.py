@@ -0,0 +1,380 @@
+"""
+Counters, gauges and histograms, exposed in the Prometheus text format.
+
+Recording is meant to be left on in production, on hot paths: it takes no
+locks, and is just arithmetic on a slotted object once a metric's labelled
+child exists. Look up children with `labels` once, up front, and keep them,
+rather than on every call. Updates from several threads rely on the GIL, so
+a rare increment can be lost under contention, which is fine for monitoring.
+"""
+
+import math
+import time
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# latency buckets, in seconds, from 100us to 10s
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+Sample = Tuple[str, Tuple[Tuple[str, str], ...], float]
+
+
+class Value:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = buckets
+        # counts per bucket, not cumulative, with one more for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "Timer":
+        """
+        Context manager observing the time spent in its block.
+        """
+        return Timer(self)
+
+
+class Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram: HistogramValue) -> None:
+        self._histogram = histogram
+        self._start = 0.0
+
+    def __enter__(self) -> "Timer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class Metric:
+    """
+    Base class of metrics. A metric with label names has a child per
+    combination of label values, got with `labels`. One without any is its
+    own only child, and can be recorded to directly.
+    """
+
+    kind = ""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        registry: "Registry" = None,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.label_names:
+            self._default = self.labels()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(
+                    f"{self.name} takes labels {self.label_names}"
+                )
+            # setdefault, so that concurrent threads get the same child
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def label_values(self) -> List[Tuple[str, ...]]:
+        return list(self._children)
+
+    def remove(self, *values: str) -> None:
+        self._children.pop(values, None)
+
+    def samples(self) -> Iterator[Sample]:
+        for values, child in list(self._children.items()):
+            labels = tuple(zip(self.label_names, values))
+            yield from self._child_samples(labels, child)
+
+    def _new_child(self):
+        return Value()
+
+    def _child_samples(self, labels, child) -> Iterator[Sample]:
+        yield self.name, labels, child.value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        self._default.value += amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1) -> None:
+        self._default.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self._default.value -= amount
+
+    def set(self, value: float) -> None:
+        self._default.value = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: "Registry" = None,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels, registry)
+
+    def observe(self, value: float) -> None:
+        self._default.observe(value)
+
+    def time(self) -> Timer:
+        return Timer(self._default)
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def _child_samples(self, labels, child) -> Iterator[Sample]:
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            total += count
+            le = (("le", format_value(bound)),)
+            yield f"{self.name}_bucket", labels + le, total
+        yield f"{self.name}_sum", labels, child.sum
+        yield f"{self.name}_count", labels, child.count
+
+
+class Registry:
+    """
+    Metrics to expose, along with collectors: functions called before each
+    exposition, to set metrics whose values are read rather than recorded,
+    like the size of a pool.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric already registered: {metric.name}")
+        self._metrics[metric.name] = metric
+
+    def add_collector(self, collect: Callable[[], None]) -> None:
+        self._collectors.append(collect)
+
+    def collect(self) -> None:
+        for collect in self._collectors:
+            collect()
+
+    def expose(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {escape(metric.help)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    pairs = ",".join(
+                        f'{k}="{escape(v, quote=True)}"' for k, v in labels
+                    )
+                    name = f"{name}{{{pairs}}}"
+                lines.append(f"{name} {format_value(value)}")
+        lines.append("")
+        return "\n".join(lines)
+
+
+def escape(text: str, quote: bool = False) -> str:
+    text = str(text).replace("\\", "\\\\").replace("\n", "\\n")
+    return text.replace('"', '\\"') if quote else text
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if value != value:
+        return "NaN"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+# stream scheduling and output
+STREAM_QUEUED_JOBS = Gauge(
+    "controlgrid_stream_queued_jobs",
+    "Jobs claimed by a streamer and waiting for a free slot.",
+    ["stream"],
+)
+STREAM_RUNNING_JOBS = Gauge(
+    "controlgrid_stream_running_jobs",
+    "Jobs running in a stream.",
+    ["stream"],
+)
+STREAM_OUTPUT_LINES = Counter(
+    "controlgrid_stream_output_lines_total",
+    "Output lines sent in stream batches.",
+    ["stream"],
+)
+STREAM_OUTPUT_BYTES = Counter(
+    "controlgrid_stream_output_bytes_total",
+    "Bytes of output text sent in stream batches.",
+    ["stream"],
+)
+STREAM_DROPPED_LINES = Counter(
+    "controlgrid_stream_dropped_lines_total",
+    "Output lines dropped by output pipelines, rather than sent.",
+    ["stream"],
+)
+STREAM_BATCH_FLUSHES = Counter(
+    "controlgrid_stream_batch_flushes_total",
+    "Stream batches flushed, by the limit that triggered them.",
+    ["stream", "reason"],
+)
+BATCH_ENCODE_SECONDS = Histogram(
+    "controlgrid_batch_encode_seconds",
+    "Time taken to encode a stream batch.",
+    ["stream"],
+)
+SPAWN_SECONDS = Histogram(
+    "controlgrid_spawn_seconds",
+    "Time taken to start a job's subprocess.",
+    ["backend"],
+)
+SSE_CLIENTS = Gauge(
+    "controlgrid_sse_clients",
+    "Connected SSE clients.",
+    ["stream"],
+)
+
+WEBSOCKET_CLIENTS = Gauge(
+    "controlgrid_websocket_clients",
+    "Connected websocket clients.",
+)
+PROCESSES = Gauge(
+    "controlgrid_job_processes",
+    "Jobs claimed or running in this process.",
+)
+RESULT_CACHE_REQUESTS = Counter(
+    "controlgrid_result_cache_requests_total",
+    "Requests with a cache TTL, by whether they were served from the cache "
+    "(hit), shared a job in flight (shared) or ran their own (miss).",
+    ["outcome"],
+)
+RESULT_CACHE_ENTRIES = Gauge(
+    "controlgrid_result_cache_entries",
+    "Results in the result cache.",
+)
+WORKERS = Gauge(
+    "controlgrid_workers",
+    "Worker processes heard from within their heartbeat timeout.",
+)
+
+# jobs run to completion by the runner
+RUNNER_RUNNING_JOBS = Gauge(
+    "controlgrid_runner_running_jobs",
+    "Jobs being run by the runner.",
+)
+RUNNER_JOBS = Counter(
+    "controlgrid_runner_jobs_total",
+    "Jobs run by the runner, by final status.",
+    ["status"],
+)
+RUNNER_JOB_SECONDS = Histogram(
+    "controlgrid_runner_job_seconds",
+    "Time taken by the runner to run a job.",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+
+# DB
+DB_QUERY_SECONDS = Histogram(
+    "controlgrid_db_query_seconds",
+    "Time taken by DB queries, by query.",
+    ["query"],
+)
+JOBS_PENDING = Gauge(
+    "controlgrid_jobs_pending",
+    "Jobs in the DB waiting to be claimed, by stream.",
+    ["stream"],
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "controlgrid_db_pool_connections",
+    "DB connection pool connections, by engine and state.",
+    ["engine", "state"],
+)
+
+# IPC
+IPC_REQUESTS = Counter(
+    "controlgrid_ipc_requests_total",
+    "Requests handled by IPC services, by outcome.",
+    ["outcome"],
+)
+IPC_REQUEST_SECONDS = Histogram(
+    "controlgrid_ipc_request_seconds",
+    "Time taken by IPC services to handle a request.",
+)
+IPC_MESSAGES_RECEIVED = Counter(
+    "controlgrid_ipc_messages_received_total",
+    "Messages received by channel subscriptions.",
+)
+IPC_MESSAGES_DROPPED = Counter(
+    "controlgrid_ipc_messages_dropped_total",
+    "Messages dropped by channel subscriptions with a full buffer.",
+)
@@ -0,0 +1,440 @@
+import asyncio
+import errno
+import os
+import pty
+import resource
+import signal
+import tty
+
+from typing import Callable, Dict, List, Optional, Type
+
+import pexpect
+
+
+def kill_group(pid: int, sig: int = signal.SIGKILL) -> None:
+    """
+    Signal the process group led by the given process. Job subprocesses are
+    started in their own sessions, so this reaches anything they started.
+    """
+    try:
+        os.killpg(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+class Process:
+    """
+    Handle to a spawned job subprocess, as returned by a `ProcessBackend`.
+    Output is read line by line, or a chunk of lines at a time, with stderr
+    merged into stdout. Don't mix `readline` and `readlines` on the same
+    process, as `readlines` may read ahead.
+
+    Processes spawned with `raw` output are read with `readinto` instead,
+    as bytes.
+    """
+
+    def __init__(self, pid: int, timeout: Optional[float] = None) -> None:
+        self.pid = pid
+        self.timeout = timeout
+
+    @property
+    def returncode(self) -> Optional[int]:
+        raise NotImplementedError()
+
+    async def readline(self) -> str:
+        """
+        Return the next line of output, including its line terminator, or an
+        empty string once the process has closed its output.
+        """
+        raise NotImplementedError()
+
+    async def readlines(self, max_lines: int) -> List[str]:
+        """
+        Return the next lines of output, without their newlines: at least
+        one, and after that up to `max_lines` of those already output, or an
+        empty list once the process has closed its output.
+        """
+        line = await self.readline()
+        return [line.rstrip("\n")] if line else []
+
+    async def readinto(self, buffer: memoryview) -> int:
+        """
+        Read output into the buffer, returning the number of bytes read, or
+        0 once the process has closed its output.
+        """
+        raise NotImplementedError()
+
+    async def wait(self) -> Optional[int]:
+        raise NotImplementedError()
+
+    def kill(self, sig: int = signal.SIGKILL) -> None:
+        kill_group(self.pid, sig)
+
+
+class ProcessBackend:
+    """
+    Strategy used by `Streamer` to spawn job subprocesses and read their
+    output. Subprocesses are started in new sessions, with the given CPU
+    time (seconds) and memory (bytes) limits, if any. With `raw`, output is
+    read as bytes, straight from the OS, with `Process.readinto`.
+    """
+
+    name: str = ""
+
+    async def spawn(
+        self,
+        command: str,
+        args: List[str],
+        timeout: Optional[float] = None,
+        cpu_limit: Optional[int] = None,
+        memory_limit: Optional[int] = None,
+        raw: bool = False,
+    ) -> Process:
+        raise NotImplementedError()
+
+
+def rlimit_setter(
+    cpu_limit: Optional[int] = None, memory_limit: Optional[int] = None
+) -> Optional[Callable[[], None]]:
+    """
+    Make a `preexec_fn` for a subprocess that applies the given limits. A
+    process past its CPU limit gets SIGXCPU, and then SIGKILL a second
+    later. Allocations past its memory limit fail.
+    """
+    if not (cpu_limit or memory_limit):
+        return None
+
+    def set_rlimits() -> None:
+        if cpu_limit:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, cpu_limit + 1))
+        if memory_limit:
+            limit = (memory_limit, memory_limit)
+            resource.setrlimit(resource.RLIMIT_AS, limit)
+
+    return set_rlimits
+
+
+class AsyncioProcess(Process):
+    def __init__(
+        self,
+        proc: asyncio.subprocess.Process,
+        reader: asyncio.StreamReader,
+        timeout: Optional[float] = None,
+        chunk_size: int = 1 << 16,
+    ) -> None:
+        super().__init__(proc.pid, timeout=timeout)
+        self._proc = proc
+        self._reader = reader
+        self._chunk_size = chunk_size
+        # lines read ahead by `readlines`, from `_next` on, and the partial
+        # line at the end of the last chunk read
+        self._lines: List[str] = []
+        self._next = 0
+        self._partial = b""
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._proc.returncode
+
+    async def readline(self) -> str:
+        # like pexpect, the timeout bounds how long we wait for output
+        line = await asyncio.wait_for(self._readline(), timeout=self.timeout)
+        return line.decode("utf-8", errors="replace")
+
+    async def _readline(self) -> bytes:
+        # the reader stops reading from the pipe once it has buffered twice
+        # its limit, so the child blocks on write until we catch up. lines
+        # longer than the limit are returned in pieces, rather than dropped
+        # with an error like `StreamReader.readline` does.
+        try:
+            return await self._reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as exc:
+            return exc.partial
+        except asyncio.LimitOverrunError as exc:
+            return await self._reader.read(max(exc.consumed, 1))
+
+    async def readlines(self, max_lines: int) -> List[str]:
+        if self._next >= len(self._lines):
+            self._lines = await self._read_chunk()
+            self._next = 0
+        start = self._next
+        self._next = min(start + max(1, max_lines), len(self._lines))
+        return self._lines[start : self._next]
+
+    async def _read_chunk(self) -> List[str]:
+        # read whatever output is available, up to a chunk, and split it
+        # into lines, holding back a partial line at the end for next time.
+        # lines longer than a chunk are returned in pieces.
+        while True:
+            data = await asyncio.wait_for(
+                self._reader.read(self._chunk_size), timeout=self.timeout
+            )
+            if not data:
+                data, self._partial = self._partial, b""
+                if not data:
+                    return []
+                end = len(data)
+            else:
+                data = self._partial + data
+                end = data.rfind(b"\n") + 1
+                if not end:
+                    if len(data) < self._chunk_size:
+                        self._partial = data
+                        continue
+                    end = len(data)
+                self._partial = data[end:]
+            lines = data[:end].decode("utf-8", errors="replace").split("\n")
+            if not lines[-1]:
+                lines.pop()
+            return lines
+
+    async def wait(self) -> Optional[int]:
+        return await self._proc.wait()
+
+
+class RawProcess(Process):
+    """
+    Reads output from the non-blocking file descriptor of the read end of a
+    pipe, or of a PTY master, into buffers given by the caller, without the
+    buffering and copies of an `asyncio.StreamReader`.
+    """
+
+    def __init__(
+        self,
+        proc: asyncio.subprocess.Process,
+        fd: int,
+        timeout: Optional[float] = None,
+    ) -> None:
+        super().__init__(proc.pid, timeout=timeout)
+        self._proc = proc
+        self._fd = fd
+        os.set_blocking(fd, False)
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._proc.returncode
+
+    async def readinto(self, buffer: memoryview) -> int:
+        if self._fd < 0:
+            return 0
+        while True:
+            try:
+                size = os.readv(self._fd, [buffer])
+            except BlockingIOError:
+                # like pexpect, the timeout bounds how long we wait for
+                # output
+                await asyncio.wait_for(self._readable(), self.timeout)
+                continue
+            except OSError as exc:
+                # reading a PTY master after the child exits fails with EIO,
+                # which is how a PTY signals EOF
+                if exc.errno != errno.EIO:
+                    raise
+                size = 0
+            if not size:
+                self._close()
+            return size
+
+    async def wait(self) -> Optional[int]:
+        self._close()
+        return await self._proc.wait()
+
+    def kill(self, sig: int = signal.SIGKILL) -> None:
+        # the process is being abandoned, so its output won't be read
+        super().kill(sig)
+        self._close()
+
+    async def _readable(self) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_readable() -> None:
+            if not future.done():
+                future.set_result(None)
+
+        loop.add_reader(self._fd, on_readable)
+        try:
+            await future
+        finally:
+            loop.remove_reader(self._fd)
+
+    def _close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PipeBackend(ProcessBackend):
+    """
+    Spawn subprocesses with `asyncio.create_subprocess_exec`, reading stdout
+    through an OS pipe watched by the event loop.
+    """
+
+    name = "pipe"
+
+    async def spawn(
+        self,
+        command: str,
+        args: List[str],
+        timeout: Optional[float] = None,
+        cpu_limit: Optional[int] = None,
+        memory_limit: Optional[int] = None,
+        raw: bool = False,
+    ) -> Process:
+        if raw:
+            # the child writes to our own pipe, which we read directly
+            read_fd, write_fd = os.pipe()
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    command,
+                    *args,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=write_fd,
+                    stderr=write_fd,
+                    start_new_session=True,
+                    preexec_fn=rlimit_setter(cpu_limit, memory_limit),
+                )
+            except Exception:
+                os.close(read_fd)
+                raise
+            finally:
+                os.close(write_fd)
+            return RawProcess(proc, read_fd, timeout=timeout)
+
+        proc = await asyncio.create_subprocess_exec(
+            command,
+            *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+            preexec_fn=rlimit_setter(cpu_limit, memory_limit),
+        )
+        return AsyncioProcess(proc, proc.stdout, timeout=timeout)
+
+
+class PtyReaderProtocol(asyncio.StreamReaderProtocol):
+    """
+    Reading a PTY master after the child exits fails with EIO, which is just
+    how a PTY signals EOF. Treat it as such, so that output still buffered in
+    the reader is not discarded along with the error.
+    """
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if isinstance(exc, OSError) and exc.errno == errno.EIO:
+            exc = None
+        super().connection_lost(exc)
+
+
+class PtyBackend(ProcessBackend):
+    """
+    Spawn subprocesses attached to a pseudo-terminal, like pexpect does, so
+    that programs line-buffer their output, but read the PTY master through
+    the event loop instead of blocking on it.
+    """
+
+    name = "pty"
+
+    async def spawn(
+        self,
+        command: str,
+        args: List[str],
+        timeout: Optional[float] = None,
+        cpu_limit: Optional[int] = None,
+        memory_limit: Optional[int] = None,
+        raw: bool = False,
+    ) -> Process:
+        loop = asyncio.get_running_loop()
+        master, slave = pty.openpty()
+        try:
+            if raw:
+                # pass output through as is, without turning newlines into
+                # CRLFs, so that binary output comes through intact
+                tty.setraw(slave)
+            proc = await asyncio.create_subprocess_exec(
+                command,
+                *args,
+                stdin=slave,
+                stdout=slave,
+                stderr=slave,
+                start_new_session=True,
+                preexec_fn=rlimit_setter(cpu_limit, memory_limit),
+            )
+        except Exception:
+            os.close(master)
+            raise
+        finally:
+            # only the child holds the slave side open, so that reading the
+            # master hits EOF (EIO) as soon as the child exits.
+            os.close(slave)
+
+        if raw:
+            return RawProcess(proc, master, timeout=timeout)
+
+        reader = asyncio.StreamReader(loop=loop)
+        protocol = PtyReaderProtocol(reader, loop=loop)
+        await loop.connect_read_pipe(
+            lambda: protocol, os.fdopen(master, "rb", buffering=0)
+        )
+        return AsyncioProcess(proc, reader, timeout=timeout)
+
+
+class PexpectProcess(Process):
+    def __init__(self, child: pexpect.spawn) -> None:
+        super().__init__(child.pid, timeout=child.timeout)
+        self._child = child
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._child.exitstatus
+
+    async def readline(self) -> str:
+        return self._child.readline()
+
+    async def wait(self) -> Optional[int]:
+        self._child.close()
+        return self._child.exitstatus
+
+
+class PexpectBackend(ProcessBackend):
+    """
+    Legacy backend that reads output with a blocking `pexpect.spawn.readline`
+    call. Every read blocks the event loop, so it is only kept for
+    benchmarking against the non-blocking backends.
+    """
+
+    name = "pexpect"
+
+    async def spawn(
+        self,
+        command: str,
+        args: List[str],
+        timeout: Optional[float] = None,
+        cpu_limit: Optional[int] = None,
+        memory_limit: Optional[int] = None,
+        raw: bool = False,
+    ) -> Process:
+        if raw:
+            raise ValueError("the pexpect backend can't read raw output")
+        # pexpect starts children in new sessions already
+        child = pexpect.spawn(
+            command,
+            args,
+            timeout=timeout,
+            encoding="utf-8",
+            preexec_fn=rlimit_setter(cpu_limit, memory_limit),
+        )
+        return PexpectProcess(child)
+
+
+BACKENDS: Dict[str, Type[ProcessBackend]] = {
+    backend_type.name: backend_type
+    for backend_type in (PipeBackend, PtyBackend, PexpectBackend)
+}
+
+
+def get_backend(name: str) -> ProcessBackend:
+    backend_type = BACKENDS.get(name)
+    if backend_type is None:
+        raise ValueError(f"unrecognized process backend: {name}")
+    return backend_type()
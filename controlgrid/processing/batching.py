@@ -0,0 +1,61 @@
+from typing import Dict, Optional
+
+
+class BatchStats:
+    """
+    Counts of batch flushes for a stream, by the limit that triggered them:
+
+    - "lines": the batch reached its max number of events,
+    - "bytes": the batch reached its max size,
+    - "latency": the oldest event in the batch reached its max age,
+    - "result": a job finished, which is flushed right away.
+
+    Stats are kept for as long as the stream is being run in this process,
+    and dropped with its hub, or when a worker runs out of its jobs.
+    """
+
+    reasons = ("lines", "bytes", "latency", "result")
+
+    _instances: Dict[str, "BatchStats"] = {}
+
+    def __init__(self, stream_name: str) -> None:
+        self.stream_name = stream_name
+        self.flushes: Dict[str, int] = dict.fromkeys(self.reasons, 0)
+        self.events = 0
+        self.bytes = 0
+
+    @classmethod
+    def get(cls, stream_name: str) -> "BatchStats":
+        stats = cls._instances.get(stream_name)
+        if stats is None:
+            stats = cls._instances[stream_name] = cls(stream_name)
+        return stats
+
+    @classmethod
+    def find(cls, stream_name: str) -> Optional["BatchStats"]:
+        return cls._instances.get(stream_name)
+
+    @classmethod
+    def remove(cls, stream_name: str) -> None:
+        # once the stream is no longer being run here
+        cls._instances.pop(stream_name, None)
+
+    @classmethod
+    def all(cls) -> Dict[str, "BatchStats"]:
+        return dict(cls._instances)
+
+    def record(self, reason: str, events: int, size: int) -> None:
+        self.flushes[reason] += 1
+        self.events += events
+        self.bytes += size
+
+    def dict(self) -> dict:
+        total = sum(self.flushes.values())
+        return {
+            "stream": self.stream_name,
+            "flushes": dict(self.flushes, total=total),
+            "events": self.events,
+            "bytes": self.bytes,
+            "mean_events_per_flush": self.events / total if total else 0,
+            "mean_bytes_per_flush": self.bytes / total if total else 0,
+        }
@@ -0,0 +1,135 @@
+import asyncio
+
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from appyratus.json import JsonEncoder
+
+from controlgrid.constants import OverflowPolicy
+
+
+def gap_event(events: int, size: int) -> dict:
+    """
+    SSE event saying how many events, of how many bytes, were dropped.
+    """
+    data = JsonEncoder().encode({"events": events, "bytes": size})
+    return {"event": "gap", "data": data}
+
+
+class ClientBuffer:
+    """
+    Bounded queue of SSE events between a stream's producer and one client,
+    holding at most `max_events` events and about `max_bytes` of data. When
+    the client falls behind and the buffer is full, the overflow policy
+    decides what happens to the next event:
+
+    - "block": the producer waits for room, which in turn stops it from
+      reading job output, so that job subprocesses block on write,
+    - "drop_oldest": the oldest buffered events are dropped, and the client
+      gets a "gap" event, saying how much was dropped, before the next event,
+    - "disconnect": the buffer is closed, ending the client's stream.
+    """
+
+    def __init__(
+        self,
+        policy: str = OverflowPolicy.block,
+        max_events: int = 16,
+        max_bytes: int = 1 << 22,
+    ) -> None:
+        if policy not in OverflowPolicy.values():
+            raise ValueError(f"invalid overflow policy: {policy}")
+        self.policy = policy
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.close_reason: Optional[str] = None
+        self._events: Deque[Tuple[dict, int]] = deque()
+        self._size = 0
+        self._dropped_events = 0
+        self._dropped_bytes = 0
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    @property
+    def closed(self) -> bool:
+        return self.close_reason is not None
+
+    @property
+    def full(self) -> bool:
+        return len(self._events) >= self.max_events or (
+            self._size >= self.max_bytes
+        )
+
+    async def put(self, event: dict) -> bool:
+        """
+        Add an event to the buffer, applying the overflow policy if it's
+        full. Return False if the buffer is closed, in which case the
+        producer should stop.
+        """
+        while self.full and not self.closed:
+            if self.policy != OverflowPolicy.block:
+                break
+            self._writable.clear()
+            await self._writable.wait()
+        return self.put_nowait(event)
+
+    def put_nowait(self, event: dict) -> bool:
+        """
+        Add an event to the buffer without waiting for room. Return False if
+        the event wasn't added, because the buffer is closed, or because it's
+        full and the policy is "block".
+        """
+        if self.full and not self.closed:
+            if self.policy == OverflowPolicy.block:
+                return False
+            elif self.policy == OverflowPolicy.drop_oldest:
+                while self._events and self.full:
+                    _, size = self._events.popleft()
+                    self._size -= size
+                    self._dropped_events += 1
+                    self._dropped_bytes += size
+            else:
+                # no point in sending what's left to a client this far behind
+                self._events.clear()
+                self._size = 0
+                self.close("client is too slow")
+
+        if self.closed:
+            return False
+
+        size = len(event.get("data", ""))
+        self._events.append((event, size))
+        self._size += size
+        self._readable.set()
+        return True
+
+    async def get(self) -> Optional[dict]:
+        """
+        Get the next event, waiting for one if the buffer is empty. Return
+        None once the buffer is closed and has been drained.
+        """
+        while not self._events:
+            if self.closed:
+                return None
+            self._readable.clear()
+            await self._readable.wait()
+
+        if self._dropped_events:
+            return self._pop_gap()
+
+        event, size = self._events.popleft()
+        self._size -= size
+        self._writable.set()
+        return event
+
+    def close(self, reason: str = "closed") -> None:
+        if self.close_reason is None:
+            self.close_reason = reason
+        self._readable.set()
+        self._writable.set()
+
+    def _pop_gap(self) -> dict:
+        event = gap_event(self._dropped_events, self._dropped_bytes)
+        self._dropped_events = 0
+        self._dropped_bytes = 0
+        return event
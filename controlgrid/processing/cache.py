@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import json
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from controlgrid import metrics
+
+
+def cache_key(command: str, args: list, *extra: Any) -> str:
+    """
+    Hash a command and its arguments, along with anything else that should
+    tell apart otherwise identical requests, like a caller's own key.
+    """
+    data = json.dumps([command, args, *extra], separators=(",", ":"))
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Process-local cache of the results of idempotent commands, by
+    `cache_key`, each kept for its own TTL. Up to `max_size` results are
+    kept, evicting the least recently used.
+
+    Identical requests made while the first is still running share it,
+    through `run`, instead of each running the command again.
+    """
+
+    _instance: Optional["ResultCache"] = None
+
+    def __init__(self, max_size: int = 1000) -> None:
+        self.max_size = max_size
+        # key -> (result, monotonic time it expires at)
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._running: Dict[str, asyncio.Future] = {}
+        self._requests = {
+            outcome: metrics.RESULT_CACHE_REQUESTS.labels(outcome)
+            for outcome in ("hit", "shared", "miss")
+        }
+
+    @classmethod
+    def get(cls) -> "ResultCache":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, key: str, stale: bool = False) -> Optional[Any]:
+        """
+        Get a cached result, or None. Expired results are dropped, unless
+        `stale` is set, in which case they're returned too.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic() and not stale:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: str, result: Any, ttl: float) -> None:
+        self._entries[key] = (result, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def record(self, outcome: str) -> None:
+        # "hit", "shared" or "miss", for requests that don't go through `run`
+        self._requests[outcome].inc()
+
+    async def run(
+        self,
+        key: str,
+        ttl: float,
+        func: Callable[[], Awaitable[Any]],
+        cacheable: Callable[[Any], bool] = lambda result: True,
+    ) -> Any:
+        """
+        Return the cached result for a key, or await the call already in
+        flight for it, or else call `func` and cache what it returns for
+        `ttl` seconds, if it's `cacheable`.
+
+        The call runs in its own task, so that a caller going away doesn't
+        cancel it for the others sharing it.
+        """
+        result = self.lookup(key)
+        if result is not None:
+            self.record("hit")
+            return result
+
+        future = self._running.get(key)
+        if future is None:
+            self.record("miss")
+            future = self._running[key] = asyncio.ensure_future(func())
+            future.add_done_callback(
+                lambda done: self._on_done(key, ttl, cacheable, done)
+            )
+        else:
+            self.record("shared")
+        return await asyncio.shield(future)
+
+    def _on_done(
+        self,
+        key: str,
+        ttl: float,
+        cacheable: Callable[[Any], bool],
+        future: asyncio.Future,
+    ) -> None:
+        if self._running.get(key) is future:
+            del self._running[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        if cacheable(result):
+            self.put(key, result, ttl)
@@ -0,0 +1,58 @@
+from typing import Optional, Tuple
+
+from controlgrid.processing.backends import Process
+
+
+class LineChunker:
+    """
+    Reads the raw output of a process into one reusable buffer, returning
+    it a chunk of whole lines at a time, as bytes. Lines are found with
+    `bytearray.rfind` and counted with `bytearray.count`, without splitting
+    them or decoding them, which is left to whoever needs to.
+
+    The partial line at the end of a chunk is moved to the start of the
+    buffer, to be completed by the next read. A line longer than the buffer
+    is returned in pieces, each counted as a line.
+    """
+
+    def __init__(self, process: Process, buffer_size: int = 1 << 18):
+        self._process = process
+        self._buffer = bytearray(max(1, buffer_size))
+        self._view = memoryview(self._buffer)
+        # size of the partial line at the start of the buffer
+        self._size = 0
+
+    async def read(self) -> Optional[Tuple[bytes, int]]:
+        """
+        Return the next chunk of output, and its number of lines, or None
+        once the process has closed its output.
+        """
+        buffer = self._buffer
+        view = self._view
+        while True:
+            start = self._size
+            size = await self._process.readinto(view[start:])
+            if not size:
+                if not start:
+                    return None
+                # the last line, without a newline
+                self._size = 0
+                return bytes(view[:start]), 1
+
+            end = start + size
+            # the partial line before `start` has no newline
+            split = buffer.rfind(b"\n", start, end) + 1
+            if not split:
+                if end < len(buffer):
+                    self._size = end
+                    continue
+                split = end
+
+            chunk = bytes(view[:split])
+            count = buffer.count(b"\n", 0, split)
+            if buffer[split - 1] != 10:
+                count += 1
+            rest = end - split
+            view[:rest] = view[split:end]
+            self._size = rest
+            return chunk, count
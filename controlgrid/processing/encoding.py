@@ -0,0 +1,161 @@
+import base64
+
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import rapidjson
+
+from appyratus.json import JsonEncoder
+
+from controlgrid.constants import OutputFormat
+from controlgrid.db.models import Job, JobStreamEvent
+
+
+class OutputLine:
+    """
+    Lightweight stand-in for a `JobStreamEvent` carrying a `JobOutput` line,
+    used on the hot path of streaming job output.
+    """
+
+    __slots__ = ("job", "timestamp", "line_no", "text", "fields")
+
+    def __init__(
+        self,
+        job: Job,
+        timestamp: int,
+        line_no: int,
+        text: str,
+        fields: Optional[dict] = None,
+    ):
+        self.job = job
+        self.timestamp = timestamp
+        self.line_no = line_no
+        self.text = text
+        # parsed out of the text by an output pipeline, if any
+        self.fields = fields
+
+    def to_event(self) -> JobStreamEvent:
+        return JobStreamEvent.parse_obj(
+            {
+                "result": None,
+                "line": {
+                    "job_id": self.job.job_id,
+                    "tag": self.job.tag,
+                    "timestamp": self.timestamp,
+                    "data": {
+                        "line_no": self.line_no,
+                        "text": self.text,
+                        "fields": self.fields,
+                    },
+                    "pid": self.job.pid,
+                },
+            }
+        )
+
+
+class OutputBlock:
+    """
+    Chunk of a job's raw output, of `line_count` lines starting at line
+    `line_no`, streamed as one event instead of a line at a time. Its data
+    is only decoded, or base64 encoded, by the `BatchEncoder`, as the job's
+    `output_format` says.
+    """
+
+    __slots__ = ("job", "timestamp", "line_no", "line_count", "data")
+
+    def __init__(
+        self,
+        job: Job,
+        timestamp: int,
+        line_no: int,
+        line_count: int,
+        data: bytes,
+    ):
+        self.job = job
+        self.timestamp = timestamp
+        self.line_no = line_no
+        self.line_count = line_count
+        self.data = data
+
+
+StreamEvent = Union[OutputLine, OutputBlock, JobStreamEvent]
+
+
+class BatchEncoder:
+    """
+    Encodes batches of stream events to JSON, byte for byte the same as
+    `JsonEncoder().encode([event.dict() for event in batch])`, with the
+    "fields" of lines left out when they have none. Output lines are
+    formatted into JSON templated per job, so only the text of each line
+    goes through the JSON encoder. Other events take the generic path.
+
+    Output blocks, which have no model, are encoded as:
+
+        {"result": null, "line": null, "block": {"job_id": ..., "tag": ...,
+         "timestamp": ..., "line_no": ..., "line_count": ..., "pid": ...,
+         "encoding": "utf-8" or "base64", "data": ...}}
+    """
+
+    def __init__(self) -> None:
+        self._json = JsonEncoder()
+        # job ID -> (JSON before the timestamp, JSON after the text)
+        self._templates: Dict[str, Tuple[str, str]] = {}
+
+    def encode(self, batch: Iterable[StreamEvent]) -> str:
+        dumps = rapidjson.dumps
+        templates = self._templates
+        parts: List[str] = []
+        for event in batch:
+            if event.__class__ is OutputLine:
+                template = templates.get(event.job.job_id)
+                if template is None:
+                    template = self._add_template(event.job)
+                text = dumps(event.text)
+                if event.fields is not None:
+                    text = f'{text},"fields":{dumps(event.fields)}'
+                parts.append(
+                    f'{template[0]}{event.timestamp},"data":{{"line_no":'
+                    f'{event.line_no},"text":{text}}}{template[1]}'
+                )
+            elif event.__class__ is OutputBlock:
+                parts.append(self._encode_block(event))
+            else:
+                if event.result is not None:
+                    # the job is done. its template is no longer needed
+                    templates.pop(event.result.job.job_id, None)
+                parts.append(self._json.encode(event.dict()))
+        return f"[{','.join(parts)}]"
+
+    def _encode_block(self, block: OutputBlock) -> str:
+        job = block.job
+        if job.output_format == OutputFormat.base64:
+            encoding = "base64"
+            # base64 is plain ASCII, with nothing to escape
+            data = f'"{base64.b64encode(block.data).decode("ascii")}"'
+        else:
+            encoding = "utf-8"
+            data = rapidjson.dumps(
+                block.data.decode("utf-8", errors="replace")
+            )
+        return (
+            f'{{"result":null,"line":null,"block":{{"job_id":'
+            f'{self._dump(job.job_id)},"tag":{self._dump(job.tag)},'
+            f'"timestamp":{block.timestamp},"line_no":{block.line_no},'
+            f'"line_count":{block.line_count},"pid":{self._dump(job.pid)},'
+            f'"encoding":"{encoding}","data":{data}}}}}'
+        )
+
+    def forget(self, job_id: str) -> None:
+        self._templates.pop(job_id, None)
+
+    def _add_template(self, job: Job) -> Tuple[str, str]:
+        # the pid is part of the template, so it must already be set
+        template = (
+            f'{{"result":null,"line":{{"job_id":{self._dump(job.job_id)},'
+            f'"tag":{self._dump(job.tag)},"timestamp":',
+            f',"pid":{self._dump(job.pid)}}}}}',
+        )
+        self._templates[job.job_id] = template
+        return template
+
+    def _dump(self, value: Optional[Union[str, int]]) -> str:
+        return self._json.encode(value)
@@ -0,0 +1,199 @@
+import asyncio
+
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Set
+
+from appyratus.logging import ConsoleLoggerInterface
+
+from controlgrid.processing.batching import BatchStats
+from controlgrid.processing.buffers import ClientBuffer
+from controlgrid.processing.notifier import JobNotifier
+from controlgrid.processing.streamer import Streamer
+from controlgrid.processing.worker import OutputRelay
+
+
+class StreamHub:
+    """
+    Runs a single `Streamer` for a stream name and broadcasts each encoded
+    batch to every subscribed client buffer, so that any number of clients
+    watching a stream share one producer and one encoding of its output.
+
+    The last `history` batches are kept for clients that join late. The
+    producer starts with the first subscriber, and the hub is torn down when
+    the last one leaves.
+
+    With an `OutputRelay`, jobs are run by worker processes instead, and the
+    hub broadcasts the batches they publish for the stream.
+    """
+
+    _instances: Dict[str, "StreamHub"] = {}
+
+    def __init__(
+        self,
+        stream_name: str,
+        streamer: Streamer,
+        notifier: JobNotifier,
+        poll_interval: Optional[float] = None,
+        history: int = 16,
+        relay: Optional[OutputRelay] = None,
+    ) -> None:
+        self.stream_name = stream_name
+        self.streamer = streamer
+        self._notifier = notifier
+        self._relay = relay
+        # worker ID -> ID of the last batch relayed from the worker
+        self._worker_event_ids: Dict[str, str] = {}
+        self._poll_interval = poll_interval
+        self._history: Deque[dict] = deque(maxlen=max(0, history))
+        self._subscribers: Set[ClientBuffer] = set()
+        self._watchers: Set[asyncio.Event] = set()
+        self._producer: Optional[asyncio.Task] = None
+        self._log = ConsoleLoggerInterface(f"hub[{stream_name}]")
+
+    @classmethod
+    def get(
+        cls, stream_name: str, factory: Callable[[], "StreamHub"]
+    ) -> "StreamHub":
+        """
+        Get the running hub for the stream name, or create one with the
+        given factory.
+        """
+        hub = cls._instances.get(stream_name)
+        if hub is None:
+            hub = cls._instances[stream_name] = factory()
+        return hub
+
+    @classmethod
+    def find(cls, stream_name: str) -> Optional["StreamHub"]:
+        """
+        Get the running hub for the stream name, if there is one.
+        """
+        return cls._instances.get(stream_name)
+
+    @classmethod
+    def all(cls) -> Dict[str, "StreamHub"]:
+        return dict(cls._instances)
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self, buffer: ClientBuffer, history: bool = True) -> None:
+        """
+        Start sending batches to the buffer, beginning with as much of the
+        recent history as fits in it, if `history` is set.
+        """
+        if history:
+            for event in list(self._history)[-buffer.max_events :]:
+                if not buffer.put_nowait(event):
+                    break
+
+        self._subscribers.add(buffer)
+        if self._producer is None:
+            self._producer = asyncio.create_task(self._produce())
+
+    def watch(self, event: asyncio.Event) -> None:
+        """
+        Set the event whenever a batch is broadcast, and when the hub is torn
+        down. Unlike subscribers, watchers don't keep the hub running.
+        """
+        self._watchers.add(event)
+
+    def unwatch(self, event: asyncio.Event) -> None:
+        self._watchers.discard(event)
+
+    def unsubscribe(self, buffer: ClientBuffer) -> None:
+        buffer.close()
+        self._subscribers.discard(buffer)
+        if not self._subscribers:
+            self._close()
+
+    async def stop(self) -> None:
+        """
+        End the streams of all subscribers and wait for the producer to
+        finish, e.g. on shutdown.
+        """
+        producer = self._producer
+        for buffer in list(self._subscribers):
+            buffer.close()
+        self._subscribers.clear()
+        self._close()
+        if producer is not None:
+            await asyncio.gather(producer, return_exceptions=True)
+
+    async def _produce(self) -> None:
+        try:
+            if self._relay is not None:
+                await self._produce_from_relay()
+                return
+
+            generation = None
+            while True:
+                # sleep until a new job is created for this stream, unless
+                # one was created while the last batch of jobs was running.
+                if generation == self._notifier.generation(self.stream_name):
+                    await self._notifier.wait(
+                        self.stream_name,
+                        generation,
+                        timeout=self._poll_interval,
+                    )
+                generation = self._notifier.generation(self.stream_name)
+                batches = self.streamer.generate()
+                try:
+                    async for batch in batches:
+                        event = {"id": self.streamer.event_id, "data": batch}
+                        if not await self._broadcast(event):
+                            return
+                finally:
+                    await batches.aclose()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self._log.exception("error producing stream events")
+        finally:
+            for buffer in list(self._subscribers):
+                buffer.close()
+            self._close()
+
+    async def _produce_from_relay(self) -> None:
+        queue = self._relay.listen(self.stream_name)
+        try:
+            while True:
+                message = await queue.get()
+                # batches dropped before this one, while the hub was behind
+                gap = self._relay.pop_gap(self.stream_name)
+                if gap is not None and not await self._broadcast(gap):
+                    return
+                # each worker's event ID covers the jobs it's running, so
+                # merge them to cover the jobs of the whole stream
+                ids = self._worker_event_ids
+                ids[message["worker_id"]] = message["id"]
+                if not message["id"]:
+                    del ids[message["worker_id"]]
+                event = {"id": ",".join(ids.values()), "data": message["data"]}
+                if not await self._broadcast(event):
+                    return
+        finally:
+            self._relay.unlisten(self.stream_name)
+
+    async def _broadcast(self, event: dict) -> bool:
+        # the batch is encoded once. each subscriber just gets a reference.
+        # return False once there's no one left to send it to.
+        self._history.append(event)
+        for watcher in self._watchers:
+            watcher.set()
+        for buffer in list(self._subscribers):
+            if not await buffer.put(event):
+                self._subscribers.discard(buffer)
+        return bool(self._subscribers)
+
+    def _close(self) -> None:
+        if self._instances.get(self.stream_name) is self:
+            del self._instances[self.stream_name]
+            BatchStats.remove(self.stream_name)
+        for watcher in self._watchers:
+            watcher.set()
+        self._watchers.clear()
+        producer = self._producer
+        if producer is not None and producer is not asyncio.current_task():
+            producer.cancel()
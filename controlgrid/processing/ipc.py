@@ -1,66 +1,297 @@
 from collections import deque
+import asyncio
 import pickle
+import struct
+import time
 
 import zmq
-
-from queue import Queue, Empty
-from threading import Thread
-from typing import Any, Callable, Deque, Iterator, Optional
+import zmq.asyncio
+
+from itertools import count
+from threading import Condition, Thread
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from appyratus.utils.type_utils import TypeUtils
 
+from controlgrid import metrics
+from controlgrid.constants import DropPolicy
 from controlgrid.log import log
+from controlgrid.processing.serializers import Serializer, get_serializer
+
+# request and reply messages are multipart: [request ID, kind, payload]. the
+# kind says how to read the payload: as a serialized object, as raw bytes,
+# which are sent as is, without copying, or as an error message.
+OBJECT = b"o"
+BYTES = b"b"
+ERROR = b"e"
+
+Frames = List[Union[bytes, zmq.Frame]]
+
+
+class RemoteError(Exception):
+    """
+    Raised by IPC clients when handling their request failed in the service.
+    """
+
+
+def pack(request_id: bytes, data: Any, serializer: Serializer) -> Frames:
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return [request_id, BYTES, data]
+    return [request_id, OBJECT, serializer.dumps(data)]
+
+
+def unpack(frames: Frames, serializer: Serializer) -> Tuple[bytes, Any]:
+    """
+    Read a message received with `copy=False`, returning its request ID and
+    data. Raw bytes payloads are returned as memoryviews of the received
+    frame. Error messages are raised as `RemoteError`.
+    """
+    request_id, kind, payload = frames
+    request_id = request_id.bytes
+    kind = kind.bytes
+    if kind == BYTES:
+        return request_id, payload.buffer
+    elif kind == ERROR:
+        raise RemoteError(payload.bytes.decode("utf-8", errors="replace"))
+    return request_id, serializer.loads(payload.buffer)
 
 
 class Service(Thread):
+    """
+    IPC request handler. Requests arrive on a ROUTER socket and are handed
+    out to a pool of `workers` threads, so that a slow handler doesn't hold
+    up other requests, and clients can have many requests in flight at once.
+
+    Each request goes to every route whose rule matches it, in order, and
+    the response of the last one is sent back.
+
+    Messages are serialized with msgpack by default. Bytes payloads skip the
+    serializer and are sent as is. Pass `serializer="pickle"` to talk to
+    clients that send arbitrary Python objects.
+    """
+
     def __init__(
         self,
         addr: str,
         context: Optional[zmq.Context] = None,
+        workers: int = 4,
+        serializer: Union[str, Serializer] = "msgpack",
     ) -> None:
         super().__init__(daemon=True)
         self._addr = addr
         self._context = context or zmq.Context()
         self._routes: dict = {}
+        self._workers = max(1, workers)
+        self._serializer = get_serializer(serializer)
+        self._backend_addr = f"inproc://controlgrid-service-{id(self)}"
 
     def run(self):
+        frontend: zmq.Socket = self._context.socket(zmq.ROUTER)
+        frontend.bind(self._addr)
+        backend: zmq.Socket = self._context.socket(zmq.DEALER)
+        backend.bind(self._backend_addr)
+
+        for _ in range(self._workers):
+            Thread(target=self._work, daemon=True).start()
+
+        # shuttle requests to workers and their replies back to clients
+        zmq.proxy(frontend, backend)
+
+    def add_route(self, rule: Callable, callback: Callable):
+        self._routes[rule] = callback
+
+    def _work(self) -> None:
         socket: zmq.Socket = self._context.socket(zmq.REP)
-        socket.bind(self._addr)
+        socket.connect(self._backend_addr)
+        succeeded = metrics.IPC_REQUESTS.labels("ok")
+        failed = metrics.IPC_REQUESTS.labels("error")
 
         while True:
+            frames = socket.recv_multipart(copy=False)
+            start = time.perf_counter()
+            request_id = frames[0].bytes
             try:
                 # route request to appropriate handler
                 # to generate a response
                 response = None
-                request = pickle.loads(socket.recv())
-                for rule, callback in self._routes.items():
+                _, request = unpack(frames, self._serializer)
+                for rule, callback in list(self._routes.items()):
                     if rule(request):
                         response = callback(request)
-                # pickle and send response
-                response = pickle.dumps(response)
-                socket.send(response)
-            except Exception:
-                log.exception("failed to read from registration socket")
-
-    def add_route(self, rule: Callable, callback: Callable):
-        self._routes[rule] = callback
+                reply = pack(request_id, response, self._serializer)
+                succeeded.value += 1
+            except Exception as exc:
+                log.exception("failed to handle IPC request")
+                reply = [request_id, ERROR, repr(exc).encode("utf-8")]
+                failed.value += 1
+            socket.send_multipart(reply, copy=False)
+            metrics.IPC_REQUEST_SECONDS.observe(time.perf_counter() - start)
 
 
 class Client:
+    """
+    Blocking client of a `Service`. Requests can be pipelined, by sending
+    several before receiving their responses:
+
+    ```python
+    request_ids = [client.send(data) for data in requests]
+    responses = [client.receive(request_id) for request_id in request_ids]
+    ```
+
+    Clients are not thread-safe. Use one per thread.
+    """
+
     def __init__(
         self,
         addr: str,
         context: Optional[zmq.Context] = None,
+        serializer: Union[str, Serializer] = "msgpack",
     ) -> None:
         self._addr = addr
         self._context = context or zmq.Context()
-        self._socket = self._context.socket(zmq.REQ)
+        self._serializer = get_serializer(serializer)
+        self._socket = self._context.socket(zmq.DEALER)
         self._socket.connect(self._addr)
+        self._ids = count()
+        # IDs of requests sent but not yet received
+        self._pending: Set[bytes] = set()
+        # request ID -> (response, error), for responses that came early
+        self._responses: Dict[bytes, Tuple[Any, Optional[Exception]]] = {}
+
+    def request(self, data: Any, timeout: Optional[float] = None) -> Any:
+        return self.receive(self.send(data), timeout=timeout)
+
+    def send(self, data: Any) -> bytes:
+        """
+        Send a request without waiting for its response. Return its ID, to
+        be passed to `receive`.
+        """
+        request_id = struct.pack("!Q", next(self._ids))
+        frames = pack(request_id, data, self._serializer)
+        # the empty frame stands in for the envelope a REQ socket would add
+        self._socket.send_multipart([b""] + frames, copy=False)
+        self._pending.add(request_id)
+        return request_id
+
+    def receive(self, request_id: bytes, timeout: Optional[float] = None):
+        """
+        Wait for the response to the given request, buffering responses to
+        other requests that arrive first.
+        """
+        timeout_ms = None if timeout is None else int(timeout * 1000)
+        while request_id not in self._responses:
+            if timeout_ms is not None and not self._socket.poll(timeout_ms):
+                self._pending.discard(request_id)
+                raise TimeoutError(f"no response to IPC request in {timeout}s")
+            frames = self._socket.recv_multipart(copy=False)[1:]
+            try:
+                received_id, response = unpack(frames, self._serializer)
+                error = None
+            except RemoteError as exc:
+                received_id, response, error = frames[0].bytes, None, exc
+            # drop late responses to requests that timed out
+            if received_id in self._pending:
+                self._responses[received_id] = (response, error)
+
+        self._pending.discard(request_id)
+        response, error = self._responses.pop(request_id)
+        if error is not None:
+            raise error
+        return response
+
+    def close(self) -> None:
+        self._socket.close(linger=0)
 
-    def request(self, data: Any) -> Any:
-        request = pickle.dumps(data)
-        self._socket.send(request)
-        return pickle.loads(self._socket.recv())
+
+class AsyncClient:
+    """
+    Asyncio client of a `Service`. Any number of requests can be in flight
+    at once, from concurrent tasks, with responses matched up to requests by
+    their IDs.
+    """
+
+    def __init__(
+        self,
+        addr: str,
+        context: Optional[zmq.asyncio.Context] = None,
+        serializer: Union[str, Serializer] = "msgpack",
+    ) -> None:
+        self._addr = addr
+        self._context = context or zmq.asyncio.Context.instance()
+        self._serializer = get_serializer(serializer)
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.connect(self._addr)
+        self._ids = count()
+        self._pending: Dict[bytes, asyncio.Future] = {}
+        self._reader: Optional[asyncio.Task] = None
+
+    async def request(self, data: Any, timeout: Optional[float] = None):
+        request_id = struct.pack("!Q", next(self._ids))
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        if self._reader is None or self._reader.done():
+            self._reader = asyncio.create_task(self._read())
+        try:
+            frames = pack(request_id, data, self._serializer)
+            await self._socket.send_multipart([b""] + frames, copy=False)
+            if timeout is None:
+                return await future
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def close(self) -> None:
+        if self._reader is not None:
+            self._reader.cancel()
+        self._socket.close(linger=0)
+
+    async def _read(self) -> None:
+        socket = self._socket
+        try:
+            while True:
+                frames = await socket.recv_multipart(copy=False)
+                self._resolve(frames[1:])
+                # drain whatever else has arrived without going back through
+                # the event loop for each response
+                while True:
+                    try:
+                        frames = socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                        frames = frames.result()
+                    except zmq.Again:
+                        break
+                    self._resolve(frames[1:])
+        except Exception as exc:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(exc)
+            raise
+
+    def _resolve(self, frames: Frames) -> None:
+        try:
+            request_id, response = unpack(frames, self._serializer)
+            error = None
+        except RemoteError as exc:
+            request_id, response, error = frames[0].bytes, None, exc
+        future = self._pending.get(request_id)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(response)
 
 
 class Channel:
@@ -78,22 +309,35 @@ class Channel:
     channel = Channel(addr)
     subscription = channel.subscribe()
 
-    while True:
-        obj = subscription.receive()
+    for obj in subscription:
         print(obj)
     ```
 
+    By default, the publisher binds the address and subscribers connect to
+    it, so there can only be one publisher. For many publishers and one
+    subscriber, set `bind_subscriber`, so that the subscriber binds it
+    instead. For many of both, set `publish_addr`: publishers connect to it
+    and subscribers to `addr`, and a `Forwarder` binds both.
+
+    Messages are serialized with msgpack by default. Pass
+    `serializer="pickle"` to send arbitrary Python objects, but only between
+    trusted processes, as subscribers unpickle whatever they receive.
     """
 
     def __init__(
-        self, addr: str, context: Optional[zmq.Context] = None
+        self,
+        addr: str,
+        context: Optional[zmq.Context] = None,
+        serializer: Union[str, Serializer] = "msgpack",
+        bind_subscriber: bool = False,
+        publish_addr: Optional[str] = None,
     ) -> None:
         self._addr = addr
         self._zmq_context = context or zmq.Context()
+        self._serializer = get_serializer(serializer)
+        self._bind_subscriber = bind_subscriber
+        self._publish_addr = publish_addr
         self._pub_socket: zmq.Socket = None
-        self._sub_socket: zmq.Socket = None
-        self._recv_queue: Queue = Queue()
-        self._recv_thread: Thread
 
     def __repr__(self) -> str:
         return f"{TypeUtils.get_class_name(self)}({self._addr})"
@@ -103,69 +347,263 @@ class Channel:
         return self._addr
 
     def serialize(self, data: Any) -> bytes:
-        return pickle.dumps(data)
+        return self._serializer.dumps(data)
 
     def deserialize(self, data: bytes) -> Any:
-        return pickle.loads(data)
+        return self._serializer.loads(data)
 
-    def publish(self, data: Any):
+    def publish(self, data: Any, topic: str = ""):
+        """
+        Publish a message under the given topic, to subscribers of any
+        prefix of it.
+        """
         # lazy bind publisher socket
         if self._pub_socket is None:
             self._pub_socket = self._zmq_context.socket(zmq.PUB)
-            self._pub_socket.bind(self._addr)
-
-        # serialize and send
+            if self._publish_addr:
+                self._pub_socket.connect(self._publish_addr)
+            elif self._bind_subscriber:
+                self._pub_socket.connect(self._addr)
+            else:
+                self._pub_socket.bind(self._addr)
+
+        # serialize and send, with the topic in its own frame, so that
+        # ZMQ can filter on it before the payload is ever deserialized
         payload = self.serialize(data)
-        self._pub_socket.send(payload)
+        self._pub_socket.send_multipart([topic.encode("utf-8"), payload])
 
-    def subscribe(self, callback: Optional[Callable] = None) -> "Subscription":
+    def subscribe(
+        self,
+        callback: Optional[Callable] = None,
+        max_queue_size: int = 10000,
+        drop_policy: str = DropPolicy.drop_oldest,
+        rcvhwm: Optional[int] = None,
+        topics: Iterable[str] = ("",),
+    ) -> "Subscription":
+        """
+        Start receiving messages published under topics that start with any
+        of the given prefixes, or all messages, by default. Filtering is done
+        by ZMQ, on the publisher's side, so that subscribers neither receive
+        nor deserialize other messages. Topics are matched by prefix, so end
+        them with a delimiter, like "job.abc.", to keep them distinct.
+
+        With a callback, messages are passed to it, from the subscription's
+        thread, and not buffered. Otherwise, see `Subscription` for how they
+        are buffered. `rcvhwm` sets how many messages ZMQ queues up for the
+        socket before dropping them.
+        """
         socket = self._zmq_context.socket(zmq.SUB)
-        socket.connect(self._addr)
-        socket.setsockopt_string(zmq.SUBSCRIBE, "")
-
-        sub = Subscription(socket, self.deserialize, callback=callback)
+        if rcvhwm is not None:
+            socket.setsockopt(zmq.RCVHWM, rcvhwm)
+        if self._bind_subscriber:
+            socket.bind(self._addr)
+        else:
+            socket.connect(self._addr)
+        for topic in topics:
+            socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+
+        sub = Subscription(
+            socket,
+            self.deserialize,
+            callback=callback,
+            max_queue_size=max_queue_size,
+            drop_policy=drop_policy,
+        )
         sub.start()
 
         return sub
 
 
+class Forwarder(Thread):
+    """
+    Relays messages from any number of publishers to any number of
+    subscribers of a `Channel` with a `publish_addr`. Publishers connect to
+    the XSUB socket bound at `publish_addr`, and subscribers to the XPUB
+    socket bound at `addr`. Subscriptions are passed upstream, so topics
+    are still filtered by the publishers.
+
+    Run exactly one per channel, such as with `controlgrid forwarder`.
+    """
+
+    def __init__(
+        self,
+        addr: str,
+        publish_addr: str,
+        context: Optional[zmq.Context] = None,
+    ) -> None:
+        super().__init__(daemon=True)
+        self._addr = addr
+        self._publish_addr = publish_addr
+        self._context = context or zmq.Context()
+
+    def run(self) -> None:
+        frontend: zmq.Socket = self._context.socket(zmq.XSUB)
+        backend: zmq.Socket = self._context.socket(zmq.XPUB)
+        try:
+            frontend.bind(self._publish_addr)
+            backend.bind(self._addr)
+            zmq.proxy(frontend, backend)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            frontend.close(linger=0)
+            backend.close(linger=0)
+
+
 class Subscription(Thread):
+    """
+    Receives messages from a SUB socket in a background thread. Messages are
+    passed to the callback, if there is one, and are otherwise buffered for
+    `receive`, `receive_many` or iteration, with or without asyncio.
+
+    The buffer holds up to `max_queue_size` messages. Once it's full, the
+    drop policy decides what happens to the next message:
+
+    - "drop_oldest": the oldest buffered message is dropped,
+    - "drop_newest": the new message is dropped,
+    - "block": receiving stops until there's room, leaving ZMQ to queue
+      messages up to the socket's high-water mark and drop the rest.
+
+    Dropped messages are counted in `dropped`.
+    """
+
     def __init__(
         self,
         socket: zmq.Socket,
         deserialize: Callable,
         callback: Optional[Callable] = None,
         unpack_callback_kwargs: bool = False,
+        max_queue_size: int = 10000,
+        drop_policy: str = DropPolicy.drop_oldest,
     ):
         super().__init__(daemon=True)
+        if drop_policy not in DropPolicy.values():
+            raise ValueError(f"invalid drop policy: {drop_policy}")
         self._socket = socket
         self._deserialize = deserialize
         self._queue: Deque[Any] = deque()
+        self._max_queue_size = max(1, max_queue_size)
+        self._drop_policy = drop_policy
+        self._cond = Condition()
+        # (loop, event) of asyncio consumers waiting for messages
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, Any]] = []
         self._callback = callback
         self._unpack_kwargs = unpack_callback_kwargs
+        self._closed = False
+        self.dropped = 0
 
-    def __iter__(self):
-        while self._queue:
-            yield self._queue.popleft()
+    def __iter__(self) -> Iterator[Any]:
+        """
+        Yield messages as they arrive, until the subscription is closed.
+        """
+        while True:
+            batch = self.receive_many(self._max_queue_size)
+            if not batch and self._closed:
+                return
+            yield from batch
 
-    def run(self):
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        loop = asyncio.get_running_loop()
         while True:
-            try:
-                data = self._socket.recv()
-                obj = self._deserialize(data)
-                self._queue.append(obj)
-                if self._callback is not None:
-                    if self._unpack_kwargs:
+            batch = self.receive_many(self._max_queue_size, timeout=0)
+            if batch:
+                for obj in batch:
+                    yield obj
+                continue
+            if self._closed:
+                return
+            event = asyncio.Event()
+            with self._cond:
+                if self._queue or self._closed:
+                    continue
+                self._async_waiters.append((loop, event))
+            await event.wait()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def run(self):
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        try:
+            while not self._closed:
+                try:
+                    # wake up now and then to check if we've been closed
+                    if not poller.poll(100):
+                        continue
+                    # messages are [topic, payload]
+                    data = self._socket.recv_multipart()[-1]
+                    metrics.IPC_MESSAGES_RECEIVED.inc()
+                    obj = self._deserialize(data)
+                    if self._callback is None:
+                        self._put(obj)
+                    elif self._unpack_kwargs:
                         self._callback(**obj)
                     else:
                         self._callback(obj)
-            except Exception:
-                log.exception("unhandled error in IPC subscription")
-
-    def receive(self, default=None) -> Any:
-        if self._queue:
-            return self._queue.popleft()
-        return default
+                except Exception:
+                    log.exception("unhandled error in IPC subscription")
+        finally:
+            self._socket.close(linger=0)
+
+    def receive(
+        self, timeout: Optional[float] = None, default: Any = None
+    ) -> Any:
+        """
+        Get the next message, waiting up to `timeout` seconds for one, or
+        forever if it's None. Return the default if none arrived in time.
+        """
+        batch = self.receive_many(1, timeout=timeout)
+        return batch[0] if batch else default
+
+    def receive_many(
+        self, max_n: int, timeout: Optional[float] = None
+    ) -> List[Any]:
+        """
+        Get up to `max_n` buffered messages, waiting up to `timeout` seconds
+        for at least one, or forever if it's None.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: self._queue or self._closed, timeout
+            ):
+                return []
+            queue = self._queue
+            batch = [queue.popleft() for _ in range(min(max_n, len(queue)))]
+            self._cond.notify_all()
+            return batch
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            self._wake_async_waiters()
+
+    def _put(self, obj: Any) -> None:
+        with self._cond:
+            if len(self._queue) >= self._max_queue_size:
+                if self._drop_policy == DropPolicy.block:
+                    self._cond.wait_for(
+                        lambda: len(self._queue) < self._max_queue_size
+                        or self._closed
+                    )
+                elif self._drop_policy == DropPolicy.drop_oldest:
+                    self._queue.popleft()
+                    self.dropped += 1
+                    metrics.IPC_MESSAGES_DROPPED.inc()
+                else:
+                    self.dropped += 1
+                    metrics.IPC_MESSAGES_DROPPED.inc()
+                    return
+            self._queue.append(obj)
+            self._cond.notify_all()
+            self._wake_async_waiters()
+
+    def _wake_async_waiters(self) -> None:
+        for loop, event in self._async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        self._async_waiters.clear()
 
 
 # Example Usage:
@@ -182,7 +620,10 @@ if __name__ == "__main__":
             sleep(0.5)
             print("publishing...")
             channel.publish(
-                {"timestamp": datetime.now(), "message": "Hello, subscriber!"}
+                {
+                    "timestamp": datetime.now().isoformat(),
+                    "message": "Hello, subscriber!",
+                }
             )
     elif side == "subscriber":
         subscription = channel.subscribe()
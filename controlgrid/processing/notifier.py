@@ -0,0 +1,141 @@
+import asyncio
+
+from collections import defaultdict
+from typing import Callable, Dict, Optional, Set
+from uuid import uuid4
+
+from appyratus.env import Environment
+
+from controlgrid.log import log
+from controlgrid.processing.ipc import Channel, Subscription
+
+
+def notify_channel(env: Environment) -> Optional[Channel]:
+    """
+    Channel between processes for job notifications, invalidations and
+    cancellations, if NOTIFY_CHANNEL_ADDR is set. Every process both
+    publishes and subscribes, so messages go through a forwarder, run with
+    `controlgrid forwarder`: published to NOTIFY_PUBLISH_ADDR and received
+    from NOTIFY_CHANNEL_ADDR.
+    """
+    addr = env.get("NOTIFY_CHANNEL_ADDR")
+    if not addr:
+        return None
+    publish_addr = env.get("NOTIFY_PUBLISH_ADDR")
+    if not publish_addr:
+        raise ValueError(
+            "NOTIFY_PUBLISH_ADDR must be set along with NOTIFY_CHANNEL_ADDR"
+        )
+    return Channel(addr, publish_addr=publish_addr)
+
+
+class JobNotifier:
+    """
+    Wakes up stream workers when new jobs are created for their stream, so
+    that idle streams don't have to poll the DB.
+
+    Each stream name has a generation counter, incremented on every
+    notification. A waiter remembers the generation it last saw and only
+    blocks if nothing has happened since, so notifications sent between
+    checking the DB and waiting are never missed.
+
+    If an IPC channel is given, notifications are also published to it and
+    received from it, so that jobs created in one process wake up streams in
+    others: see `notify_channel`. Notifications are published under
+    per-stream topics, so that other traffic on the channel isn't delivered
+    to the notifier.
+    """
+
+    topic_prefix = "notify.stream."
+
+    # pseudo stream name, notified along with every stream
+    ANY = "*"
+
+    def __init__(self, channel: Optional[Channel] = None) -> None:
+        self._id = uuid4().hex
+        self._channel = channel
+        self._subscription: Optional[Subscription] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._generations: Dict[str, int] = defaultdict(int)
+        self._events: Dict[str, asyncio.Event] = {}
+        self._listeners: Dict[str, Set[Callable]] = defaultdict(set)
+
+    def start(self) -> None:
+        """
+        Start receiving notifications from other processes, if there's an
+        IPC channel. Must be called from within the running event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        if self._channel is not None and self._subscription is None:
+            self._subscription = self._channel.subscribe(
+                callback=self._on_message, topics=[self.topic_prefix]
+            )
+
+    def generation(self, stream: str) -> int:
+        return self._generations[stream]
+
+    def notify(self, stream: str) -> None:
+        self._notify_local(stream)
+        if self._channel is not None:
+            # other processes still find the jobs when they next poll, so
+            # this mustn't fail whoever created them
+            try:
+                self._channel.publish(
+                    {"stream": stream, "source": self._id},
+                    topic=f"{self.topic_prefix}{stream}.",
+                )
+            except Exception:
+                log.exception(f"error publishing '{stream}' notification")
+
+    async def wait(
+        self, stream: str, generation: int, timeout: Optional[float] = None
+    ) -> bool:
+        """
+        Wait until the stream's generation moves past the given one. Return
+        False if it timed out first.
+        """
+        while self._generations[stream] == generation:
+            event = self._events.get(stream)
+            if event is None:
+                event = self._events[stream] = asyncio.Event()
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def add_listener(self, stream: str, callback: Callable) -> None:
+        """
+        Call the callback, without arguments, on each notification for the
+        given stream.
+        """
+        self._listeners[stream].add(callback)
+
+    def remove_listener(self, stream: str, callback: Callable) -> None:
+        listeners = self._listeners.get(stream)
+        if listeners is not None:
+            listeners.discard(callback)
+            if not listeners:
+                del self._listeners[stream]
+
+    def _notify_local(self, stream: str) -> None:
+        for name in (stream, self.ANY):
+            self._generations[name] += 1
+
+            # wake up current waiters. the next waiter gets a fresh event.
+            event = self._events.pop(name, None)
+            if event is not None:
+                event.set()
+
+        for callback in list(self._listeners.get(stream, ())):
+            try:
+                callback()
+            except Exception:
+                log.exception(f"error in '{stream}' stream listener")
+
+    def _on_message(self, message: dict) -> None:
+        # called from the subscription thread, not the event loop
+        if message.get("source") != self._id and self._loop is not None:
+            self._loop.call_soon_threadsafe(
+                self._notify_local, message["stream"]
+            )
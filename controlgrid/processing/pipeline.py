@@ -0,0 +1,254 @@
+"""
+Output pipelines: stages that parse, annotate and filter job output lines
+on the server, before they're encoded and sent to clients.
+
+Stages take and return a whole chunk of lines at a time, as read from a
+job's subprocess in one go, so a stage costs one call per chunk rather
+than per line, and lines dropped by a stage are never encoded or sent.
+Lines are still stored unprocessed, so a job's full output can always be
+read back from `GET /jobs/{job_id}/output`.
+
+A pipeline is specified as a list of stages, each a dict with a "type" and
+the stage's options, like:
+
+    [
+        {"type": "strip_ansi"},
+        {"type": "filter", "pattern": "DEBUG", "invert": true},
+        {"type": "extract", "pattern": "(?P<percent>\\d+)%"},
+    ]
+
+Pipelines are set per job, with the `pipeline` field of a job spec, or per
+tag, with the OUTPUT_PIPELINES env var: a JSON object of tag to pipeline,
+used for jobs without one of their own.
+"""
+
+import json
+import re
+
+from typing import Dict, List, Optional, Type
+
+import rapidjson
+
+from appyratus.env import Environment
+
+from controlgrid.db.models import Job
+from controlgrid.processing.encoding import OutputLine
+
+# CSI sequences, like colors and cursor movement, and OSC sequences, like
+# window titles. neither can span lines.
+ANSI_PATTERN = re.compile(
+    r"\x1b\[[0-?]*[ -/]*[@-~]"
+    r"|\x1b\][^\x07\x1b\n]*(?:\x07|\x1b\\)"
+    r"|\x1b[@-Z\\-_]"
+)
+
+
+class Stage:
+    """
+    Base class of pipeline stages. A stage is constructed with the options
+    of its spec, and may drop lines or replace their text, or add to their
+    fields, which are sent along with their text.
+    """
+
+    name: str = ""
+
+    def __call__(self, lines: List[OutputLine]) -> List[OutputLine]:
+        raise NotImplementedError()
+
+
+class StripAnsiStage(Stage):
+    """
+    Remove ANSI escape sequences, like colors, from lines.
+    """
+
+    name = "strip_ansi"
+
+    def __call__(self, lines: List[OutputLine]) -> List[OutputLine]:
+        # one substitution over the whole chunk. lines have no newlines, and
+        # the pattern can't match one, so the text splits back line by line.
+        text = "\n".join([line.text for line in lines])
+        if "\x1b" not in text:
+            return lines
+        texts = ANSI_PATTERN.sub("", text).split("\n")
+        for line, text in zip(lines, texts):
+            line.text = text
+        return lines
+
+
+class JsonStage(Stage):
+    """
+    Decode lines that are JSON objects into their fields. Other lines are
+    kept as they are, or dropped with `drop_invalid`.
+    """
+
+    name = "json"
+
+    def __init__(self, drop_invalid: bool = False) -> None:
+        self.drop_invalid = drop_invalid
+
+    def __call__(self, lines: List[OutputLine]) -> List[OutputLine]:
+        loads = rapidjson.loads
+        kept: List[OutputLine] = []
+        for line in lines:
+            fields = None
+            if line.text.startswith("{"):
+                try:
+                    fields = loads(line.text)
+                except ValueError:
+                    pass
+            if isinstance(fields, dict):
+                line.fields = (
+                    {**line.fields, **fields} if line.fields else fields
+                )
+            elif self.drop_invalid:
+                continue
+            kept.append(line)
+        return kept
+
+
+class ExtractStage(Stage):
+    """
+    Add the named groups of a regex matching each line to its fields, like
+    a progress percentage or a log level. Lines that don't match are kept
+    as they are, or dropped with `drop_unmatched`.
+    """
+
+    name = "extract"
+
+    def __init__(self, pattern: str, drop_unmatched: bool = False) -> None:
+        self.pattern = compile_pattern(pattern)
+        if not self.pattern.groupindex:
+            raise ValueError(f"pattern has no named groups: {pattern}")
+        self.drop_unmatched = drop_unmatched
+
+    def __call__(self, lines: List[OutputLine]) -> List[OutputLine]:
+        search = self.pattern.search
+        kept: List[OutputLine] = []
+        for line in lines:
+            match = search(line.text)
+            if match is not None:
+                fields = match.groupdict()
+                line.fields = (
+                    {**line.fields, **fields} if line.fields else fields
+                )
+            elif self.drop_unmatched:
+                continue
+            kept.append(line)
+        return kept
+
+
+class FilterStage(Stage):
+    """
+    Keep only lines matching a regex, or with `invert`, lines that don't.
+    """
+
+    name = "filter"
+
+    def __init__(self, pattern: str, invert: bool = False) -> None:
+        self.pattern = compile_pattern(pattern)
+        self.invert = invert
+
+    def __call__(self, lines: List[OutputLine]) -> List[OutputLine]:
+        search = self.pattern.search
+        if self.invert:
+            return [line for line in lines if search(line.text) is None]
+        return [line for line in lines if search(line.text) is not None]
+
+
+class SampleStage(Stage):
+    """
+    Keep every `every`th line of output, by line number, so that samples
+    are the same however output is chunked.
+    """
+
+    name = "sample"
+
+    def __init__(self, every: int) -> None:
+        if not isinstance(every, int) or every < 1:
+            raise ValueError(f"every must be a positive integer: {every}")
+        self.every = every
+
+    def __call__(self, lines: List[OutputLine]) -> List[OutputLine]:
+        every = self.every
+        return [line for line in lines if line.line_no % every == 0]
+
+
+STAGES: Dict[str, Type[Stage]] = {
+    stage_type.name: stage_type
+    for stage_type in (
+        StripAnsiStage,
+        JsonStage,
+        ExtractStage,
+        FilterStage,
+        SampleStage,
+    )
+}
+
+
+class Pipeline:
+    """
+    Stages applied in order to each chunk of a job's output lines.
+    """
+
+    def __init__(self, stages: List[Stage]) -> None:
+        self.stages = stages
+
+    def __call__(self, lines: List[OutputLine]) -> List[OutputLine]:
+        for stage in self.stages:
+            if not lines:
+                break
+            lines = stage(lines)
+        return lines
+
+    @classmethod
+    def parse(cls, specs: List[dict]) -> "Pipeline":
+        """
+        Build a pipeline from a list of stage specs, raising ValueError if
+        any is invalid.
+        """
+        if not isinstance(specs, list):
+            raise ValueError("expected a list of pipeline stages")
+        stages = []
+        for spec in specs:
+            if not isinstance(spec, dict):
+                raise ValueError(f"invalid pipeline stage: {spec}")
+            options = dict(spec)
+            stage_type = STAGES.get(options.pop("type", None))
+            if stage_type is None:
+                raise ValueError(
+                    f"unrecognized pipeline stage: {spec.get('type')}"
+                )
+            try:
+                stages.append(stage_type(**options))
+            except TypeError as exc:
+                raise ValueError(f"invalid {stage_type.name} stage: {exc}")
+        return cls(stages)
+
+
+def compile_pattern(pattern: str) -> re.Pattern:
+    try:
+        return re.compile(pattern)
+    except (re.error, TypeError) as exc:
+        raise ValueError(f"invalid pattern {pattern!r}: {exc}")
+
+
+def load_tag_pipelines(env: Environment) -> Dict[str, Pipeline]:
+    """
+    Parse pipelines by tag from the OUTPUT_PIPELINES env var, if it's set.
+    """
+    value = env.get("OUTPUT_PIPELINES")
+    if not value:
+        return {}
+    specs = json.loads(value) if isinstance(value, str) else value
+    return {tag: Pipeline.parse(stages) for tag, stages in specs.items()}
+
+
+def get_pipeline(
+    job: Job, tag_pipelines: Dict[str, Pipeline]
+) -> Optional[Pipeline]:
+    """
+    Get the pipeline for a job's output: its own, or else its tag's.
+    """
+    if job.pipeline:
+        return Pipeline.parse(job.pipeline)
+    return tag_pipelines.get(job.tag)
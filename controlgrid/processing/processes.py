@@ -0,0 +1,190 @@
+import asyncio
+import os
+import signal
+import socket
+
+from collections import defaultdict
+from typing import Dict, List, Optional, Set
+
+import sqlalchemy as sa
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.database import Database
+from controlgrid.db.models import Job, JobStateWriter
+from controlgrid.log import log
+from controlgrid.processing.backends import kill_group
+from controlgrid.processing.ipc import Channel
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ProcessRegistry:
+    """
+    Jobs claimed by this process, by job ID, with the PIDs of their
+    subprocesses once they're running, so that they can be cancelled.
+
+    Cancelling a running job sends SIGTERM to its process group, and SIGKILL
+    if it hasn't exited after `kill_grace_period`. Cancelling a job that's
+    claimed but not running yet stops it from starting. Whoever runs the job
+    checks `is_cancelled` to record how it ended.
+
+    Jobs claimed by other processes are cancelled by asking them to, over an
+    IPC channel: see `connect`.
+    """
+
+    cancel_topic = "jobs.cancel."
+
+    _instance: Optional["ProcessRegistry"] = None
+
+    def __init__(self, kill_grace_period: float = 5.0) -> None:
+        self.kill_grace_period = kill_grace_period
+        self._pids: Dict[str, Optional[int]] = {}
+        self._cancelled: Set[str] = set()
+        self._channel: Optional[Channel] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def get(cls) -> "ProcessRegistry":
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __len__(self) -> int:
+        return len(self._pids)
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self._pids
+
+    def add(self, job_id: str, pid: Optional[int] = None) -> None:
+        self._pids[job_id] = pid
+
+    def remove(self, job_id: str) -> None:
+        self._pids.pop(job_id, None)
+        self._cancelled.discard(job_id)
+
+    def is_cancelled(self, job_id: str) -> bool:
+        return job_id in self._cancelled
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a job claimed by this process. Return False if it isn't.
+        """
+        if job_id not in self._pids:
+            return False
+        self._cancelled.add(job_id)
+        pid = self._pids[job_id]
+        if pid is not None:
+            log.info(f"cancelling job {job_id} (pid {pid})")
+            kill_group(pid, signal.SIGTERM)
+            asyncio.get_running_loop().call_later(
+                self.kill_grace_period, self._kill, job_id, pid
+            )
+        return True
+
+    def connect(self, channel: Channel) -> None:
+        """
+        Send and receive requests to cancel jobs over an IPC channel. Must
+        be called from within the running event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._channel = channel
+        channel.subscribe(
+            callback=self._on_message, topics=[self.cancel_topic]
+        )
+
+    def request_cancel(self, job_id: str) -> bool:
+        """
+        Ask other processes to cancel a job. Return False if there's no
+        channel to ask them over.
+        """
+        if self._channel is None:
+            return False
+        self._channel.publish({"job_id": job_id}, topic=self.cancel_topic)
+        return True
+
+    def _kill(self, job_id: str, pid: int) -> None:
+        # only if the job hasn't exited and been removed in the meantime
+        if self._pids.get(job_id) == pid:
+            kill_group(pid, signal.SIGKILL)
+
+    def _on_message(self, message: dict) -> None:
+        # called from the subscription thread, not the event loop
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self.cancel, message["job_id"])
+
+
+async def cancel_job(db: Database, job: Job) -> Optional[str]:
+    """
+    Cancel a job, wherever it is. Return its status, which is "cancelled" if
+    it hadn't been claimed yet, or "cancelling" if the process running it
+    was told to stop, or None if it couldn't be cancelled.
+    """
+    if job.status in JobStateWriter.terminal_statuses:
+        return None
+    if job.status == JobStatus.created:
+        if await Job.cancel(db, [job.job_id]):
+            return JobStatus.cancelled
+        # claimed in the meantime
+    processes = ProcessRegistry.get()
+    if processes.cancel(job.job_id) or processes.request_cancel(job.job_id):
+        return "cancelling"
+    return None
+
+
+async def reap_orphans(db: Database) -> Set[str]:
+    """
+    Recover jobs left claimed or running by processes on this host that
+    have died, killing what's left of their subprocesses. Enqueued jobs go
+    back to pending, and running ones are marked as errors. Return the
+    streams with jobs put back.
+
+    Jobs of processes on other hosts are recovered from their heartbeats,
+    by the output relay, instead.
+    """
+    table = db.tables["jobs"]
+    query = sa.select(
+        table.c.job_id, table.c.status, table.c.pid, table.c.worker_id
+    ).where(
+        table.c.status.in_([JobStatus.enqueued, JobStatus.running]),
+        table.c.worker_id.isnot(None),
+    )
+    hostname = socket.gethostname()
+    orphans: Dict[str, List[str]] = defaultdict(list)
+    for row in await db.fetch_all(query):
+        job_id, status, pid, worker_id = row[0], row[1], row[2], row[3]
+        # worker IDs are "hostname:pid:random"
+        host, _, rest = worker_id.partition(":")
+        owner = rest.partition(":")[0]
+        if host != hostname or not owner.isdigit():
+            continue
+        if int(owner) == os.getpid() or is_alive(int(owner)):
+            continue
+        orphans[worker_id].append(job_id)
+        # make sure it's still the job's process group, not an unrelated
+        # process that has since been given the same PID
+        if status == JobStatus.running and pid and is_group_leader(pid):
+            log.warning(f"killing orphaned process {pid} of job {job_id}")
+            kill_group(pid)
+
+    streams: Set[str] = set()
+    for worker_id, job_ids in orphans.items():
+        log.warning(
+            f"recovering {len(job_ids)} jobs of dead process {worker_id}"
+        )
+        streams |= await Job.recover_worker_jobs(db, worker_id)
+    return streams
+
+
+def is_group_leader(pid: int) -> bool:
+    try:
+        return os.getpgid(pid) == pid
+    except ProcessLookupError:
+        return False
@@ -1,47 +1,206 @@
-import subprocess as sp
+import asyncio
+import os
+import signal
+import socket
+import time
 
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import List, Optional
+from uuid import uuid4
+
+from appyratus.env import Environment
+
+from controlgrid import metrics
 from controlgrid.log import log
 from controlgrid.db.database import Database
 from controlgrid.db.models import (
     Job,
     JobResult,
+    JobStateWriter,
     JobStatus,
 )
+from controlgrid.processing.backends import kill_group, rlimit_setter
+from controlgrid.processing.processes import ProcessRegistry
+
+
+def split_output(data: bytes) -> List[str]:
+    """
+    Decode and split raw subprocess output into lines. This is a module-level
+    function so that it can be offloaded to a process pool.
+    """
+    return data.decode("utf-8", errors="replace").splitlines()
 
 
 class Runner:
+    """
+    Runs a job's subprocess to completion without blocking the event loop,
+    buffering (at most `max_output_bytes` of) its output.
+
+    Post-processing of the output runs inline by default, or in a thread or
+    process pool if `offload` is "thread" or "process".
+    """
+
+    def __init__(
+        self,
+        max_output_bytes: Optional[int] = None,
+        kill_grace_period: Optional[float] = None,
+        offload: Optional[str] = None,
+        max_workers: Optional[int] = None,
+    ) -> None:
+        env = Environment()
+        self._max_output_bytes = max_output_bytes or env.get(
+            "RUNNER_MAX_OUTPUT_BYTES", 1 << 20, dtype=int
+        )
+        self._kill_grace_period = kill_grace_period or env.get(
+            "RUNNER_KILL_GRACE_PERIOD", 5.0, dtype=float
+        )
+        self._offload = offload or env.get("RUNNER_OFFLOAD")
+        self._max_workers = max_workers or env.get(
+            "RUNNER_MAX_WORKERS", dtype=int
+        )
+        self._executor: Optional[Executor] = None
+        self._spawn_seconds = metrics.SPAWN_SECONDS.labels("runner")
+        # default rlimits, for jobs without their own
+        self._cpu_limit = env.get("JOB_CPU_LIMIT", dtype=int)
+        self._memory_limit = env.get("JOB_MEMORY_LIMIT", dtype=int)
+        # recorded on jobs, so that they can be recovered if this process
+        # dies while running them
+        self.worker_id = (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        )
+
+    @property
+    def executor(self) -> Optional[Executor]:
+        # lazily create the executor, so a process pool isn't forked until
+        # it's needed
+        if self._executor is None and self._offload:
+            if self._offload == "thread":
+                self._executor = ThreadPoolExecutor(self._max_workers)
+            elif self._offload == "process":
+                self._executor = ProcessPoolExecutor(self._max_workers)
+            else:
+                raise ValueError(
+                    f"unrecognized offload mode: {self._offload}"
+                )
+        return self._executor
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
     async def run(self, db: Database, job: Job) -> JobResult:
-        await job.save(db, status=JobStatus.running)
+        writer = JobStateWriter.get(db)
+        writer.update(job, status=JobStatus.running, worker_id=self.worker_id)
+        processes = ProcessRegistry.get()
+        processes.add(job.job_id)
+        metrics.RUNNER_RUNNING_JOBS.inc()
+        start = time.perf_counter()
 
-        output = []
+        output = bytearray()
+        proc: Optional[asyncio.subprocess.Process] = None
         try:
-            proc = sp.Popen(
-                [job.command] + job.args,
-                stdout=sp.PIPE,
-                stderr=sp.STDOUT,
-                universal_newlines=True,
-            )
+            with self._spawn_seconds.time():
+                proc = await asyncio.create_subprocess_exec(
+                    job.command,
+                    *job.args,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    start_new_session=True,
+                    preexec_fn=rlimit_setter(
+                        job.cpu_limit or self._cpu_limit,
+                        job.memory_limit or self._memory_limit,
+                    ),
+                )
             # persist OS process ID
-            await job.save(db, pid=proc.pid)
+            processes.add(job.job_id, proc.pid)
+            writer.update(job, pid=proc.pid)
 
-            # if there's a timeout, wait for the process to complete
-            if job.timeout is not None:
-                proc.wait(timeout=job.timeout)
+            # read output until the process exits or times out. when there's
+            # no timeout, this waits for as long as the process runs.
+            try:
+                await asyncio.wait_for(
+                    self._read_output(proc, output), timeout=job.timeout
+                )
+            except asyncio.TimeoutError:
+                await self._terminate(proc)
+                log.error(f"job {job.job_id} timed out")
+                await writer.save(
+                    job,
+                    status=JobStatus.failed,
+                    exit_code=proc.returncode,
+                    error=f"timed out after {job.timeout} seconds",
+                )
+            else:
+                if processes.is_cancelled(job.job_id):
+                    status = JobStatus.cancelled
+                else:
+                    # the job finished normally
+                    status = JobStatus.completed
+                await writer.save(
+                    job, exit_code=proc.returncode, status=status
+                )
+        except Exception as exc:
+            log.exception(f"error in subprocess for job {job.job_id}")
+            await writer.save(job, status=JobStatus.error, error=str(exc))
+        finally:
+            # don't leave the process running if the request was cancelled
+            if proc is not None and proc.returncode is None:
+                self._kill(proc, signal.SIGKILL)
+            processes.remove(job.job_id)
+            metrics.RUNNER_RUNNING_JOBS.dec()
+            metrics.RUNNER_JOB_SECONDS.observe(time.perf_counter() - start)
+            metrics.RUNNER_JOBS.labels(job.status).inc()
 
-            # the job finished normally
-            await job.save(
-                db, exit_code=proc.returncode, status=JobStatus.completed
+        # split the stdout (which also has stderr) into lines
+        if self.executor is not None:
+            loop = asyncio.get_running_loop()
+            lines = await loop.run_in_executor(
+                self.executor, split_output, bytes(output)
             )
+        else:
+            lines = split_output(output)
 
-            # split the stdout (which also has stderr) into lines
-            stdout = proc.communicate()[0]
-            output = stdout.split("\n")
+        return JobResult.create(job, lines)
 
-        except sp.TimeoutExpired as exc:
-            log.exception(f"job {job.job_id} timed out")
-            await job.save(db, status=JobStatus.failed, error=str(exc))
-        except Exception as exc:
-            log.exception(f"error in subprocess for job {job.job_id}")
-            await job.save(db, status=JobStatus.error, error=str(exc))
+    async def _read_output(
+        self, proc: asyncio.subprocess.Process, output: bytearray
+    ) -> None:
+        max_bytes = self._max_output_bytes
+        truncated = False
+        while True:
+            chunk = await proc.stdout.read(1 << 16)
+            if not chunk:
+                break
+            output += chunk
+            if len(output) > max_bytes:
+                # keep only the tail of the output
+                del output[: len(output) - max_bytes]
+                truncated = True
+
+        if truncated:
+            # drop the partial line left at the head of the buffer
+            del output[: output.find(b"\n") + 1]
+
+        await proc.wait()
+
+    async def _terminate(self, proc: asyncio.subprocess.Process) -> None:
+        """
+        Send SIGTERM to the process group, escalating to SIGKILL if it hasn't
+        exited after the grace period.
+        """
+        self._kill(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(proc.wait(), self._kill_grace_period)
+        except asyncio.TimeoutError:
+            self._kill(proc, signal.SIGKILL)
+            await proc.wait()
 
-        return JobResult.create(job, output)
+    @staticmethod
+    def _kill(proc: asyncio.subprocess.Process, sig: int) -> None:
+        kill_group(proc.pid, sig)
@@ -0,0 +1,64 @@
+import pickle
+
+from typing import Any, Dict, Type, Union
+
+import msgpack
+
+
+class Serializer:
+    """
+    Strategy used by IPC sockets to turn messages into bytes and back.
+    """
+
+    name: str = ""
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError()
+
+    def loads(self, data: Union[bytes, memoryview]) -> Any:
+        raise NotImplementedError()
+
+
+class MsgpackSerializer(Serializer):
+    """
+    Compact and fast, but limited to basic types: None, bools, numbers,
+    strings, bytes, lists and dicts.
+    """
+
+    name = "msgpack"
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data: Union[bytes, memoryview]) -> Any:
+        return msgpack.unpackb(data, raw=False)
+
+
+class PickleSerializer(Serializer):
+    """
+    Handles any picklable object, but is slower, and unpickling runs
+    arbitrary code, so it must only be used between trusted processes.
+    """
+
+    name = "pickle"
+
+    def dumps(self, obj: Any) -> bytes:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data: Union[bytes, memoryview]) -> Any:
+        return pickle.loads(data)
+
+
+SERIALIZERS: Dict[str, Type[Serializer]] = {
+    serializer_type.name: serializer_type
+    for serializer_type in (MsgpackSerializer, PickleSerializer)
+}
+
+
+def get_serializer(serializer: Union[str, Serializer]) -> Serializer:
+    if isinstance(serializer, Serializer):
+        return serializer
+    serializer_type = SERIALIZERS.get(serializer)
+    if serializer_type is None:
+        raise ValueError(f"unrecognized serializer: {serializer}")
+    return serializer_type()
@@ -1,19 +1,61 @@
 import asyncio
-import sys
+import heapq
+import os
+import socket
+import time
 
-import pexpect
-
-from collections import deque
-from typing import AsyncIterator, Deque, Dict, List, Optional
+from collections import Counter
+from itertools import count
+from typing import (
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from uuid import uuid4
 
 from appyratus.utils.time_utils import TimeUtils
 from appyratus.logging import ConsoleLoggerInterface
 from appyratus.env import Environment
-from appyratus.json import JsonEncoder
 
-from controlgrid.db.models import Job, JobResult, JobStreamEvent, JobOutput
+from controlgrid.db.models import (
+    Job,
+    JobResult,
+    JobStateWriter,
+    JobStreamEvent,
+)
 from controlgrid.db.database import Database
-from controlgrid.constants import JobStatus
+from controlgrid.db.output import JobOutputStore
+from controlgrid.constants import JobStatus, OutputFormat
+from controlgrid import metrics
+from controlgrid.processing.backends import (
+    Process,
+    ProcessBackend,
+    get_backend,
+)
+from controlgrid.processing.notifier import JobNotifier
+from controlgrid.processing.pipeline import (
+    Pipeline,
+    get_pipeline,
+    load_tag_pipelines,
+)
+from controlgrid.processing.processes import ProcessRegistry
+from controlgrid.processing.batching import BatchStats
+from controlgrid.processing.chunks import LineChunker
+from controlgrid.processing.encoding import (
+    BatchEncoder,
+    OutputBlock,
+    OutputLine,
+    StreamEvent,
+)
+
+
+def utf8_size(text: str) -> int:
+    # without encoding the text, if it's all ASCII, as output mostly is
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
 
 
 class Streamer:
@@ -22,120 +64,550 @@ class Streamer:
         db: Database,
         stream_name: str,
         batch_size: int = 100,
+        batch_bytes: int = 1 << 18,
+        batch_latency: float = 0.02,
+        backend: Optional[ProcessBackend] = None,
+        max_concurrency: int = 4,
+        tag_limits: Optional[Dict[str, int]] = None,
+        notifier: Optional[JobNotifier] = None,
+        claim_batch_size: Optional[int] = None,
+        worker_id: Optional[str] = None,
+        tag_pipelines: Optional[Dict[str, Pipeline]] = None,
     ) -> None:
-        self._job_queue: Deque[Job] = deque()
+        # heap of (-priority, sequence, job), so that higher priority jobs
+        # run first and jobs of equal priority run in FIFO order.
+        self._job_queue: List[Tuple[int, int, Job]] = []
+        self._job_seq = count()
         self._batch_size = max(1, batch_size)
+        self._batch_bytes = max(1, batch_bytes)
+        self._batch_latency = max(0.0, batch_latency)
+        self._max_concurrency = max(1, max_concurrency)
+        self._claim_batch_size = max(1, claim_batch_size or max_concurrency)
+        self._tag_limits = tag_limits or {}
+        self._running_tags: Counter = Counter()
+        # tags of jobs put back because their tag was at its limit
+        self._held_back_tags: Set[str] = set()
+        self._notifier = notifier
+        # whether there may be new jobs in the DB that aren't in the queue
+        self._stale = True
         self._env = Environment()
         self._stream_name = stream_name
         self._log = ConsoleLoggerInterface(f"stream[{stream_name}]")
-        self._json = JsonEncoder()
+        self._encoder = BatchEncoder()
         self._db = db
+        self._writer = JobStateWriter.get(db)
+        self._output = JobOutputStore.get(db)
+        # next line number to send for each job with output in flight
+        self._cursor: Dict[str, int] = {}
+        self._worker_id = worker_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        )
+        self._backend = backend or get_backend(
+            self._env.get("STREAMER_BACKEND", "pty")
+        )
+        self._processes = ProcessRegistry.get()
+        # output pipelines by tag, for jobs without their own
+        self._tag_pipelines = (
+            tag_pipelines
+            if tag_pipelines is not None
+            else load_tag_pipelines(self._env)
+        )
+        # default rlimits, for jobs without their own
+        self._cpu_limit = self._env.get("JOB_CPU_LIMIT", dtype=int)
+        self._memory_limit = self._env.get("JOB_MEMORY_LIMIT", dtype=int)
+        # metrics are recorded per batch, not per line
+        self._queued_jobs = metrics.STREAM_QUEUED_JOBS.labels(stream_name)
+        self._running_jobs = metrics.STREAM_RUNNING_JOBS.labels(stream_name)
+        self._output_lines = metrics.STREAM_OUTPUT_LINES.labels(stream_name)
+        self._output_bytes = metrics.STREAM_OUTPUT_BYTES.labels(stream_name)
+        self._dropped_lines = metrics.STREAM_DROPPED_LINES.labels(stream_name)
+        # counted as they happen, as batch stats are dropped with the hub
+        self._batch_flushes = {
+            reason: metrics.STREAM_BATCH_FLUSHES.labels(stream_name, reason)
+            for reason in BatchStats.reasons
+        }
+        self._encode_seconds = metrics.BATCH_ENCODE_SECONDS.labels(
+            stream_name
+        )
+        self._spawn_seconds = metrics.SPAWN_SECONDS.labels(
+            self._backend.name
+        )
+
+    @property
+    def event_id(self) -> str:
+        """
+        ID for the last batch yielded by `generate`, which can be passed to
+        `replay` to resume from where the batch left off.
+        """
+        return ",".join(f"{k}:{v}" for k, v in self._cursor.items())
 
     async def generate(self) -> AsyncIterator[str]:
-        await self._enqueue_jobs()
+        """
+        Run pending jobs and yield batches of their encoded output events,
+        returning once there are no more jobs to run.
+
+        A batch is flushed as soon as it has `batch_size` events, holds
+        `batch_bytes` of output, encoded as UTF-8, or its first event is
+        `batch_latency` seconds old, whichever comes first, and whenever a
+        job finishes.
+        """
+        # running job tasks all put their events, chunks of output lines or
+        # results, into one merged queue, which is bounded so that a chatty
+        # job can't starve the others.
+        events: asyncio.Queue = asyncio.Queue(maxsize=self._batch_size)
+        tasks: Dict[Job, asyncio.Task] = {}
+        batch: List[StreamEvent] = []
+        batch_bytes = 0
+        batch_lines = 0
+        deadline: Optional[float] = None
+        loop = asyncio.get_running_loop()
+        # looked up per run, as stats are dropped along with a stream's hub
+        stats = BatchStats.get(self._stream_name)
 
-        # start streaming the next job in queue
-        generators: Dict[Job, AsyncIterator[JobStreamEvent]] = {}
+        def on_notify() -> None:
+            # new jobs were created for this stream while jobs are running.
+            # wake up the loop below, unless it's already busy.
+            self._stale = True
+            if not events.full():
+                events.put_nowait((None, None))
 
-        if self._job_queue and len(generators) < 4:
-            job = self._job_queue.popleft()
-            generators[job] = self._generate_stream_events(job)
+        self._stale = True
+        await self._schedule(tasks, events)
 
-        while generators:
-            # emit job stream events for each running job in a round-robin
-            # fashion, clearing job from the generators dict when work is
-            # done.
-            for job, generator in list(generators.items()):
-                batch: List[dict] = []
+        if self._notifier is not None:
+            self._notifier.add_listener(self._stream_name, on_notify)
+        try:
+            while tasks:
+                # only wait for as long as the current batch may be held
                 try:
-                    async for event in generator:
-                        batch.append(event.dict())
-                        if len(batch) == self._batch_size:
-                            yield self._json.encode(batch)
-                            batch.clear()
-                            break
-                        if event.result is not None:
-                            del generators[job]
-                            # send any data still accumulated in final batch
-                            if batch:
-                                yield self._json.encode(batch)
-                            break
-                except ValueError:
-                    self._log.exception(
-                        f"JSON encode error streaming "
-                        f"output for job {job.job_id}"
-                    )
-                except Exception:
-                    self._log.exception(
-                        f"unhandled exception streaming"
-                        f"output for job {job.job_id}"
+                    job, event = events.get_nowait()
+                except asyncio.QueueEmpty:
+                    try:
+                        if deadline is None:
+                            job, event = await events.get()
+                        else:
+                            job, event = await asyncio.wait_for(
+                                events.get(), deadline - loop.time()
+                            )
+                    except asyncio.TimeoutError:
+                        job, event = None, None
+
+                if self._stale and len(tasks) < self._max_concurrency:
+                    await self._schedule(tasks, events)
+
+                reason = None
+                if job is not None:
+                    if not batch:
+                        deadline = loop.time() + self._batch_latency
+                    if event.__class__ is list:
+                        batch.extend(event)
+                        self._cursor[job.job_id] = event[-1].line_no + 1
+                        batch_bytes += sum(
+                            [utf8_size(line.text) for line in event]
+                        )
+                        batch_lines += len(event)
+                    elif event.__class__ is OutputBlock:
+                        batch.append(event)
+                        self._cursor[job.job_id] = (
+                            event.line_no + event.line_count
+                        )
+                        batch_bytes += len(event.data)
+                        batch_lines += event.line_count
+                    else:
+                        batch.append(event)
+                        # job is done. free its slot and start the next job
+                        self._cursor.pop(job.job_id, None)
+                        del tasks[job]
+                        self._release(job)
+                        await self._schedule(tasks, events)
+                        reason = "result"
+
+                if batch and reason is None:
+                    reason = self._flush_reason(
+                        len(batch), batch_bytes, deadline - loop.time()
                     )
+                if reason is None:
+                    continue
 
-    async def _enqueue_jobs(self):
-        # gather new jobs from db and update status to "enqeueued"
-        db = self._db
-        async with db.transaction():
-            jobs = await Job.get_pending_jobs(db, stream=self._stream_name)
+                stats.record(reason, len(batch), batch_bytes)
+                self._batch_flushes[reason].value += 1
+                self._output_lines.value += batch_lines
+                self._output_bytes.value += batch_bytes
+                encoded = self._encode(batch)
+                batch = []
+                batch_bytes = 0
+                batch_lines = 0
+                deadline = None
+                if encoded is not None:
+                    yield encoded
+        finally:
+            if self._notifier is not None:
+                self._notifier.remove_listener(self._stream_name, on_notify)
+            for job, task in tasks.items():
+                task.cancel()
+                self._release(job)
+                self._encoder.forget(job.job_id)
+            # put back jobs that were claimed but not started
+            unstarted = [job for _, _, job in self._job_queue]
+            self._job_queue.clear()
+            await self._put_back(unstarted)
+
+    def _flush_reason(
+        self, size: int, size_bytes: int, time_left: float
+    ) -> Optional[str]:
+        if size >= self._batch_size:
+            return "lines"
+        if size_bytes >= self._batch_bytes:
+            return "bytes"
+        if time_left <= 0:
+            return "latency"
+        return None
+
+    async def replay(self, event_id: str) -> AsyncIterator[str]:
+        """
+        Yield batches of stored output events for the jobs in the given event
+        ID, starting from where it left off, along with the result of each job
+        that has since finished.
+        """
+        for item in event_id.split(","):
+            job_id, _, line_no = item.strip().partition(":")
+            if not line_no.isdigit():
+                continue
+            job = await Job.get(self._db, job_id)
+            if job is None:
+                continue
+            pipeline = get_pipeline(job, self._tag_pipelines)
+
+            from_line = int(line_no)
+            while True:
+                batch, next_line = await read_stored_events(
+                    self._output, job, from_line, self._batch_size, pipeline
+                )
+                if next_line == from_line:
+                    break
+                from_line = next_line
+                if not batch:
+                    continue
+                encoded = self._encode(batch)
+                if encoded is not None:
+                    yield encoded
+
+            if job.status in JobStateWriter.terminal_statuses:
+                result = JobResult.create(job, [])
+                encoded = self._encode(
+                    [JobStreamEvent(result=result, line=None)]
+                )
+                if encoded is not None:
+                    yield encoded
+
+    async def _schedule(
+        self, tasks: Dict[Job, asyncio.Task], events: asyncio.Queue
+    ) -> None:
+        """
+        Fill free concurrency slots with jobs from the queue, going back to the
+        DB for more jobs if the queue can't fill them and there may be new
+        ones. Without a notifier, there may always be new ones.
+
+        Claimed jobs whose tag is at its concurrency limit are put back, so
+        that they neither hold up claims of jobs that can run, nor sit
+        claimed where no one can run them. They're claimed again once a job
+        with their tag finishes.
+        """
+        held_back: List[Job] = []
+        while True:
+            free_slots = self._max_concurrency - len(tasks)
+            if free_slots <= 0:
+                break
+
+            if len(self._job_queue) < free_slots and (
+                self._stale or self._notifier is None
+            ):
+                self._stale = False
+                await self._enqueue_jobs()
+
+            jobs, blocked = self._pop_runnable_jobs(free_slots)
             for job in jobs:
-                await job.save(db, status=JobStatus.enqueued)
-                self._job_queue.append(job)
+                self._running_tags[job.tag] += 1
+                tasks[job] = asyncio.create_task(self._run_job(job, events))
+            held_back.extend(blocked)
+
+            # claim again, past the jobs that were held back, if they left
+            # slots free and there may be more jobs to claim
+            if not blocked or not (self._stale or self._notifier is None):
+                break
+
+        self._queued_jobs.value = len(self._job_queue)
+        if held_back:
+            self._held_back_tags.update(job.tag for job in held_back)
+            await self._put_back(held_back)
+
+    def _pop_runnable_jobs(self, limit: int) -> Tuple[List[Job], List[Job]]:
+        # pop jobs in priority order, along with jobs whose tag is already at
+        # its concurrency limit, which are returned separately.
+        jobs: List[Job] = []
+        blocked: List[Job] = []
+        tags = Counter(self._running_tags)
+        while self._job_queue and len(jobs) < limit:
+            job = heapq.heappop(self._job_queue)[2]
+            tag_limit = self._tag_limits.get(job.tag)
+            if tag_limit is not None and tags[job.tag] >= tag_limit:
+                blocked.append(job)
+            else:
+                tags[job.tag] += 1
+                jobs.append(job)
+        self._running_jobs.value += len(jobs)
+        return jobs, blocked
+
+    def _full_tags(self) -> List[str]:
+        # tags at their concurrency limit with the jobs running and queued
+        tags = Counter(self._running_tags)
+        tags.update(job.tag for _, _, job in self._job_queue)
+        return [
+            tag
+            for tag, tag_limit in self._tag_limits.items()
+            if tags[tag] >= tag_limit
+        ]
+
+    async def _put_back(self, jobs: List[Job]) -> None:
+        # unclaim jobs, for whoever runs the stream next. they're written
+        # right away, and whoever is waiting on the stream told, so that
+        # they don't sit claimed until the next flush or poll.
+        if not jobs:
+            return
+        for job in jobs:
+            self._processes.remove(job.job_id)
+            self._writer.update(job, status=JobStatus.created, worker_id=None)
+        try:
+            await self._writer.flush()
+        except Exception:
+            self._log.exception("error putting back claimed jobs")
+        if self._notifier is not None:
+            self._notifier.notify(self._stream_name)
+
+    def _release(self, job: Job) -> None:
+        self._running_jobs.value -= 1
+        if job.tag in self._held_back_tags:
+            # jobs with this tag were put back, and can now be claimed again
+            self._held_back_tags.discard(job.tag)
+            self._stale = True
+        self._running_tags[job.tag] -= 1
+        if self._running_tags[job.tag] <= 0:
+            del self._running_tags[job.tag]
+
+    async def _run_job(self, job: Job, events: asyncio.Queue) -> None:
+        job_events = self._generate_stream_events(job)
+        try:
+            async for event in job_events:
+                await events.put((job, event))
+        except Exception as exc:
+            self._log.exception(
+                f"unhandled exception streaming output for job {job.job_id}"
+            )
+            await self._writer.save(
+                job, status=JobStatus.error, error=str(exc)
+            )
+            result = JobResult.create(job, [])
+            await events.put((job, JobStreamEvent(result=result, line=None)))
+        finally:
+            # if the task was cancelled, this kills the job's subprocess
+            await job_events.aclose()
+
+    def _encode(self, batch: List[StreamEvent]) -> Optional[str]:
+        start = time.perf_counter()
+        try:
+            return self._encoder.encode(batch)
+        except ValueError:
+            self._log.exception(
+                f"JSON encode error streaming output for {len(batch)} events"
+            )
+            return None
+        finally:
+            self._encode_seconds.observe(time.perf_counter() - start)
+
+    async def _enqueue_jobs(self):
+        # claim a batch of new jobs from db, which sets them to "enqueued"
+        jobs = await Job.claim_pending(
+            self._db,
+            stream=self._stream_name,
+            limit=self._claim_batch_size,
+            worker_id=self._worker_id,
+            exclude_tags=self._full_tags(),
+        )
+        for job in jobs:
+            item = (-job.priority, next(self._job_seq), job)
+            heapq.heappush(self._job_queue, item)
+            self._processes.add(job.job_id)
+
+        # a full batch means there may be more jobs left to claim
+        if len(jobs) >= self._claim_batch_size:
+            self._stale = True
 
     async def _generate_stream_events(
         self, job: Job
-    ) -> AsyncIterator[JobStreamEvent]:
-        db = self._db
-        child = await self._spawn(db, job)
+    ) -> AsyncIterator[Union[List[OutputLine], StreamEvent]]:
+        writer = self._writer
+        output = self._output
+        pipeline = get_pipeline(job, self._tag_pipelines)
+        child = await self._spawn(job)
         if child is None:
             yield JobStreamEvent(result=JobResult.create(job, []), line=None)
         else:
-            await job.save(db, pid=child.pid)
-            line_no = 0
+            done = False
             try:
-                while not child.closed:
-                    line = child.readline()
-                    if line:
-                        yield JobStreamEvent(
-                            result=None,
-                            line=JobOutput(
-                                job_id=job.job_id,
-                                tag=job.tag,
-                                timestamp=TimeUtils.utc_timestamp(),
-                                data=JobOutput.Data(
-                                    line_no=line_no, text=line.rstrip()
-                                ),
-                                pid=job.pid,
-                            ),
-                        )
-                        line_no += 1
-                    else:
-                        await job.save(
-                            db,
-                            status=JobStatus.completed,
-                            exit_code=child.exitstatus,
-                        )
-                        yield JobStreamEvent(
-                            result=JobResult.create(job, []), line=None
-                        )
-                        break
+                if self._is_raw(job):
+                    chunks = self._read_raw_output(job, child)
+                else:
+                    chunks = self._read_output(job, child, pipeline)
+                async for chunk in chunks:
+                    yield chunk
+
+                output.close(job.job_id)
+                exit_code = await child.wait()
+                if self._processes.is_cancelled(job.job_id):
+                    await writer.save(
+                        job,
+                        status=JobStatus.cancelled,
+                        exit_code=exit_code,
+                        error="cancelled",
+                    )
+                else:
+                    await writer.save(
+                        job, status=JobStatus.completed, exit_code=exit_code
+                    )
+                done = True
+                yield JobStreamEvent(
+                    result=JobResult.create(job, []), line=None
+                )
             except Exception as exc:
                 self._log.exception(
                     f"error reading subprocess stdout for job {job.job_id}"
                 )
-                await job.save(db, status=JobStatus.error, error=str(exc))
+                child.kill()
+                output.close(job.job_id)
+                await writer.save(job, status=JobStatus.error, error=str(exc))
+                done = True
                 yield JobStreamEvent(
                     result=JobResult.create(job, []), line=None
                 )
+            finally:
+                self._processes.remove(job.job_id)
+                if not done:
+                    # no one's reading the job's output anymore, e.g. its
+                    # stream's clients have all disconnected. don't leave the
+                    # process running, unowned.
+                    child.kill()
+                    output.close(job.job_id)
+                    writer.update(
+                        job, status=JobStatus.cancelled, error="stream closed"
+                    )
 
-    async def _spawn(self, db: Database, job: Job) -> Optional[pexpect.spawn]:
-        try:
-            child = pexpect.spawn(
-                job.command, job.args, timeout=job.timeout, encoding="utf-8"
+    async def _read_output(
+        self, job: Job, child: Process, pipeline: Optional[Pipeline]
+    ) -> AsyncIterator[List[OutputLine]]:
+        # a chunk of lines at a time, as many as are available, up to a batch
+        output = self._output
+        line_no = 0
+        while True:
+            texts = await child.readlines(self._batch_size)
+            if not texts:
+                return
+            texts = [text.rstrip() for text in texts]
+            timestamp = int(TimeUtils.utc_timestamp())
+            output.extend(job.job_id, line_no, texts, timestamp)
+            lines = [
+                OutputLine(job, timestamp, line_no + i, text)
+                for i, text in enumerate(texts)
+            ]
+            line_no += len(texts)
+            if pipeline is not None:
+                count = len(lines)
+                lines = pipeline(lines)
+                self._dropped_lines.value += count - len(lines)
+            if lines:
+                yield lines
+
+    async def _read_raw_output(
+        self, job: Job, child: Process
+    ) -> AsyncIterator[OutputBlock]:
+        # a buffer of whole lines at a time, stored and sent as bytes
+        output = self._output
+        chunker = LineChunker(child, self._batch_bytes)
+        line_no = 0
+        while True:
+            chunk = await chunker.read()
+            if chunk is None:
+                return
+            data, count = chunk
+            timestamp = int(TimeUtils.utc_timestamp())
+            output.extend_raw(job.job_id, line_no, data, count, timestamp)
+            yield OutputBlock(job, timestamp, line_no, count, data)
+            line_no += count
+
+    async def _spawn(self, job: Job) -> Optional[Process]:
+        if self._processes.is_cancelled(job.job_id):
+            self._processes.remove(job.job_id)
+            await self._writer.save(
+                job, status=JobStatus.cancelled, error="cancelled"
             )
-            await job.save(db, pid=child.pid)
+            return None
+        try:
+            with self._spawn_seconds.time():
+                child = await self._backend.spawn(
+                    job.command,
+                    job.args,
+                    timeout=job.timeout,
+                    cpu_limit=job.cpu_limit or self._cpu_limit,
+                    memory_limit=job.memory_limit or self._memory_limit,
+                    raw=self._is_raw(job),
+                )
+            self._processes.add(job.job_id, child.pid)
+            self._writer.update(job, status=JobStatus.running, pid=child.pid)
             return child
         except Exception as exc:
             self._log.exception(
                 f"error spawning subprocess for job {job.job_id}"
             )
-            await job.save(db, status=JobStatus.error, error=str(exc))
+            self._processes.remove(job.job_id)
+            await self._writer.save(
+                job, status=JobStatus.error, error=str(exc)
+            )
             return None
+
+    @staticmethod
+    def _is_raw(job: Job) -> bool:
+        return job.output_format in (OutputFormat.text, OutputFormat.base64)
+
+
+async def read_stored_events(
+    output: JobOutputStore,
+    job: Job,
+    from_line: int,
+    limit: int,
+    pipeline: Optional[Pipeline] = None,
+) -> Tuple[List[StreamEvent], int]:
+    """
+    Read up to `limit` lines of a job's stored output, from `from_line`, as
+    the events they were streamed as: lines, run through the pipeline, if
+    any, or for jobs with raw output, blocks. Also return the line to read
+    from next, which is `from_line` if there's no more output yet.
+    """
+    if Streamer._is_raw(job):
+        blocks = await output.read_raw(job.job_id, from_line, limit)
+        if not blocks:
+            return [], from_line
+        line_no, line_count = blocks[-1][:2]
+        return [
+            OutputBlock(job, timestamp, line_no, line_count, data)
+            for line_no, line_count, timestamp, data in blocks
+        ], line_no + line_count
+
+    lines = await output.read(job.job_id, from_line, limit)
+    if not lines:
+        return [], from_line
+    batch: List[StreamEvent] = [
+        OutputLine(job, timestamp, line_no, text)
+        for line_no, timestamp, text in lines
+    ]
+    if pipeline is not None:
+        batch = pipeline(batch)
+    return batch, lines[-1][0] + 1
@@ -0,0 +1,386 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+from typing import Dict, List, Optional, Set
+from uuid import uuid4
+
+from appyratus.env import Environment
+from appyratus.logging import ConsoleLoggerInterface
+
+from controlgrid.db import tables
+from controlgrid.db.database import Database, DatabaseManager, resolve_url
+from controlgrid.db.models import (
+    Job,
+    JobRegistry,
+    JobStateWriter,
+    WorkerHeartbeat,
+)
+from controlgrid.db.output import JobOutputStore
+from controlgrid.log import log
+from controlgrid.processing.batching import BatchStats
+from controlgrid.processing.buffers import gap_event
+from controlgrid.processing.ipc import Channel
+from controlgrid.processing.notifier import JobNotifier, notify_channel
+from controlgrid.processing.processes import ProcessRegistry, reap_orphans
+from controlgrid.processing.streamer import Streamer
+
+# messages published by workers are dicts with one of these types
+OUTPUT = "output"
+HEARTBEAT = "heartbeat"
+INVALIDATE = "invalidate"
+STOPPED = "stopped"
+
+
+def output_channel(addr: str) -> Channel:
+    """
+    Channel from workers to the API. There are many workers and one API
+    process relaying their output, so the relaying side binds the address.
+    """
+    return Channel(addr, serializer="msgpack", bind_subscriber=True)
+
+
+class Worker:
+    """
+    Runs jobs outside of the API process. A worker claims pending jobs from
+    any stream, runs them with a `Streamer` per stream, and publishes each
+    encoded batch of output to the API, which relays it to clients through
+    an `OutputRelay`. Job state and output are written to the shared DB, as
+    when jobs run in the API process.
+
+    Workers coordinate only through the DB, where claiming a job is atomic,
+    so any number of them can run, on any number of hosts. Each publishes a
+    heartbeat, and records it in the DB, so that the API can recover the
+    jobs of workers that die.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        output: Channel,
+        notifier: JobNotifier,
+        max_concurrency: int = 4,
+        poll_interval: float = 1.0,
+        heartbeat_interval: float = 1.0,
+        worker_id: Optional[str] = None,
+    ) -> None:
+        self.worker_id = worker_id or (
+            f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        )
+        self._db = db
+        self._output = output
+        self._notifier = notifier
+        self._max_concurrency = max_concurrency
+        self._poll_interval = poll_interval
+        self._heartbeat_interval = heartbeat_interval
+        self._streams: Dict[str, asyncio.Task] = {}
+        self._log = ConsoleLoggerInterface(f"worker[{self.worker_id}]")
+
+    async def run(self) -> None:
+        self._log.info("worker started")
+        # tell the API about changes to jobs, so that it doesn't serve stale
+        # copies from its registry
+        JobRegistry.get(self._db).publisher = self._invalidate
+        heartbeat = asyncio.create_task(self._beat())
+        generation = None
+        try:
+            while True:
+                # sleep until a new job is created in any stream, or until
+                # it's time to check the DB anyway
+                if generation == self._notifier.generation(JobNotifier.ANY):
+                    await self._notifier.wait(
+                        JobNotifier.ANY, generation, self._poll_interval
+                    )
+                generation = self._notifier.generation(JobNotifier.ANY)
+                for stream in await Job.get_pending_streams(self._db):
+                    if stream is not None and stream not in self._streams:
+                        self._streams[stream] = asyncio.create_task(
+                            self._run_stream(stream)
+                        )
+        finally:
+            heartbeat.cancel()
+            for task in self._streams.values():
+                task.cancel()
+            await asyncio.gather(
+                *self._streams.values(), return_exceptions=True
+            )
+            self._publish({"type": STOPPED})
+            try:
+                await WorkerHeartbeat.remove(self._db, self.worker_id)
+            except Exception:
+                self._log.exception("error removing heartbeat")
+            self._log.info("worker stopped")
+
+    async def _run_stream(self, stream: str) -> None:
+        # run the stream's jobs until there are none left to claim
+        streamer = Streamer(
+            self._db,
+            stream,
+            max_concurrency=self._max_concurrency,
+            notifier=self._notifier,
+            worker_id=self.worker_id,
+        )
+        batches = streamer.generate()
+        try:
+            async for batch in batches:
+                self._publish(
+                    {
+                        "type": OUTPUT,
+                        "stream": stream,
+                        "id": streamer.event_id,
+                        "data": batch,
+                    },
+                    topic=f"output.{stream}.",
+                )
+        except Exception:
+            self._log.exception(f"error running '{stream}' stream")
+        finally:
+            await batches.aclose()
+            if self._streams.get(stream) is asyncio.current_task():
+                del self._streams[stream]
+                BatchStats.remove(stream)
+
+    async def _beat(self) -> None:
+        while True:
+            self._publish({"type": HEARTBEAT})
+            try:
+                await WorkerHeartbeat.beat(self._db, self.worker_id)
+            except Exception:
+                self._log.exception("error recording heartbeat")
+            await asyncio.sleep(self._heartbeat_interval)
+
+    def _invalidate(self, job_ids: List[str]) -> None:
+        self._publish({"type": INVALIDATE, "job_ids": job_ids})
+
+    def _publish(self, message: dict, topic: str = "worker.") -> None:
+        message["worker_id"] = self.worker_id
+        self._output.publish(message, topic=topic)
+
+
+class OutputRelay:
+    """
+    Receives output published by workers and passes it on to the stream
+    hubs that are listening for it, one bounded queue per stream. A hub that
+    falls behind loses its oldest batches, rather than holding up workers,
+    and gets a gap event for them from `pop_gap`.
+
+    Also keeps track of worker heartbeats, so that `reap_periodically` can
+    recover the jobs of workers that have gone silent, and passes on changes
+    to jobs made by workers to the registry.
+    """
+
+    def __init__(
+        self,
+        channel: Channel,
+        max_queue_size: int = 1000,
+        heartbeat_timeout: float = 10.0,
+        registry: Optional[JobRegistry] = None,
+    ) -> None:
+        self._channel = channel
+        self._registry = registry
+        self._max_queue_size = max_queue_size
+        self._heartbeat_timeout = heartbeat_timeout
+        self._queues: Dict[str, asyncio.Queue] = {}
+        # stream -> [batches, bytes] dropped since the last gap event
+        self._dropped: Dict[str, List[int]] = {}
+        # worker ID -> monotonic time it was last heard from
+        self._workers: Dict[str, float] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subscription = None
+
+    @property
+    def workers(self) -> List[str]:
+        return list(self._workers)
+
+    def start(self) -> None:
+        """
+        Start receiving from workers. Must be called from within the running
+        event loop.
+        """
+        self._loop = asyncio.get_running_loop()
+        if self._subscription is None:
+            self._subscription = self._channel.subscribe(
+                callback=self._on_message, topics=["output.", "worker."]
+            )
+
+    def stop(self) -> None:
+        if self._subscription is not None:
+            self._subscription.close()
+            self._subscription = None
+
+    def listen(self, stream: str) -> asyncio.Queue:
+        queue = self._queues.get(stream)
+        if queue is None:
+            queue = self._queues[stream] = asyncio.Queue(
+                maxsize=self._max_queue_size
+            )
+        return queue
+
+    def unlisten(self, stream: str) -> None:
+        self._queues.pop(stream, None)
+        self._dropped.pop(stream, None)
+
+    def pop_gap(self, stream: str) -> Optional[dict]:
+        """
+        Get a gap event for the batches of the stream dropped since the last
+        one, if any were.
+        """
+        dropped = self._dropped.pop(stream, None)
+        return gap_event(*dropped) if dropped else None
+
+    async def reap_periodically(
+        self, db: Database, notifier: JobNotifier
+    ) -> None:
+        while True:
+            await asyncio.sleep(self._heartbeat_timeout / 2)
+            deadline = time.monotonic() - self._heartbeat_timeout
+            for worker_id, last_seen in list(self._workers.items()):
+                if last_seen < deadline:
+                    del self._workers[worker_id]
+                    await self._recover(db, notifier, worker_id)
+
+            # workers this process hasn't heard from, like those that died
+            # while it was down, are found by their heartbeats in the DB
+            try:
+                stale = await WorkerHeartbeat.find_stale(
+                    db, self._heartbeat_timeout
+                )
+            except Exception:
+                log.exception("error finding stale workers")
+                continue
+            for worker_id in stale:
+                if worker_id not in self._workers:
+                    await self._recover(db, notifier, worker_id)
+
+    async def _recover(
+        self, db: Database, notifier: JobNotifier, worker_id: str
+    ) -> None:
+        log.warning(f"lost worker {worker_id}. recovering its jobs")
+        try:
+            streams = await Job.recover_worker_jobs(db, worker_id)
+            await WorkerHeartbeat.remove(db, worker_id)
+        except Exception:
+            log.exception(f"error recovering jobs of {worker_id}")
+            return
+        for stream in streams:
+            notifier.notify(stream)
+
+    def _on_message(self, message: dict) -> None:
+        # called from the subscription thread, not the event loop
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._dispatch, message)
+
+    def _dispatch(self, message: dict) -> None:
+        worker_id = message.get("worker_id")
+        if message.get("type") == STOPPED:
+            self._workers.pop(worker_id, None)
+            return
+
+        self._workers[worker_id] = time.monotonic()
+        if message.get("type") == INVALIDATE:
+            if self._registry is not None:
+                self._registry.invalidate(message["job_ids"])
+            return
+        if message.get("type") != OUTPUT:
+            return
+
+        stream = message["stream"]
+        queue = self._queues.get(stream)
+        if queue is not None:
+            if queue.full():
+                dropped = queue.get_nowait()
+                counts = self._dropped.setdefault(stream, [0, 0])
+                counts[0] += 1
+                counts[1] += len(dropped["data"])
+            queue.put_nowait(message)
+
+
+async def run_worker(env: Environment, max_concurrency: int) -> None:
+    url = resolve_url(env.get("DATABASE_URL"))
+    db = await DatabaseManager().connect(
+        url,
+        "db",
+        tables=[
+            tables.jobs,
+            tables.jobs_archive,
+            tables.job_output,
+            tables.workers,
+        ],
+    )
+    db.create_tables()
+
+    channel = notify_channel(env)
+    notifier = JobNotifier(channel)
+    notifier.start()
+
+    processes = ProcessRegistry.get()
+    processes.kill_grace_period = env.get(
+        "JOB_KILL_GRACE_PERIOD", 5.0, dtype=float
+    )
+    if channel is not None:
+        processes.connect(channel)
+
+    # recover jobs of a worker that this one may be replacing
+    for stream in await reap_orphans(db):
+        notifier.notify(stream)
+
+    worker = Worker(
+        db,
+        output_channel(env.get("WORKER_OUTPUT_ADDR")),
+        notifier,
+        max_concurrency=max_concurrency,
+        poll_interval=env.get("WORKER_POLL_INTERVAL", 1.0, dtype=float),
+    )
+    task = asyncio.create_task(worker.run())
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await JobStateWriter.get(db).flush()
+        await JobOutputStore.get(db).flush()
+        await db.disconnect()
+
+
+def work(max_concurrency: int) -> None:
+    asyncio.run(run_worker(Environment(), max_concurrency))
+
+
+def run_workers(processes: int, max_concurrency: int) -> None:
+    """
+    Run worker processes, restarting any that die, until interrupted.
+    """
+    children: Set[multiprocessing.Process] = set()
+
+    def spawn() -> None:
+        child = multiprocessing.Process(target=work, args=(max_concurrency,))
+        child.start()
+        children.add(child)
+
+    for _ in range(max(1, processes)):
+        spawn()
+
+    try:
+        while True:
+            time.sleep(1)
+            for child in list(children):
+                if not child.is_alive():
+                    log.warning(
+                        f"worker process {child.pid} exited with code "
+                        f"{child.exitcode}. restarting it"
+                    )
+                    children.discard(child)
+                    spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.join()
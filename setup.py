@@ -16,5 +16,7 @@ if __name__ == "__main__":
             "databases[postgresql]",
             "databases[sqlite]",
             "zmq",
+            "python-rapidjson",
+            "msgpack",
         ]
     )
@@ -0,0 +1,63 @@
+from typing import Callable
+from uuid import uuid4
+
+import pytest
+
+from appyratus.utils.time_utils import TimeUtils
+
+from controlgrid.api import app
+from controlgrid.constants import JobStatus
+from controlgrid.db import tables
+from controlgrid.db.database import Database, DatabaseManager
+from controlgrid.db.models import Job
+from controlgrid.processing.notifier import JobNotifier
+
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+
+@pytest.fixture
+async def db(tmp_path) -> Database:
+    # a fresh SQLite file per test, so that the per-DB singletons, like the
+    # job registry and state writer, are fresh too
+    url = f"sqlite:///{tmp_path / 'controlgrid.db'}"
+    database = await DatabaseManager().connect(
+        url,
+        "db",
+        tables=[
+            tables.jobs,
+            tables.jobs_archive,
+            tables.job_output,
+            tables.workers,
+        ],
+    )
+    database.create_tables()
+    yield database
+    await database.disconnect()
+
+
+@pytest.fixture
+def make_job() -> Callable[..., Job]:
+    def make(**values) -> Job:
+        fields = dict(
+            job_id=uuid4().hex,
+            created_at=TimeUtils.utc_now(),
+            command="echo",
+            args=[],
+            status=JobStatus.created,
+        )
+        fields.update(values)
+        return Job(**fields)
+
+    return make
+
+
+@pytest.fixture
+def api(db):
+    # the app's state, as its startup would set it up, on the test DB
+    app.db = db
+    app.notifier = JobNotifier()
+    app.relay = None
+    return app
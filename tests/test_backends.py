@@ -0,0 +1,89 @@
+import asyncio
+import signal
+
+import pytest
+
+from controlgrid.processing.backends import get_backend
+
+pytestmark = pytest.mark.anyio
+
+BACKENDS = ["pipe", "pty"]
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+async def test_readline(name):
+    proc = await get_backend(name).spawn("printf", ["a\\nb\\nc"])
+    lines = []
+    while True:
+        line = await proc.readline()
+        if not line:
+            break
+        lines.append(line.rstrip())
+    assert lines == ["a", "b", "c"]
+    assert await proc.wait() == 0
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+async def test_readlines(name):
+    proc = await get_backend(name).spawn("seq", ["1", "1000"])
+    lines = []
+    while True:
+        chunk = await proc.readlines(100)
+        if not chunk:
+            break
+        assert len(chunk) <= 100
+        lines.extend(text.rstrip() for text in chunk)
+    assert lines == [str(i) for i in range(1, 1001)]
+    assert await proc.wait() == 0
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+async def test_stderr_is_merged(name):
+    proc = await get_backend(name).spawn(
+        "sh", ["-c", "echo out; echo err >&2"]
+    )
+    lines = [(await proc.readline()).rstrip() for _ in range(2)]
+    assert sorted(lines) == ["err", "out"]
+    assert await proc.wait() == 0
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+async def test_exit_code(name):
+    proc = await get_backend(name).spawn("sh", ["-c", "exit 3"])
+    assert await proc.readlines(10) == []
+    assert await proc.wait() == 3
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+async def test_timeout_bounds_wait_for_output(name):
+    proc = await get_backend(name).spawn("sleep", ["10"], timeout=0.1)
+    with pytest.raises(asyncio.TimeoutError):
+        await proc.readline()
+    proc.kill()
+    assert await proc.wait() == -signal.SIGKILL
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+async def test_kill_reaches_process_group(name):
+    proc = await get_backend(name).spawn(
+        "sh", ["-c", "sleep 10 & echo $!; wait"]
+    )
+    grandchild = int(await proc.readline())
+    proc.kill()
+    await proc.wait()
+    # the grandchild was in the job's process group, so it's gone too
+    for _ in range(50):
+        try:
+            with open(f"/proc/{grandchild}/stat") as stat:
+                if stat.read().split()[2] == "Z":
+                    break
+        except FileNotFoundError:
+            break
+        await asyncio.sleep(0.02)
+    else:
+        pytest.fail("grandchild survived killing the job's process group")
+
+
+def test_unrecognized_backend():
+    with pytest.raises(ValueError):
+        get_backend("nope")
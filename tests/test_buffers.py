@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+import pytest
+
+from controlgrid.constants import OverflowPolicy
+from controlgrid.processing.buffers import ClientBuffer
+
+pytestmark = pytest.mark.anyio
+
+
+def event(i: int, size: int = 1) -> dict:
+    return {"id": str(i), "data": "x" * size}
+
+
+async def drain(buffer: ClientBuffer) -> list:
+    events = []
+    while True:
+        try:
+            item = await asyncio.wait_for(buffer.get(), 0.01)
+        except asyncio.TimeoutError:
+            return events
+        if item is None:
+            return events
+        events.append(item)
+
+
+async def test_block_waits_for_room():
+    buffer = ClientBuffer(OverflowPolicy.block, max_events=2)
+    for i in range(2):
+        assert await buffer.put(event(i))
+    assert not buffer.put_nowait(event(2))
+
+    put = asyncio.create_task(buffer.put(event(2)))
+    await asyncio.sleep(0.01)
+    assert not put.done()
+    assert (await buffer.get())["id"] == "0"
+    assert await asyncio.wait_for(put, 1)
+    assert [e["id"] for e in await drain(buffer)] == ["1", "2"]
+
+
+async def test_drop_oldest_sends_a_gap():
+    buffer = ClientBuffer(OverflowPolicy.drop_oldest, max_events=2)
+    for i in range(5):
+        assert await buffer.put(event(i, size=10))
+    gap, *rest = await drain(buffer)
+    assert gap["event"] == "gap"
+    assert json.loads(gap["data"]) == {"events": 3, "bytes": 30}
+    assert [e["id"] for e in rest] == ["3", "4"]
+
+
+async def test_drop_oldest_by_size():
+    buffer = ClientBuffer(
+        OverflowPolicy.drop_oldest, max_events=100, max_bytes=25
+    )
+    for i in range(4):
+        await buffer.put(event(i, size=10))
+    gap, *rest = await drain(buffer)
+    assert json.loads(gap["data"]) == {"events": 1, "bytes": 10}
+    assert [e["id"] for e in rest] == ["1", "2", "3"]
+
+
+async def test_disconnect_closes_the_buffer():
+    buffer = ClientBuffer(OverflowPolicy.disconnect, max_events=2)
+    for i in range(2):
+        assert await buffer.put(event(i))
+    assert not await buffer.put(event(2))
+    assert buffer.closed and buffer.close_reason == "client is too slow"
+    assert await buffer.get() is None
+
+
+async def test_closing_wakes_up_a_blocked_producer():
+    buffer = ClientBuffer(OverflowPolicy.block, max_events=1)
+    await buffer.put(event(0))
+    put = asyncio.create_task(buffer.put(event(1)))
+    await asyncio.sleep(0.01)
+    buffer.close()
+    assert await asyncio.wait_for(put, 1) is False
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        ClientBuffer("nope")
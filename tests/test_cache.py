@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from controlgrid.api.routes.run import Body as RunBody
+from controlgrid.api.routes.stream import Body as StreamBody
+from controlgrid.processing.cache import ResultCache
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"args": ["b"]},
+        {"cache_key": "mine"},
+        {"tag": "build"},
+        {"timeout": 5},
+        {"cpu_limit": 1},
+        {"memory_limit": 1 << 20},
+    ],
+)
+@pytest.mark.parametrize("body", [RunBody, StreamBody])
+def test_jobs_that_differ_dont_share(body, change):
+    spec = {"command": "echo", "args": ["a"], "stream": "s", "cache_ttl": 1}
+    key = body(**spec).result_key()
+    assert body(**spec).result_key() == key
+    assert body(**dict(spec, **change)).result_key() != key
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        {"stream": "other"},
+        {"output_format": "text"},
+        {"pipeline": [{"type": "strip_ansi"}]},
+    ],
+)
+def test_stream_jobs_that_differ_dont_share(change):
+    spec = {"command": "echo", "args": ["a"], "stream": "s", "cache_ttl": 1}
+    key = StreamBody(**spec).result_key()
+    assert StreamBody(**dict(spec, **change)).result_key() != key
+
+
+async def test_concurrent_calls_share_one_run():
+    cache = ResultCache()
+    calls = []
+
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    results = await asyncio.gather(
+        *[cache.run("k", 60, func) for _ in range(3)]
+    )
+    assert results == ["result"] * 3 and len(calls) == 1
+    # and then it's cached
+    assert await cache.run("k", 60, func) == "result" and len(calls) == 1
+
+
+async def test_uncacheable_and_failed_results_arent_kept():
+    cache = ResultCache()
+    assert await cache.run("k", 60, _return(1), lambda r: False) == 1
+    assert cache.lookup("k") is None
+
+    async def fail():
+        raise RuntimeError("nope")
+
+    with pytest.raises(RuntimeError):
+        await cache.run("k", 60, fail)
+    assert cache.lookup("k") is None
+
+
+def test_expiry_and_eviction(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+    cache = ResultCache(max_size=2)
+    cache.put("a", 1, ttl=10)
+    cache.put("b", 2, ttl=10)
+    # "a" was used more recently than "b", so "b" is evicted
+    assert cache.lookup("a") == 1
+    cache.put("c", 3, ttl=10)
+    assert cache.lookup("b") is None and len(cache) == 2
+
+    now[0] += 10
+    assert cache.lookup("a") is None
+    assert cache.lookup("c", stale=True) == 3
+
+
+def _return(value):
+    async def func():
+        return value
+
+    return func
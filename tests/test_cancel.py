@@ -0,0 +1,113 @@
+import asyncio
+import signal
+import time
+
+import pytest
+
+from fastapi import HTTPException
+
+from controlgrid.api.routes.jobs import post_job_cancel
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job, JobRegistry
+from controlgrid.processing.processes import ProcessRegistry
+from controlgrid.processing.streamer import Streamer
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def processes():
+    processes = ProcessRegistry.get()
+    grace_period = processes.kill_grace_period
+    yield processes
+    processes.kill_grace_period = grace_period
+
+
+async def run_stream(db, stream: str) -> None:
+    async for _ in Streamer(db, stream).generate():
+        pass
+
+
+async def wait_until_running(db, job_id: str) -> Job:
+    registry = JobRegistry.get(db)
+    deadline = time.monotonic() + 5
+    while True:
+        job = await registry.find(job_id)
+        if job.status == JobStatus.running and job.pid:
+            return job
+        assert time.monotonic() < deadline, job
+        await asyncio.sleep(0.01)
+
+
+async def test_cancel_pending_job(api, make_job):
+    job = await make_job(stream="s").create(api.db)
+    reply = await post_job_cancel(job.job_id)
+    assert reply == {"job_id": job.job_id, "status": JobStatus.cancelled}
+    assert (await Job.get(api.db, job.job_id)).status == JobStatus.cancelled
+
+    # it's done, and can't be cancelled again
+    with pytest.raises(HTTPException) as info:
+        await post_job_cancel(job.job_id)
+    assert info.value.status_code == 409
+    with pytest.raises(HTTPException) as info:
+        await post_job_cancel("missing")
+    assert info.value.status_code == 404
+
+
+async def test_cancel_claimed_job_before_it_starts(api, processes, make_job):
+    job = make_job(stream="s", command="sleep", args=["10"])
+    await job.create(api.db)
+    # as the streamer claims it, before running it
+    (claimed,) = await Job.claim_pending(api.db, stream="s", worker_id="w")
+    processes.add(job.job_id)
+
+    reply = await post_job_cancel(job.job_id)
+    assert reply["status"] == "cancelling"
+
+    # and then gets to it
+    streamer = Streamer(api.db, "s", worker_id="w")
+    streamer._job_queue.append((0, 0, claimed))
+    start = time.monotonic()
+    async for _ in streamer.generate():
+        pass
+    assert time.monotonic() - start < 5
+    job = await Job.get(api.db, job.job_id)
+    assert (job.status, job.pid) == (JobStatus.cancelled, None)
+
+
+async def test_cancel_running_job(api, make_job):
+    job = make_job(stream="s", command="sleep", args=["10"])
+    await job.create(api.db)
+    stream = asyncio.create_task(run_stream(api.db, "s"))
+    await wait_until_running(api.db, job.job_id)
+
+    reply = await post_job_cancel(job.job_id)
+    assert reply["status"] == "cancelling"
+    await asyncio.wait_for(stream, 5)
+    job = await Job.get(api.db, job.job_id)
+    assert job.status == JobStatus.cancelled
+    assert job.exit_code == -signal.SIGTERM
+
+
+async def test_cancel_kills_jobs_ignoring_sigterm(api, processes, make_job):
+    processes.kill_grace_period = 0.2
+    job = make_job(
+        stream="s",
+        command="sh",
+        args=["-c", "trap '' TERM; echo ready; sleep 10"],
+    )
+    await job.create(api.db)
+    # only cancelled once it's ignoring SIGTERM, which it says it is
+    batches = Streamer(api.db, "s").generate()
+    await asyncio.wait_for(batches.__anext__(), 5)
+
+    assert (await post_job_cancel(job.job_id))["status"] == "cancelling"
+
+    async def finish():
+        async for _ in batches:
+            pass
+
+    await asyncio.wait_for(finish(), 5)
+    job = await Job.get(api.db, job.job_id)
+    assert job.status == JobStatus.cancelled
+    assert job.exit_code == -signal.SIGKILL
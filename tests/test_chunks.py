@@ -0,0 +1,69 @@
+import pytest
+
+from controlgrid.processing.backends import get_backend
+from controlgrid.processing.chunks import LineChunker
+
+pytestmark = pytest.mark.anyio
+
+
+class Reads:
+    """
+    Stands in for a process whose output arrives in the given pieces.
+    """
+
+    def __init__(self, *pieces: bytes) -> None:
+        self._pieces = list(pieces)
+
+    async def readinto(self, buffer: memoryview) -> int:
+        if not self._pieces:
+            return 0
+        piece = self._pieces.pop(0)
+        size = min(len(buffer), len(piece))
+        buffer[:size] = piece[:size]
+        if size < len(piece):
+            self._pieces.insert(0, piece[size:])
+        return size
+
+
+async def read_all(chunker: LineChunker) -> list:
+    chunks = []
+    while True:
+        chunk = await chunker.read()
+        if chunk is None:
+            return chunks
+        chunks.append(chunk)
+
+
+async def test_partial_lines_are_carried_over():
+    chunker = LineChunker(Reads(b"a\nb", b"c\nd\n", b"e"))
+    assert await read_all(chunker) == [
+        (b"a\n", 1),
+        (b"bc\nd\n", 2),
+        (b"e", 1),
+    ]
+
+
+async def test_reads_without_a_newline_are_joined():
+    chunker = LineChunker(Reads(b"a", b"b", b"c\n"))
+    assert await read_all(chunker) == [(b"abc\n", 1)]
+
+
+async def test_long_lines_are_split_into_pieces():
+    chunker = LineChunker(Reads(b"abcdefghij\nk\n"), buffer_size=4)
+    chunks = await read_all(chunker)
+    assert all(len(data) <= 4 for data, _ in chunks)
+    assert b"".join(data for data, _ in chunks) == b"abcdefghij\nk\n"
+    assert chunks[:2] == [(b"abcd", 1), (b"efgh", 1)]
+
+
+@pytest.mark.parametrize("name", ["pipe", "pty"])
+async def test_process_output(name):
+    proc = await get_backend(name).spawn("seq", ["1", "10000"], raw=True)
+    chunks = await read_all(LineChunker(proc, buffer_size=1000))
+    assert await proc.wait() == 0
+    assert len(chunks) > 1
+    assert sum(count for _, count in chunks) == 10000
+    data = b"".join(data for data, _ in chunks)
+    # ptys are put in raw mode, so newlines aren't rewritten as \r\n
+    assert b"\r" not in data
+    assert data.split() == [str(i).encode() for i in range(1, 10001)]
@@ -0,0 +1,76 @@
+import asyncio
+
+from datetime import timedelta
+
+import pytest
+
+from appyratus.utils.time_utils import TimeUtils
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_claims_in_priority_then_fifo_order(db, make_job):
+    start = TimeUtils.utc_now()
+    jobs = [
+        make_job(stream="s", priority=priority, created_at=start + delay)
+        for priority, delay in [
+            (0, timedelta(seconds=1)),
+            (0, timedelta(seconds=0)),
+            (5, timedelta(seconds=2)),
+        ]
+    ]
+    await Job.create_many(db, jobs)
+    claimed = await Job.claim_pending(db, stream="s", worker_id="w")
+    assert [job.job_id for job in claimed] == [
+        jobs[2].job_id,
+        jobs[1].job_id,
+        jobs[0].job_id,
+    ]
+    assert {(job.status, job.worker_id) for job in claimed} == {
+        (JobStatus.enqueued, "w")
+    }
+    # and they're no longer pending
+    assert await Job.claim_pending(db, stream="s", worker_id="x") == []
+
+
+async def test_claims_only_the_stream_up_to_the_limit(db, make_job):
+    await Job.create_many(
+        db,
+        [make_job(stream="s") for _ in range(3)]
+        + [make_job(stream="other")]
+        + [make_job(stream="s", status=JobStatus.running)],
+    )
+    assert len(await Job.claim_pending(db, stream="s", limit=2)) == 2
+    claimed = await Job.claim_pending(db, stream="s", limit=10)
+    assert [job.stream for job in claimed] == ["s"]
+    assert await Job.get_pending_streams(db) == ["other"]
+
+
+async def test_concurrent_claims_never_share_a_job(db, make_job):
+    jobs = [make_job(stream="s") for _ in range(50)]
+    await Job.create_many(db, jobs)
+    claims = await asyncio.gather(
+        *[
+            Job.claim_pending(db, stream="s", limit=7, worker_id=f"w{i}")
+            for i in range(10)
+        ]
+    )
+    claimed = [job.job_id for jobs in claims for job in jobs]
+    assert len(claimed) == len(set(claimed))
+    # whatever wasn't claimed is still pending
+    rest = await Job.claim_pending(db, stream="s", limit=100, worker_id="z")
+    assert sorted(claimed + [job.job_id for job in rest]) == sorted(
+        job.job_id for job in jobs
+    )
+
+
+async def test_claims_skip_excluded_tags(db, make_job):
+    jobs = [make_job(stream="s", tag=tag) for tag in ("a", None, "b")]
+    await Job.create_many(db, jobs)
+    claimed = await Job.claim_pending(
+        db, stream="s", worker_id="w", exclude_tags=["a"]
+    )
+    assert {job.job_id for job in claimed} == {jobs[1].job_id, jobs[2].job_id}
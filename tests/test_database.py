@@ -0,0 +1,148 @@
+import sqlalchemy as sa
+import pytest
+
+from appyratus.utils.time_utils import TimeUtils
+
+from controlgrid.constants import JobStatus
+from controlgrid.db import tables
+from controlgrid.db.database import DatabaseManager
+from controlgrid.db.models import Job
+
+pytestmark = pytest.mark.anyio
+
+
+def create_baseline_jobs_table(url: str) -> None:
+    # the jobs table as first released, before any columns were added
+    metadata = sa.MetaData()
+    table = sa.Table(
+        "jobs",
+        metadata,
+        sa.Column("job_id", sa.String(), primary_key=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False, index=True),
+        sa.Column("command", sa.String(length=100), nullable=False),
+        sa.Column("args", sa.JSON(), nullable=False, default=[]),
+        sa.Column("status", sa.String(length=20), nullable=False, index=True),
+        sa.Column("tag", sa.String(length=100), index=True),
+        sa.Column("stream", sa.String(length=100), index=True),
+        sa.Column("timeout", sa.Float()),
+        sa.Column("pid", sa.Integer()),
+        sa.Column("exit_code", sa.Integer()),
+        sa.Column("error", sa.String()),
+    )
+    # created by hand, which is left alone
+    sa.Index("by_hand_pid", table.c.pid)
+    engine = sa.create_engine(url)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(
+            table.insert(),
+            [
+                {
+                    "job_id": "0" * 32,
+                    "created_at": TimeUtils.utc_now(),
+                    "command": "echo",
+                    "args": ["old"],
+                    "status": JobStatus.created,
+                    "stream": "s",
+                }
+            ],
+        )
+    engine.dispose()
+
+
+async def connect(url: str):
+    db = await DatabaseManager().connect(
+        url,
+        "db",
+        tables=[
+            tables.jobs,
+            tables.jobs_archive,
+            tables.job_output,
+            tables.workers,
+        ],
+    )
+    db.create_tables()
+    return db
+
+
+async def test_adds_missing_columns_to_existing_tables(tmp_path, make_job):
+    url = f"sqlite:///{tmp_path / 'old.db'}"
+    create_baseline_jobs_table(url)
+    db = await connect(url)
+    try:
+        columns = {
+            column["name"]
+            for column in sa.inspect(db.engine).get_columns("jobs")
+        }
+        assert set(db.tables["jobs"].c.keys()) <= columns
+
+        # rows from before get the server default of NOT NULL columns
+        old = await Job.get(db, "0" * 32)
+        assert old.priority == 0 and old.args == ["old"]
+
+        new = await make_job(stream="s", priority=5).create(db)
+        claimed = await Job.claim_pending(db, stream="s", worker_id="w")
+        assert [job.job_id for job in claimed] == [new.job_id, old.job_id]
+    finally:
+        await db.disconnect()
+
+
+async def test_adding_columns_is_idempotent(tmp_path):
+    url = f"sqlite:///{tmp_path / 'old.db'}"
+    create_baseline_jobs_table(url)
+    db = await connect(url)
+    try:
+        db.create_tables()
+        assert db.add_missing_columns(db.tables["jobs"]) == []
+    finally:
+        await db.disconnect()
+
+
+async def test_indexes_are_added_to_existing_tables(tmp_path):
+    # the indexes are on columns that the original schema didn't have, so
+    # they can only be created once the columns are added
+    url = f"sqlite:///{tmp_path / 'old.db'}"
+    create_baseline_jobs_table(url)
+    db = await connect(url)
+    try:
+        names = {
+            index["name"]
+            for index in sa.inspect(db.engine).get_indexes("jobs")
+        }
+        assert {index.name for index in db.tables["jobs"].indexes} <= names
+        assert "ix_jobs_worker_id_status" in names
+        # while the single column indexes they replace are dropped
+        assert not names & {
+            "ix_jobs_created_at",
+            "ix_jobs_status",
+            "ix_jobs_tag",
+            "ix_jobs_stream",
+        }
+        assert db.drop_stale_indexes(db.tables["jobs"]) == []
+        assert "by_hand_pid" in names
+    finally:
+        await db.disconnect()
+
+
+async def test_output_timestamps_are_added_to_existing_tables(tmp_path):
+    url = f"sqlite:///{tmp_path / 'old.db'}"
+    metadata = sa.MetaData()
+    sa.Table(
+        "job_output",
+        metadata,
+        sa.Column("job_id", sa.String(), primary_key=True),
+        sa.Column("line_no", sa.Integer(), primary_key=True),
+        sa.Column("line_count", sa.Integer(), nullable=False),
+        sa.Column("timestamp", sa.Integer(), nullable=False),
+        sa.Column("data", sa.LargeBinary(), nullable=False),
+    )
+    engine = sa.create_engine(url)
+    metadata.create_all(engine)
+    engine.dispose()
+
+    db = await connect(url)
+    try:
+        columns = sa.inspect(db.engine).get_columns("job_output")
+        assert "timestamps" in {column["name"] for column in columns}
+    finally:
+        await db.disconnect()
@@ -0,0 +1,115 @@
+import base64
+import json
+
+import pytest
+
+from appyratus.json import JsonEncoder
+
+from controlgrid.constants import JobStatus, OutputFormat
+from controlgrid.db.models import JobResult, JobStreamEvent
+from controlgrid.processing.encoding import (
+    BatchEncoder,
+    OutputBlock,
+    OutputLine,
+)
+
+
+@pytest.fixture
+def job(make_job):
+    return make_job(status=JobStatus.running, tag="build", pid=4242)
+
+
+def generic(batch) -> str:
+    # the slow path that `BatchEncoder` must match byte for byte
+    return JsonEncoder().encode(
+        [
+            event.to_event().dict()
+            if isinstance(event, OutputLine)
+            else event.dict()
+            for event in batch
+        ]
+    )
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "plain",
+        "",
+        'quotes " and \\ backslashes',
+        "tab\tand\x1b[1mansi",
+        "ünï",
+    ],
+)
+def test_lines_match_generic_encoding(job, text):
+    batch = [OutputLine(job, 1700000000, i, text) for i in range(3)]
+    assert BatchEncoder().encode(batch) == generic(batch)
+
+
+def test_lines_with_fields_match_generic_encoding(job):
+    batch = [
+        OutputLine(job, 1, 0, "50%", {"percent": "50"}),
+        OutputLine(job, 1, 1, "no fields"),
+    ]
+    encoded = BatchEncoder().encode(batch)
+    assert encoded == generic(batch)
+    first, second = json.loads(encoded)
+    assert first["line"]["data"]["fields"] == {"percent": "50"}
+    assert "fields" not in second["line"]["data"]
+
+
+def test_job_without_tag(make_job):
+    job = make_job(status=JobStatus.running, pid=1)
+    batch = [OutputLine(job, 1, 0, "x")]
+    assert BatchEncoder().encode(batch) == generic(batch)
+
+
+def test_results_match_generic_encoding(job):
+    encoder = BatchEncoder()
+    lines = [OutputLine(job, 1, 0, "done")]
+    encoder.encode(lines)
+    job.status = JobStatus.completed
+    job.exit_code = 0
+    batch = lines + [
+        JobStreamEvent(result=JobResult.create(job, []), line=None)
+    ]
+    assert encoder.encode(batch) == generic(batch)
+
+
+def test_template_follows_the_job_after_its_result(job):
+    # the template is dropped with the result, so a job that's run again,
+    # with a new pid, isn't encoded with the old one
+    encoder = BatchEncoder()
+    encoder.encode([OutputLine(job, 1, 0, "x")])
+    encoder.encode(
+        [JobStreamEvent(result=JobResult.create(job, []), line=None)]
+    )
+    job.pid = 99
+    batch = [OutputLine(job, 1, 0, "y")]
+    assert encoder.encode(batch) == generic(batch)
+
+
+def test_text_block(job):
+    job.output_format = OutputFormat.text
+    block = OutputBlock(job, 5, 10, 2, "a\nü\n".encode())
+    (event,) = json.loads(BatchEncoder().encode([block]))
+    assert event["result"] is None and event["line"] is None
+    assert event["block"] == {
+        "job_id": job.job_id,
+        "tag": "build",
+        "timestamp": 5,
+        "line_no": 10,
+        "line_count": 2,
+        "pid": 4242,
+        "encoding": "utf-8",
+        "data": "a\nü\n",
+    }
+
+
+def test_base64_block_keeps_bytes(job):
+    job.output_format = OutputFormat.base64
+    data = b"\x00\xff\n"
+    block = OutputBlock(job, 5, 0, 1, data)
+    (event,) = json.loads(BatchEncoder().encode([block]))
+    assert event["block"]["encoding"] == "base64"
+    assert base64.b64decode(event["block"]["data"]) == data
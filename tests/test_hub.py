@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job, JobRegistry, JobStateWriter
+from controlgrid.processing.batching import BatchStats
+from controlgrid.processing.buffers import ClientBuffer
+from controlgrid.processing.hub import StreamHub
+from controlgrid.processing.notifier import JobNotifier
+from controlgrid.processing.streamer import Streamer
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_watchers_dont_keep_hub_running(db, make_job):
+    await Job.create_many(db, [make_job(stream="s", args=["hi"])])
+    notifier = JobNotifier()
+    assert StreamHub.find("s") is None
+    hub = StreamHub.get(
+        "s", lambda: StreamHub("s", Streamer(db, "s"), notifier)
+    )
+    assert StreamHub.find("s") is hub
+
+    watcher = asyncio.Event()
+    hub.watch(watcher)
+    buffer = ClientBuffer()
+    hub.subscribe(buffer)
+    # woken up by each broadcast batch, without being sent them
+    await asyncio.wait_for(watcher.wait(), 5)
+    assert hub.subscriber_count == 1
+    assert await asyncio.wait_for(buffer.get(), 5) is not None
+    assert BatchStats.find("s").events > 0
+
+    # and once more when the last subscriber leaves and the hub is torn
+    # down, so that watchers know to stop following it
+    watcher.clear()
+    hub.unsubscribe(buffer)
+    assert watcher.is_set()
+    assert StreamHub.find("s") is None
+    # along with the stream's stats, so that they don't pile up
+    assert BatchStats.find("s") is None
+
+
+async def test_batch_bytes_are_counted_in_utf8(db, make_job):
+    job = make_job(stream="u", command="printf", args=["ü\\nab\\n"])
+    await Job.create_many(db, [job])
+    async for _ in Streamer(db, "u").generate():
+        pass
+    stats = BatchStats.find("u")
+    assert stats.events == 3 and stats.bytes == len("üab".encode())
+    BatchStats.remove("u")
+
+
+async def run_stream(db, stream, **kwargs):
+    async for _ in Streamer(db, stream, **kwargs).generate():
+        pass
+    stats = BatchStats.find(stream)
+    BatchStats.remove(stream)
+    return stats.flushes
+
+
+async def test_flushes_full_batches_by_lines(db, make_job):
+    job = make_job(stream="l", command="seq", args=["1", "10"])
+    await Job.create_many(db, [job])
+    # a long latency, so that only full batches and the result flush
+    flushes = await run_stream(db, "l", batch_size=2, batch_latency=60)
+    assert flushes["lines"] >= 1
+    assert flushes["latency"] == 0
+    assert flushes["result"] == 1
+
+
+async def test_flushes_held_lines_by_latency(db, make_job):
+    job = make_job(stream="t", command="sh", args=["-c", "echo a; sleep 0.3"])
+    await Job.create_many(db, [job])
+    flushes = await run_stream(db, "t", batch_size=100, batch_latency=0.01)
+    # the line is sent before the job ends, rather than with its result
+    assert flushes["latency"] == 1
+    assert flushes["lines"] == 0
+    assert flushes["result"] == 1
+
+
+async def test_flushes_each_result(db, make_job):
+    jobs = [make_job(stream="r", args=[str(i)]) for i in range(3)]
+    await Job.create_many(db, jobs)
+    flushes = await run_stream(db, "r", batch_latency=60)
+    assert flushes["result"] == 3
+    assert flushes["lines"] == flushes["latency"] == 0
+
+
+async def test_stop_waits_for_the_producer(db, make_job):
+    jobs = [
+        make_job(stream="x", command="sleep", args=["10"]) for _ in range(2)
+    ]
+    await Job.create_many(db, jobs)
+    notifier = JobNotifier()
+    streamer = Streamer(
+        db, "x", max_concurrency=1, claim_batch_size=2, notifier=notifier
+    )
+    hub = StreamHub.get("x", lambda: StreamHub("x", streamer, notifier))
+    buffer = ClientBuffer()
+    hub.subscribe(buffer)
+    producer = hub._producer
+    # until one job is running and the other is queued behind it
+    registry = JobRegistry.get(db)
+    while True:
+        running = [
+            job
+            for job in jobs
+            if (await registry.find(job.job_id)).status == JobStatus.running
+        ]
+        if running and streamer._job_queue:
+            break
+        await asyncio.sleep(0.01)
+
+    await asyncio.wait_for(hub.stop(), 5)
+    assert producer.done()
+    assert StreamHub.find("x") is None
+    assert await buffer.get() is None
+    # the job that hadn't started was put back, rather than left claimed,
+    # and the running one is cancelled with the writer's last flush
+    await JobStateWriter.get(db).flush()
+    statuses = {(await Job.get(db, job.job_id)).status for job in jobs}
+    assert statuses == {JobStatus.cancelled, JobStatus.created}
@@ -0,0 +1,235 @@
+import asyncio
+import threading
+import time
+
+import pytest
+import zmq
+
+from controlgrid.constants import DropPolicy
+from controlgrid.processing.ipc import (
+    AsyncClient,
+    Channel,
+    Client,
+    Forwarder,
+    RemoteError,
+    Service,
+    Subscription,
+)
+from controlgrid.processing.notifier import JobNotifier, notify_channel
+
+
+def test_many_publishers_through_forwarder(tmp_path):
+    addr = f"ipc://{tmp_path / 'sub'}"
+    publish_addr = f"ipc://{tmp_path / 'pub'}"
+    forwarder_context = zmq.Context()
+    forwarder = Forwarder(addr, publish_addr, context=forwarder_context)
+    forwarder.start()
+
+    context = zmq.Context()
+    # one channel per process, each both publishing and subscribing, which
+    # would fail with EADDRINUSE if they each bound the address
+    channels = [
+        Channel(addr, context=context, publish_addr=publish_addr)
+        for _ in range(2)
+    ]
+    received = []
+    subscription = channels[0].subscribe(
+        callback=received.append, topics=["a."]
+    )
+    try:
+        # subscriptions reach the publishers asynchronously, so publish
+        # until they have
+        deadline = time.monotonic() + 5
+        while len({message["source"] for message in received}) < 2:
+            assert time.monotonic() < deadline, received
+            for i, channel in enumerate(channels):
+                channel.publish({"source": i}, topic="a.x.")
+                channel.publish({"source": "other"}, topic="b.x.")
+            time.sleep(0.01)
+        assert all(message["source"] in (0, 1) for message in received)
+    finally:
+        subscription.close()
+        subscription.join()
+        context.destroy(linger=0)
+        # terminating its context stops the forwarder
+        forwarder_context.term()
+        forwarder.join()
+
+
+@pytest.mark.anyio
+async def test_notifications_between_processes(tmp_path):
+    addr = f"ipc://{tmp_path / 'sub'}"
+    publish_addr = f"ipc://{tmp_path / 'pub'}"
+    forwarder_context = zmq.Context()
+    forwarder = Forwarder(addr, publish_addr, context=forwarder_context)
+    forwarder.start()
+
+    context = zmq.Context()
+    sender, receiver = [
+        JobNotifier(Channel(addr, context=context, publish_addr=publish_addr))
+        for _ in range(2)
+    ]
+    for notifier in (sender, receiver):
+        notifier.start()
+    try:
+        generation = receiver.generation("s")
+        for _ in range(500):
+            sender.notify("s")
+            if await receiver.wait("s", generation, timeout=0.01):
+                break
+        else:
+            pytest.fail("notification never reached the other notifier")
+    finally:
+        for notifier in (sender, receiver):
+            notifier._subscription.close()
+            notifier._subscription.join()
+        context.destroy(linger=0)
+        forwarder_context.term()
+        forwarder.join()
+
+
+def test_notify_channel():
+    assert notify_channel({}) is None
+    channel = notify_channel(
+        {"NOTIFY_CHANNEL_ADDR": "ipc:///a", "NOTIFY_PUBLISH_ADDR": "ipc:///b"}
+    )
+    assert channel.addr == "ipc:///a"
+    # a publisher binding the address would conflict with the others
+    with pytest.raises(ValueError):
+        notify_channel({"NOTIFY_CHANNEL_ADDR": "ipc:///a"})
+
+
+def start_service(addr):
+    # services have no way to stop, so this one is left running in its
+    # daemon thread
+    service = Service(addr, context=zmq.Context())
+    service.add_route(lambda request: request != "fail", lambda r: r)
+    service.add_route(lambda request: request == "fail", lambda r: 1 / 0)
+    service.start()
+    return service
+
+
+def test_pipelined_requests(tmp_path):
+    addr = f"ipc://{tmp_path / 'service'}"
+    start_service(addr)
+    client = Client(addr)
+    try:
+        # bytes are sent as is, and everything else through msgpack
+        requests = [{"n": i} for i in range(10)] + [b"raw"]
+        request_ids = [client.send(request) for request in requests]
+        responses = [
+            client.receive(request_id, timeout=5)
+            for request_id in reversed(request_ids)
+        ]
+        assert bytes(responses[0]) == b"raw"
+        assert responses[1:] == list(reversed(requests[:-1]))
+        with pytest.raises(RemoteError):
+            client.request("fail", timeout=5)
+    finally:
+        client.close()
+
+
+@pytest.mark.anyio
+async def test_concurrent_async_requests(tmp_path):
+    addr = f"ipc://{tmp_path / 'service'}"
+    start_service(addr)
+    client = AsyncClient(addr)
+    try:
+        responses = await asyncio.gather(
+            *(client.request([i], timeout=5) for i in range(20))
+        )
+        assert responses == [[i] for i in range(20)]
+        with pytest.raises(RemoteError):
+            await client.request("fail", timeout=5)
+    finally:
+        client.close()
+
+
+def make_subscription(**kwargs):
+    # messages are put directly, without a socket or starting the thread
+    return Subscription(None, lambda data: data, **kwargs)
+
+
+@pytest.mark.parametrize(
+    "policy, kept",
+    [
+        (DropPolicy.drop_oldest, [2, 3, 4]),
+        (DropPolicy.drop_newest, [0, 1, 2]),
+    ],
+)
+def test_subscription_drop_policies(policy, kept):
+    subscription = make_subscription(max_queue_size=3, drop_policy=policy)
+    for i in range(5):
+        subscription._put(i)
+    assert subscription.dropped == 2
+    assert subscription.receive_many(10, timeout=0) == kept
+    assert subscription.receive(timeout=0, default="none") == "none"
+
+
+def test_subscription_blocks_until_there_is_room():
+    subscription = make_subscription(
+        max_queue_size=1, drop_policy=DropPolicy.block
+    )
+    subscription._put(0)
+    putter = threading.Thread(target=subscription._put, args=(1,))
+    putter.start()
+    putter.join(0.05)
+    assert putter.is_alive()
+
+    assert subscription.receive(timeout=1) == 0
+    putter.join(1)
+    assert not putter.is_alive()
+    assert subscription.receive(timeout=1) == 1
+    assert subscription.dropped == 0
+
+
+def test_subscription_rejects_unknown_drop_policy():
+    with pytest.raises(ValueError):
+        make_subscription(drop_policy="drop_all")
+
+
+@pytest.mark.anyio
+async def test_subscription_async_iteration_ends_when_closed():
+    subscription = make_subscription()
+
+    async def consume():
+        return [obj async for obj in subscription]
+
+    consumer = asyncio.create_task(consume())
+    await asyncio.sleep(0.01)
+    threading.Thread(target=subscription._put, args=("a",)).start()
+    await asyncio.sleep(0.05)
+    subscription.close()
+    assert await asyncio.wait_for(consumer, 1) == ["a"]
+
+
+def test_subscribers_only_receive_their_topics(tmp_path):
+    context = zmq.Context()
+    channel = Channel(f"ipc://{tmp_path / 'topics'}", context=context)
+    subscription = channel.subscribe(topics=["job.a.", "stream.s."])
+    try:
+        # subscriptions reach the publisher asynchronously, so publish
+        # until they have
+        deadline = time.monotonic() + 5
+        received = []
+        while len(set(received)) < 2:
+            assert time.monotonic() < deadline, received
+            for topic in ("job.a.", "job.ab.", "stream.s.", "stream.t."):
+                channel.publish(topic, topic=topic)
+            received.extend(subscription.receive_many(100, timeout=0.01))
+        assert set(received) == {"job.a.", "stream.s."}
+    finally:
+        subscription.close()
+        subscription.join()
+        context.destroy(linger=0)
+
+
+def test_channels_only_unpickle_when_asked_to(tmp_path):
+    addr = f"ipc://{tmp_path / 'channel'}"
+    # arbitrary objects can't be sent over a channel by default
+    channel = Channel(addr)
+    with pytest.raises(TypeError):
+        channel.serialize({"at": object()})
+    pickled = Channel(addr, serializer="pickle").serialize({"at": 1})
+    with pytest.raises(ValueError):
+        channel.deserialize(pickled)
@@ -0,0 +1,90 @@
+from datetime import timedelta
+
+import pytest
+
+from appyratus.utils.time_utils import TimeUtils
+from fastapi import HTTPException
+
+from controlgrid.api.routes.jobs import decode_cursor, encode_cursor
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def jobs(db, make_job):
+    # 25 jobs, in pairs created at the same time, so that pages have to be
+    # split between jobs with equal created_at, by job ID
+    start = TimeUtils.utc_now()
+    jobs = [
+        make_job(
+            created_at=start + timedelta(seconds=i // 2),
+            stream="even" if i % 2 == 0 else "odd",
+            status=JobStatus.completed if i % 3 == 0 else JobStatus.created,
+        )
+        for i in range(25)
+    ]
+    await Job.create_many(db, jobs)
+    # newest first, then by job ID, descending
+    return sorted(
+        jobs, key=lambda job: (job.created_at, job.job_id), reverse=True
+    )
+
+
+async def read_pages(db, limit: int, **filters):
+    pages = []
+    after = None
+    while True:
+        page = await Job.query(db, after=after, limit=limit, **filters)
+        if page:
+            pages.append([job.job_id for job in page])
+        if len(page) < limit:
+            return pages
+        after = (page[-1].created_at, page[-1].job_id)
+
+
+async def test_keyset_pages_cover_every_job_once(db, jobs):
+    pages = await read_pages(db, limit=10)
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == [job.job_id for job in jobs]
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7])
+async def test_keyset_pages_split_between_equal_timestamps(db, jobs, limit):
+    pages = await read_pages(db, limit=limit)
+    assert sum(pages, []) == [job.job_id for job in jobs]
+
+
+async def test_keyset_pages_with_filters(db, jobs):
+    pages = await read_pages(
+        db, limit=4, statuses=[JobStatus.created], stream="odd"
+    )
+    expected = [
+        job.job_id
+        for job in jobs
+        if job.status == JobStatus.created and job.stream == "odd"
+    ]
+    assert expected and sum(pages, []) == expected
+
+
+async def test_query_by_creation_time(db, jobs):
+    oldest = jobs[-1].created_at
+    found = await Job.query(
+        db, created_after=oldest, created_before=oldest + timedelta(1 / 86400)
+    )
+    assert {job.job_id for job in found} == {
+        job.job_id for job in jobs if job.created_at == oldest
+    }
+
+
+def test_cursor_round_trip(make_job):
+    job = make_job()
+    assert decode_cursor(encode_cursor(job)) == (job.created_at, job.job_id)
+
+
+@pytest.mark.parametrize("cursor", ["nope", "W10=", "e30="])
+def test_invalid_cursor(cursor):
+    with pytest.raises(HTTPException) as info:
+        decode_cursor(cursor)
+    assert info.value.status_code == 400
@@ -0,0 +1,102 @@
+import pytest
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job, JobRegistry, JobStateWriter
+
+pytestmark = pytest.mark.anyio
+
+
+async def read_row(db, job_id):
+    # straight from the DB, not the in-memory registry
+    table = db.tables["jobs"]
+    return await db.fetch_one(table.select().where(table.c.job_id == job_id))
+
+
+async def test_updates_are_written_behind(db, make_job):
+    job = await make_job(stream="s").create(db)
+    writer = JobStateWriter(db, flush_interval=60)
+
+    writer.update(job, status=JobStatus.running, pid=1)
+    writer.update(job, pid=2)
+    # set on the job right away, but not yet written
+    assert job.pid == 2
+    assert (await read_row(db, job.job_id))["pid"] is None
+
+    await writer.flush()
+    row = await read_row(db, job.job_id)
+    assert (row["status"], row["pid"]) == (JobStatus.running, 2)
+
+
+async def test_save_flushes_terminal_states(db, make_job):
+    job = await make_job(stream="s").create(db)
+    writer = JobStateWriter(db, flush_interval=60)
+
+    await writer.save(job, status=JobStatus.running)
+    assert (await read_row(db, job.job_id))["status"] == JobStatus.created
+
+    await writer.save(job, status=JobStatus.completed, exit_code=0)
+    row = await read_row(db, job.job_id)
+    assert (row["status"], row["exit_code"]) == (JobStatus.completed, 0)
+
+
+async def test_flush_groups_jobs_by_changed_fields(db, make_job):
+    jobs = [await make_job(stream="s").create(db) for _ in range(3)]
+    writer = JobStateWriter(db, flush_interval=60)
+    writer.update(jobs[0], pid=1)
+    writer.update(jobs[1], pid=2)
+    writer.update(jobs[2], status=JobStatus.running, pid=3)
+    await writer.flush()
+
+    rows = [await read_row(db, job.job_id) for job in jobs]
+    assert [row["pid"] for row in rows] == [1, 2, 3]
+    assert [row["status"] for row in rows] == [
+        JobStatus.created,
+        JobStatus.created,
+        JobStatus.running,
+    ]
+
+
+async def test_registry_keeps_live_jobs_and_evicts_finished(db, make_job):
+    registry = JobRegistry(db, max_finished=2)
+    live = registry.put(make_job(stream="s", status=JobStatus.running))
+    finished = [
+        registry.put(make_job(stream="s", status=JobStatus.completed))
+        for _ in range(3)
+    ]
+    assert len(registry) == 3
+    assert registry.peek(live.job_id) is live
+    # the least recently used finished job is the one evicted
+    assert registry.peek(finished[0].job_id) is None
+    assert registry.peek(finished[2].job_id) is finished[2]
+
+
+async def test_registry_reads_through_and_invalidates(db, make_job):
+    job = await make_job(stream="s").create(db)
+    registry = JobRegistry(db)
+    registry.invalidate([job.job_id])
+
+    found = await registry.find(job.job_id)
+    assert found.job_id == job.job_id
+    assert await registry.find(job.job_id) is found
+    assert await registry.find("missing") is None
+
+    # a change made elsewhere is only seen once invalidated
+    table = db.tables["jobs"]
+    await db.execute(
+        table.update()
+        .where(table.c.job_id == job.job_id)
+        .values(status=JobStatus.cancelled)
+    )
+    assert (await registry.find(job.job_id)).status == JobStatus.created
+    registry.invalidate([job.job_id])
+    assert (await registry.find(job.job_id)).status == JobStatus.cancelled
+
+
+async def test_flush_publishes_invalidations(db, make_job):
+    job = await make_job(stream="s").create(db)
+    published = []
+    JobRegistry.get(db).publisher = published.append
+    writer = JobStateWriter(db, flush_interval=60)
+    writer.update(job, pid=1)
+    await writer.flush()
+    assert published == [[job.job_id]]
@@ -0,0 +1,64 @@
+import pytest
+
+from controlgrid import metrics
+from controlgrid.db.models import Job
+from controlgrid.processing.batching import BatchStats
+from controlgrid.processing.streamer import Streamer
+
+
+def test_exposition_format():
+    registry = metrics.Registry()
+    counter = metrics.Counter(
+        "test_events_total", "Events.", ["kind"], registry=registry
+    )
+    gauge = metrics.Gauge("test_level", "Level.", registry=registry)
+    histogram = metrics.Histogram(
+        "test_seconds", "Time.", buckets=(1.0, 0.1), registry=registry
+    )
+    counter.labels('a "b"').inc(2)
+    gauge.set(1.5)
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+
+    assert registry.expose().splitlines() == [
+        "# HELP test_events_total Events.",
+        "# TYPE test_events_total counter",
+        'test_events_total{kind="a \\"b\\""} 2',
+        "# HELP test_level Level.",
+        "# TYPE test_level gauge",
+        "test_level 1.5",
+        "# HELP test_seconds Time.",
+        "# TYPE test_seconds histogram",
+        # buckets are cumulative, in order of their bounds
+        'test_seconds_bucket{le="0.1"} 1',
+        'test_seconds_bucket{le="1"} 2',
+        'test_seconds_bucket{le="+Inf"} 3',
+        "test_seconds_sum 5.55",
+        "test_seconds_count 3",
+    ]
+
+
+def test_metric_names_are_unique():
+    registry = metrics.Registry()
+    metrics.Gauge("test_level", "Level.", registry=registry)
+    with pytest.raises(ValueError):
+        metrics.Gauge("test_level", "Level.", registry=registry)
+
+
+@pytest.mark.anyio
+async def test_batch_flushes_keep_counting_across_runs(db, make_job):
+    flushes = metrics.STREAM_BATCH_FLUSHES.labels("m", "result")
+    before = flushes.value
+    for _ in range(2):
+        await Job.create_many(db, [make_job(stream="m", args=["hi"])])
+        async for _ in Streamer(db, "m").generate():
+            pass
+        # as the stream's hub would, once it's done
+        BatchStats.remove("m")
+    assert flushes.value == before + 2
+    exposed = metrics.REGISTRY.expose()
+    assert "# TYPE controlgrid_stream_batch_flushes_total counter" in exposed
+    assert (
+        'controlgrid_stream_batch_flushes_total{stream="m",reason="result"}'
+        in exposed
+    )
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from controlgrid.processing.notifier import JobNotifier
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("stream", ["s", JobNotifier.ANY])
+async def test_notify_wakes_waiters(stream):
+    notifier = JobNotifier()
+    generation = notifier.generation(stream)
+    waiter = asyncio.create_task(notifier.wait(stream, generation, timeout=5))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+
+    notifier.notify("s")
+    assert await asyncio.wait_for(waiter, 1)
+    assert notifier.generation(stream) == generation + 1
+
+
+async def test_notifications_sent_before_waiting_arent_missed():
+    notifier = JobNotifier()
+    generation = notifier.generation("s")
+    notifier.notify("s")
+    assert await notifier.wait("s", generation, timeout=0)
+
+
+async def test_waits_time_out_without_notifications():
+    notifier = JobNotifier()
+    generation = notifier.generation("s")
+    notifier.notify("other")
+    assert not await notifier.wait("s", generation, timeout=0.05)
+
+
+async def test_listeners():
+    notifier = JobNotifier()
+    calls = []
+    notifier.add_listener("s", lambda: calls.append("s"))
+    notifier.notify("s")
+    notifier.notify("other")
+    assert calls == ["s"]
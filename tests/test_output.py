@@ -0,0 +1,108 @@
+import pytest
+
+from controlgrid.constants import OutputFormat
+from controlgrid.db.output import JobOutputStore, OutputChunk
+from controlgrid.processing.encoding import OutputBlock, OutputLine
+from controlgrid.processing.streamer import read_stored_events
+
+pytestmark = pytest.mark.anyio
+
+
+def test_raw_chunk_slices():
+    chunk = OutputChunk("j", 10, 1)
+    chunk.add_raw(b"a\nb\n", 2)
+    # a piece of a long line, without a newline, counted as a line
+    chunk.add_raw(b"cc", 1)
+    chunk.add_raw(b"d\n", 1)
+    assert chunk.line_count == 4
+    assert [line[2] for line in chunk.slice(11, None)] == ["b", "cc", "d"]
+    assert chunk.slice_raw(11, 13) == (11, 2, 1, b"b\ncc\n")
+    assert chunk.slice_raw(0, None) == (10, 4, 1, b"a\nb\ncc\nd\n")
+    assert chunk.slice_raw(14, None) is None
+
+
+def test_chunk_round_trip():
+    chunk = OutputChunk("j", 0, 1)
+    chunk.lines = ["a", "", "ü"]
+    loaded = OutputChunk.from_row(chunk.to_row())
+    assert loaded.slice(0, None) == chunk.slice(0, None)
+    assert loaded.slice_raw(1, None) == chunk.slice_raw(1, None)
+
+
+async def test_lines_keep_the_time_they_were_output(db):
+    store = JobOutputStore(db)
+    store.extend("j", 0, ["a", "b"], 1)
+    store.extend("j", 2, ["c"], 1)
+    store.extend("j", 3, ["d", "e"], 5)
+    store.extend_raw("r", 0, b"a\n", 1, 1)
+    store.extend_raw("r", 1, b"b\nc\n", 2, 7)
+
+    expected = [
+        (0, 1, "a"),
+        (1, 1, "b"),
+        (2, 1, "c"),
+        (3, 5, "d"),
+        (4, 5, "e"),
+    ]
+    assert await store.read("j") == expected
+    assert await store.read_raw("r", from_line=1) == [(1, 2, 7, b"b\nc\n")]
+
+    # and once they're stored
+    await store.flush()
+    assert await store.read("j") == expected
+    assert await store.read("j", from_line=3, limit=1) == [(3, 5, "d")]
+    assert [line[1] for line in await store.read("r")] == [1, 7, 7]
+
+
+def test_chunks_stored_without_timestamps():
+    chunk = OutputChunk("j", 0, 3)
+    chunk.lines = ["a", "b"]
+    row = dict(chunk.to_row(), timestamps=None)
+    lines = OutputChunk.from_row(row).slice(0, None)
+    assert lines == [(0, 3, "a"), (1, 3, "b")]
+
+
+async def test_read_across_flushed_and_pending_chunks(db):
+    store = JobOutputStore(db, chunk_size=3)
+    store.extend("j", 0, [str(i) for i in range(5)], 1)
+    await store.flush()
+    store.extend("j", 5, ["5", "6"], 2)
+
+    lines = await store.read("j", from_line=2, limit=4)
+    assert lines == [(2, 1, "2"), (3, 1, "3"), (4, 1, "4"), (5, 2, "5")]
+    blocks = await store.read_raw("j", from_line=2, limit=4)
+    assert blocks == [
+        (2, 1, 1, b"2\n"),
+        (3, 2, 1, b"3\n4\n"),
+        (5, 1, 2, b"5\n"),
+    ]
+
+
+async def test_stored_raw_output_is_read_back_as_blocks(db, make_job):
+    job = make_job(output_format=OutputFormat.base64)
+    store = JobOutputStore(db)
+    data = b"\x00\xff\nbinary\n"
+    store.extend_raw(job.job_id, 0, data, 2, 1)
+    await store.flush()
+
+    events, next_line = await read_stored_events(store, job, 0, 100)
+    assert next_line == 2
+    (block,) = events
+    assert isinstance(block, OutputBlock)
+    assert (block.line_no, block.line_count, block.data) == (0, 2, data)
+    assert await read_stored_events(store, job, 2, 100) == ([], 2)
+
+
+async def test_stored_lines_are_read_back_as_lines(db, make_job):
+    job = make_job()
+    store = JobOutputStore(db)
+    store.extend(job.job_id, 0, ["a", "b"], 1)
+
+    events, next_line = await read_stored_events(
+        store, job, 1, 100, pipeline=lambda batch: batch[:0]
+    )
+    # lines filtered out by the pipeline are still read past
+    assert (events, next_line) == ([], 2)
+    events, _ = await read_stored_events(store, job, 0, 100)
+    assert [type(e) for e in events] == [OutputLine, OutputLine]
+    assert [e.text for e in events] == ["a", "b"]
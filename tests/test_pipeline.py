@@ -0,0 +1,104 @@
+import pytest
+
+from controlgrid.processing.encoding import OutputLine
+from controlgrid.processing.pipeline import Pipeline, get_pipeline
+
+
+@pytest.fixture
+def lines(make_job):
+    job = make_job()
+
+    def make(*texts: str, start: int = 0):
+        return [
+            OutputLine(job, 1, line_no, text)
+            for line_no, text in enumerate(texts, start)
+        ]
+
+    return make
+
+
+def run(specs, lines):
+    return Pipeline.parse(specs)(lines)
+
+
+def test_strip_ansi(lines):
+    out = run(
+        [{"type": "strip_ansi"}],
+        lines("\x1b[1;31mred\x1b[0m", "plain", "\x1b]0;title\x07x"),
+    )
+    assert [line.text for line in out] == ["red", "plain", "x"]
+
+
+def test_json(lines):
+    texts = ('{"level": "info"}', "not json", "[1]")
+    out = run([{"type": "json"}], lines(*texts))
+    assert [line.fields for line in out] == [{"level": "info"}, None, None]
+    out = run([{"type": "json", "drop_invalid": True}], lines(*texts))
+    assert [line.text for line in out] == ['{"level": "info"}']
+
+
+def test_extract_merges_fields(lines):
+    out = run(
+        [
+            {"type": "json"},
+            {"type": "extract", "pattern": r"(?P<percent>\d+)%"},
+        ],
+        lines('{"step": 1, "msg": "50%"}', "10% done", "nothing"),
+    )
+    assert [line.fields for line in out] == [
+        {"step": 1, "msg": "50%", "percent": "50"},
+        {"percent": "10"},
+        None,
+    ]
+    out = run(
+        [{"type": "extract", "pattern": "(?P<n>x)", "drop_unmatched": True}],
+        lines("x", "y"),
+    )
+    assert [line.text for line in out] == ["x"]
+
+
+def test_filter(lines):
+    batch = ("DEBUG a", "INFO b", "DEBUG c")
+    out = run([{"type": "filter", "pattern": "^DEBUG"}], lines(*batch))
+    assert [line.text for line in out] == ["DEBUG a", "DEBUG c"]
+    out = run(
+        [{"type": "filter", "pattern": "^DEBUG", "invert": True}],
+        lines(*batch),
+    )
+    assert [line.text for line in out] == ["INFO b"]
+
+
+def test_sample_by_line_number(lines):
+    # the same lines are kept however output is chunked
+    pipeline = Pipeline.parse([{"type": "sample", "every": 3}])
+    kept = pipeline(lines(*"abcd")) + pipeline(lines(*"efg", start=4))
+    assert [line.line_no for line in kept] == [0, 3, 6]
+
+
+@pytest.mark.parametrize(
+    "specs",
+    [
+        {"type": "json"},
+        ["json"],
+        [{"type": "nope"}],
+        [{"type": "filter"}],
+        [{"type": "filter", "pattern": "("}],
+        [{"type": "extract", "pattern": "no groups"}],
+        [{"type": "sample", "every": 0}],
+        [{"type": "json", "unknown": 1}],
+    ],
+)
+def test_invalid_specs(specs):
+    with pytest.raises(ValueError):
+        Pipeline.parse(specs)
+
+
+def test_jobs_own_pipeline_over_their_tags(make_job):
+    tagged = {"build": Pipeline.parse([{"type": "strip_ansi"}])}
+    assert get_pipeline(make_job(tag="build"), tagged) is tagged["build"]
+    assert get_pipeline(make_job(tag="other"), tagged) is None
+    own = get_pipeline(
+        make_job(tag="build", pipeline=[{"type": "json"}]), tagged
+    )
+    assert [stage.name for stage in own.stages] == ["json"]
+
@@ -0,0 +1,90 @@
+import socket
+import subprocess
+
+import pytest
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job
+from controlgrid.processing.notifier import JobNotifier
+from controlgrid.processing.processes import reap_orphans
+from controlgrid.processing.streamer import Streamer
+
+pytestmark = pytest.mark.anyio
+
+
+async def read_statuses(db, jobs):
+    # straight from the DB, not the in-memory registry
+    table = db.tables["jobs"]
+    rows = await db.fetch_all(
+        table.select().where(table.c.job_id.in_([job.job_id for job in jobs]))
+    )
+    return {row["job_id"]: (row["status"], row["worker_id"]) for row in rows}
+
+
+async def test_recover_worker_jobs(db, make_job):
+    claimed = make_job(stream="a", status=JobStatus.enqueued, worker_id="w")
+    running = make_job(stream="b", status=JobStatus.running, worker_id="w")
+    other = make_job(stream="c", status=JobStatus.enqueued, worker_id="x")
+    await Job.create_many(db, [claimed, running, other])
+
+    assert await Job.recover_worker_jobs(db, "w") == {"a"}
+
+    statuses = await read_statuses(db, [claimed, running, other])
+    assert statuses[claimed.job_id] == (JobStatus.created, None)
+    assert statuses[running.job_id] == (JobStatus.error, "w")
+    assert statuses[other.job_id] == (JobStatus.enqueued, "x")
+    # put back jobs can be claimed again
+    again = await Job.claim_pending(db, stream="a", worker_id="y")
+    assert [job.job_id for job in again] == [claimed.job_id]
+
+
+async def test_reap_orphans_of_dead_local_process(db, make_job):
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    worker_id = f"{socket.gethostname()}:{dead.pid}:abcd"
+    orphan = make_job(
+        stream="s", status=JobStatus.enqueued, worker_id=worker_id
+    )
+    # jobs of processes on other hosts are left to their heartbeats
+    remote = make_job(
+        stream="s", status=JobStatus.enqueued, worker_id="elsewhere:1:abcd"
+    )
+    await Job.create_many(db, [orphan, remote])
+
+    assert await reap_orphans(db) == {"s"}
+    statuses = await read_statuses(db, [orphan, remote])
+    assert statuses[orphan.job_id] == (JobStatus.created, None)
+    assert statuses[remote.job_id][0] == JobStatus.enqueued
+
+
+async def test_unstarted_jobs_are_put_back(db, make_job):
+    # one job at a time, with all three claimed up front, so that two are
+    # still queued when the stream is closed during the first
+    jobs = [
+        make_job(stream="s", command="sh", args=["-c", "echo x; sleep 10"])
+        for _ in range(3)
+    ]
+    await Job.create_many(db, jobs)
+    notifier = JobNotifier()
+    streamer = Streamer(
+        db,
+        "s",
+        max_concurrency=1,
+        claim_batch_size=3,
+        notifier=notifier,
+        worker_id="w",
+    )
+    generation = notifier.generation("s")
+    stream = streamer.generate()
+    await stream.__anext__()
+    await stream.aclose()
+
+    # written to the DB right away, and waiters told about them
+    statuses = await read_statuses(db, jobs)
+    put_back = [
+        job_id
+        for job_id, status in statuses.items()
+        if status == (JobStatus.created, None)
+    ]
+    assert len(put_back) == 2, statuses
+    assert notifier.generation("s") > generation
@@ -0,0 +1,124 @@
+import json
+
+import pytest
+
+from fastapi import HTTPException
+
+from controlgrid.api.routes.stream_event_source import parse_tag_limits
+from controlgrid.db.models import Job
+
+
+def test_parse_tag_limits():
+    assert parse_tag_limits(["a:1", "b:c:2"]) == {"a": 1, "b:c": 2}
+    with pytest.raises(HTTPException) as info:
+        parse_tag_limits(["a"])
+    assert info.value.status_code == 400
+    # jobs with a limit of 0 would be claimed and put back forever
+    with pytest.raises(HTTPException) as info:
+        parse_tag_limits(["a:0"])
+    assert info.value.status_code == 422
+
+
+async def post(app, path: str, chunks, content_type: str):
+    # drive the app over ASGI, sending the body in the given chunks
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", content_type.encode())],
+        "client": ("test", 1),
+        "server": ("test", 80),
+    }
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": True}
+        for chunk in chunks
+    ]
+    messages.append({"type": "http.request", "body": b"", "more_body": False})
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    status = sent[0]["status"]
+    body = b"".join(m.get("body", b"") for m in sent[1:])
+    return status, json.loads(body)
+
+
+SPECS = [
+    {"command": "echo", "args": ["1"], "stream": "a"},
+    {"command": "echo", "args": ["2"], "stream": "b", "priority": 5},
+]
+
+
+@pytest.mark.anyio
+async def test_stream_batch_from_json_array(api):
+    generations = [api.notifier.generation(name) for name in "ab"]
+    status, body = await post(
+        api, "/stream/batch", [json.dumps(SPECS).encode()], "application/json"
+    )
+    assert status == 200
+    jobs = [await Job.get(api.db, job_id) for job_id in body["job_ids"]]
+    assert [(job.stream, job.args) for job in jobs] == [
+        ("a", ["1"]),
+        ("b", ["2"]),
+    ]
+    assert jobs[1].priority == 5
+    assert [api.notifier.generation(name) for name in "ab"] == [
+        generation + 1 for generation in generations
+    ]
+
+
+@pytest.mark.anyio
+async def test_stream_batch_from_ndjson(api):
+    data = b"\n".join(json.dumps(spec).encode() for spec in SPECS) + b"\n\n"
+    # split mid-line, as the body may arrive in any chunks
+    chunks = [data[:10], data[10:50], data[50:]]
+    status, body = await post(
+        api, "/stream/batch", chunks, "application/x-ndjson"
+    )
+    assert status == 200
+    jobs = [await Job.get(api.db, job_id) for job_id in body["job_ids"]]
+    assert [job.args for job in jobs] == [["1"], ["2"]]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "data, content_type, status, detail",
+    [
+        (b'[{"command": "echo"}]', "application/json", 422, "index 0"),
+        (b'{"command": "echo"}', "application/json", 400, "array"),
+        (b"[", "application/json", 400, "invalid JSON"),
+        (
+            b'{"command": "echo", "args": [], "stream": "s"}\n{"command"',
+            "application/x-ndjson",
+            400,
+            "invalid JSON at index 1",
+        ),
+        (
+            b'{"command": "echo", "args": [], "stream": "s"}\n'
+            b'{"command": "echo", "args": [], "stream": "s", '
+            b'"output_format": "hex"}\n',
+            "application/x-ndjson",
+            422,
+            "invalid job spec at index 1",
+        ),
+    ],
+)
+async def test_stream_batch_rejects_bad_specs(
+    api, data, content_type, status, detail
+):
+    table = api.db.tables["jobs"]
+    reply_status, body = await post(api, "/stream/batch", [data], content_type)
+    assert reply_status == status
+    assert detail in body["detail"]
+    # nothing is created unless every spec is valid
+    assert await api.db.fetch_all(table.select()) == []
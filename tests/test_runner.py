@@ -0,0 +1,53 @@
+import signal
+import time
+
+import pytest
+
+from controlgrid.constants import JobStatus
+from controlgrid.processing.runner import Runner
+
+pytestmark = pytest.mark.anyio
+
+
+async def run(db, job, **kwargs):
+    await job.create(db)
+    return await Runner(**kwargs).run(db, job)
+
+
+async def test_timeout_terminates_the_job(db, make_job):
+    job = make_job(command="sleep", args=["10"], timeout=1)
+    result = await run(db, job, kill_grace_period=5)
+    assert result.job.status == JobStatus.failed
+    assert result.job.exit_code == -signal.SIGTERM
+    assert result.job.error == "timed out after 1 seconds"
+
+
+async def test_timeout_kills_jobs_ignoring_sigterm(db, make_job):
+    # sleep inherits the ignored signal, so the whole group ignores it
+    job = make_job(
+        command="sh", args=["-c", "trap '' TERM; sleep 10"], timeout=1
+    )
+    start = time.monotonic()
+    result = await run(db, job, kill_grace_period=0.2)
+    assert time.monotonic() - start < 5
+    assert result.job.status == JobStatus.failed
+    assert result.job.exit_code == -signal.SIGKILL
+
+
+async def test_truncated_output_keeps_whole_lines_of_the_tail(db, make_job):
+    job = make_job(command="seq", args=["1", "10000"])
+    result = await run(db, job, max_output_bytes=100)
+    assert result.job.status == JobStatus.completed
+    assert result.output[-1] == "10000"
+    assert len("\n".join(result.output)) < 100
+    # the partial line at the head of the buffer is dropped
+    first = int(result.output[0])
+    assert result.output == [str(n) for n in range(first, 10001)]
+
+
+async def test_missing_command_is_an_error(db, make_job):
+    job = make_job(command="controlgrid-no-such-command")
+    result = await run(db, job)
+    assert result.job.status == JobStatus.error
+    assert result.output == []
+    assert "controlgrid-no-such-command" in result.job.error
@@ -0,0 +1,137 @@
+import asyncio
+
+from datetime import timedelta
+
+import pytest
+
+from appyratus.utils.time_utils import TimeUtils
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job
+from controlgrid.processing.notifier import JobNotifier
+from controlgrid.processing.streamer import Streamer
+
+pytestmark = pytest.mark.anyio
+
+
+async def read_rows(db, jobs):
+    # straight from the DB, not the in-memory registry
+    table = db.tables["jobs"]
+    rows = await db.fetch_all(
+        table.select().where(table.c.job_id.in_([job.job_id for job in jobs]))
+    )
+    return {row["job_id"]: row for row in rows}
+
+
+async def schedule(streamer):
+    # start jobs as `generate` would, without reading their output
+    tasks = {}
+    await streamer._schedule(tasks, asyncio.Queue())
+    return tasks
+
+
+async def stop(tasks):
+    for task in tasks.values():
+        task.cancel()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+
+async def test_tag_limited_jobs_dont_hold_slots(db, make_job):
+    start = TimeUtils.utc_now()
+    jobs = [
+        make_job(
+            stream="s",
+            tag=tag,
+            command="sleep",
+            args=["10"],
+            created_at=start + timedelta(seconds=i),
+        )
+        for i, tag in enumerate(["a", "a", "b", "c"])
+    ]
+    await Job.create_many(db, jobs)
+    notifier = JobNotifier()
+    generation = notifier.generation("s")
+    streamer = Streamer(
+        db,
+        "s",
+        max_concurrency=3,
+        tag_limits={"a": 1},
+        notifier=notifier,
+        worker_id="w",
+    )
+    tasks = await schedule(streamer)
+    try:
+        # the second "a" job was claimed along with the first, but is put
+        # back, and jobs with other tags claimed in its place
+        assert sorted(job.tag for job in tasks) == ["a", "b", "c"]
+        rows = await read_rows(db, jobs)
+        held_back = rows[jobs[1].job_id]
+        assert (held_back["status"], held_back["worker_id"]) == (
+            JobStatus.created,
+            None,
+        )
+        assert notifier.generation("s") > generation
+
+        # and claimed again once the running "a" job is done
+        a_job = next(job for job in tasks if job.tag == "a")
+        task = tasks.pop(a_job)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        streamer._release(a_job)
+        await streamer._schedule(tasks, asyncio.Queue())
+        assert jobs[1].job_id in {job.job_id for job in tasks}
+    finally:
+        await stop(tasks)
+
+
+async def test_runs_highest_priority_jobs_up_to_max_concurrency(
+    db, make_job
+):
+    jobs = [
+        make_job(stream="s", priority=priority, command="sleep", args=["10"])
+        for priority in (0, 5, 1, 9)
+    ]
+    await Job.create_many(db, jobs)
+    streamer = Streamer(
+        db, "s", max_concurrency=2, claim_batch_size=4, worker_id="w"
+    )
+    tasks = await schedule(streamer)
+    try:
+        assert sorted(job.priority for job in tasks) == [5, 9]
+        # the rest stay claimed, queued for the next free slot
+        assert [job.priority for _, _, job in streamer._job_queue] == [1, 0]
+    finally:
+        await stop(tasks)
+
+
+async def test_tag_limits_cap_concurrent_jobs(db, make_job):
+    jobs = [
+        make_job(stream="s", tag=tag, command="sleep", args=["10"])
+        for tag in ["a", "a", "a", "b", None]
+    ]
+    await Job.create_many(db, jobs)
+    streamer = Streamer(
+        db,
+        "s",
+        max_concurrency=5,
+        tag_limits={"a": 2},
+        notifier=JobNotifier(),
+        worker_id="w",
+    )
+    tasks = await schedule(streamer)
+    try:
+        assert sorted(job.tag or "" for job in tasks) == ["", "a", "a", "b"]
+    finally:
+        await stop(tasks)
+
+
+async def test_all_tag_limited_jobs_run_in_turn(db, make_job):
+    jobs = [make_job(stream="s", tag="a", args=[str(i)]) for i in range(3)]
+    await Job.create_many(db, jobs)
+    streamer = Streamer(
+        db, "s", tag_limits={"a": 1}, notifier=JobNotifier(), worker_id="w"
+    )
+    async for _ in streamer.generate():
+        pass
+    rows = await read_rows(db, jobs)
+    assert {row["status"] for row in rows.values()} == {JobStatus.completed}
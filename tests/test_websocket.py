@@ -0,0 +1,188 @@
+import asyncio
+
+import msgpack
+import pytest
+import rapidjson
+
+from controlgrid.api.routes.websocket import Credits, Session
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job
+from controlgrid.processing.streamer import Streamer
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeSocket:
+    """
+    Stands in for a `WebSocket`, with frames sent by the test and received
+    from the session through queues.
+    """
+
+    def __init__(self, binary: bool = False) -> None:
+        self.binary = binary
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        self.outgoing: asyncio.Queue = asyncio.Queue()
+
+    async def receive(self) -> dict:
+        return await self.incoming.get()
+
+    async def send_text(self, text: str) -> None:
+        await self.outgoing.put(rapidjson.loads(text))
+
+    async def send_bytes(self, data: bytes) -> None:
+        await self.outgoing.put(msgpack.unpackb(data, raw=False))
+
+    def send(self, frame) -> None:
+        if self.binary:
+            message = {"bytes": msgpack.packb(frame, use_bin_type=True)}
+        else:
+            message = {"text": rapidjson.dumps(frame)}
+        self.incoming.put_nowait(dict(message, type="websocket.receive"))
+
+    async def receive_frame(self, timeout: float = 5) -> dict:
+        return await asyncio.wait_for(self.outgoing.get(), timeout)
+
+    async def request(self, frame: dict) -> dict:
+        self.send(frame)
+        return await self.receive_frame()
+
+
+@pytest.fixture
+async def socket(api):
+    socket = FakeSocket()
+    session = asyncio.create_task(Session(socket, binary=False).run())
+    yield socket
+    socket.incoming.put_nowait({"type": "websocket.disconnect"})
+    await asyncio.wait_for(session, 5)
+
+
+async def run_stream(db, stream: str) -> None:
+    async for _ in Streamer(db, stream).generate():
+        pass
+
+
+async def test_submit(api, socket):
+    spec = {"command": "echo", "args": ["hi"], "stream": "s"}
+    reply = await socket.request(
+        {"op": "submit", "id": 1, "jobs": [spec, spec]}
+    )
+    assert reply["op"] == "submitted" and reply["id"] == 1
+    assert len(reply["job_ids"]) == 2
+    for job_id in reply["job_ids"]:
+        assert (await Job.get(api.db, job_id)).status == JobStatus.created
+
+
+async def test_subscribe_to_stream_and_unsubscribe(api, socket):
+    reply = await socket.request(
+        {"op": "subscribe", "id": 1, "stream": "s", "credits": 100}
+    )
+    assert reply == {"op": "subscribed", "id": 1, "sub": 1}
+
+    spec = {"command": "echo", "args": ["hi"], "stream": "s"}
+    submitted = await socket.request({"op": "submit", "jobs": [spec]})
+    job_id = submitted["job_ids"][0]
+
+    # output, then the job's result
+    lines = []
+    while True:
+        frame = await socket.receive_frame()
+        assert frame["op"] == "output" and frame["sub"] == 1
+        events = frame["data"]
+        lines += [e["line"]["data"]["text"] for e in events if e["line"]]
+        results = [e["result"] for e in events if e["result"]]
+        if results:
+            assert results[0]["job"]["job_id"] == job_id
+            break
+    assert lines == ["hi"]
+
+    reply = await socket.request({"op": "unsubscribe", "id": 2, "sub": 1})
+    assert reply == {"op": "unsubscribed", "id": 2, "sub": 1}
+
+
+async def test_credits_hold_back_frames(api, socket, make_job):
+    job = make_job(stream="c", command="seq", args=["1", "3"])
+    await job.create(api.db)
+    await run_stream(api.db, "c")
+
+    socket.send({"op": "subscribe", "job": job.job_id, "credits": 1})
+    assert (await socket.receive_frame())["op"] == "subscribed"
+    output = await socket.receive_frame()
+    lines = [event["line"]["data"]["text"] for event in output["data"]]
+    assert lines == ["1", "2", "3"]
+    # the result waits for another credit
+    with pytest.raises(asyncio.TimeoutError):
+        await socket.receive_frame(timeout=0.2)
+
+    socket.send({"op": "credit", "sub": 1, "credits": 1})
+    result = await socket.receive_frame()
+    assert result["data"][0]["result"]["job"]["status"] == JobStatus.completed
+    # and ending doesn't take one
+    end = await socket.receive_frame()
+    assert end == {"op": "end", "sub": 1, "reason": "finished"}
+
+
+async def test_spending_credits_waits_for_grants():
+    credits = Credits(1)
+    await asyncio.wait_for(credits.spend(), 1)
+    spend = asyncio.create_task(credits.spend())
+    await asyncio.sleep(0.01)
+    assert not spend.done()
+    credits.grant(1)
+    await asyncio.wait_for(spend, 1)
+
+
+async def test_cancel(api, socket, make_job):
+    job = await make_job(stream="s").create(api.db)
+    reply = await socket.request(
+        {"op": "cancel", "id": 1, "job_ids": [job.job_id, "missing"]}
+    )
+    assert reply == {
+        "op": "cancelled",
+        "id": 1,
+        "jobs": {job.job_id: JobStatus.cancelled, "missing": None},
+    }
+    assert (await Job.get(api.db, job.job_id)).status == JobStatus.cancelled
+
+
+@pytest.mark.parametrize(
+    "frame, error",
+    [
+        ([1, 2], "expected an object"),
+        ({"op": "dance", "id": 1}, "unrecognized op: dance"),
+        ({"op": "subscribe", "id": 1}, "expected a stream or job"),
+        ({"op": "subscribe", "id": 1, "job": "missing"}, "not found"),
+        ({"op": "unsubscribe", "id": 1, "sub": 9}, "no such subscription"),
+        ({"op": "credit", "id": 1, "sub": 9}, "no such subscription"),
+        ({"op": "submit", "id": 1}, "expected a list of jobs"),
+        ({"op": "submit", "id": 1, "jobs": [{}]}, "invalid job spec"),
+        (
+            {
+                "op": "subscribe",
+                "id": 1,
+                "stream": "s",
+                "params": {"tag_limit": ["a:0"]},
+            },
+            "tag_limit must be at least 1",
+        ),
+    ],
+)
+async def test_bad_frames_get_error_frames(api, socket, frame, error):
+    reply = await socket.request(frame)
+    assert reply["op"] == "error"
+    if isinstance(frame, dict):
+        assert reply["id"] == frame["id"]
+    assert error in reply["error"]
+
+
+async def test_msgpack_frames(api, make_job):
+    socket = FakeSocket(binary=True)
+    session = asyncio.create_task(Session(socket, binary=True).run())
+    try:
+        job = await make_job(stream="s").create(api.db)
+        reply = await socket.request(
+            {"op": "cancel", "id": 1, "job_ids": [job.job_id]}
+        )
+        assert reply["jobs"] == {job.job_id: JobStatus.cancelled}
+    finally:
+        socket.incoming.put_nowait({"type": "websocket.disconnect"})
+        await asyncio.wait_for(session, 5)
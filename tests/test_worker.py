@@ -0,0 +1,75 @@
+import asyncio
+import json
+
+from datetime import timedelta
+
+import pytest
+
+from appyratus.utils.time_utils import TimeUtils
+
+from controlgrid.constants import JobStatus
+from controlgrid.db.models import Job, WorkerHeartbeat
+from controlgrid.processing.notifier import JobNotifier
+from controlgrid.processing.worker import OUTPUT, OutputRelay
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_heartbeats(db):
+    await WorkerHeartbeat.beat(db, "w")
+    await WorkerHeartbeat.beat(db, "w")
+    assert await WorkerHeartbeat.find_stale(db, 60) == []
+    await asyncio.sleep(0.02)
+    assert await WorkerHeartbeat.find_stale(db, 0.01) == ["w"]
+    await WorkerHeartbeat.remove(db, "w")
+    assert await WorkerHeartbeat.find_stale(db, 0) == []
+
+
+async def test_reap_workers_only_known_from_the_db(db, make_job):
+    # a worker that died before this process ever heard from it
+    table = db.tables["workers"]
+    await db.execute(
+        table.insert().values(
+            worker_id="dead",
+            heartbeat_at=TimeUtils.utc_now() - timedelta(minutes=1),
+        )
+    )
+    await WorkerHeartbeat.beat(db, "alive")
+    claimed = make_job(stream="s", status=JobStatus.enqueued, worker_id="dead")
+    running = make_job(
+        stream="s", status=JobStatus.running, worker_id="alive"
+    )
+    await Job.create_many(db, [claimed, running])
+
+    notifier = JobNotifier()
+    generation = notifier.generation("s")
+    relay = OutputRelay(None, heartbeat_timeout=1)
+    reaper = asyncio.create_task(relay.reap_periodically(db, notifier))
+    try:
+        assert await notifier.wait("s", generation, timeout=10)
+    finally:
+        reaper.cancel()
+
+    assert (await Job.get(db, claimed.job_id)).status == JobStatus.created
+    assert (await Job.get(db, running.job_id)).status == JobStatus.running
+    assert await WorkerHeartbeat.find_stale(db, 0) == ["alive"]
+
+
+def test_relay_reports_dropped_batches():
+    relay = OutputRelay(None, max_queue_size=2)
+    queue = relay.listen("s")
+    for i in range(5):
+        relay._dispatch(
+            {
+                "type": OUTPUT,
+                "worker_id": "w",
+                "stream": "s",
+                "id": str(i),
+                "data": "x" * 10,
+            }
+        )
+    gap = relay.pop_gap("s")
+    assert gap["event"] == "gap"
+    assert json.loads(gap["data"]) == {"events": 3, "bytes": 30}
+    assert relay.pop_gap("s") is None
+    assert [queue.get_nowait()["id"] for _ in range(2)] == ["3", "4"]